@@ -1,9 +1,12 @@
 # FusedChatbot/server/ai_core_service/app.py
+import time
+_STARTUP_T0 = time.perf_counter()
 import os
 import sys
 import logging
 import tempfile
-import pandas as pd
+import importlib
+import threading
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 
@@ -16,10 +19,6 @@ if AI_CORE_SERVICE_DIR not in sys.path: sys.path.insert(0, AI_CORE_SERVICE_DIR)
 try:
     from ai_core_service import config
     from ai_core_service import file_parser, faiss_handler, llm_handler
-    from ai_core_service.modules.web_resources import youtube_dl_core, pdf_downloader
-    from ai_core_service.modules.content_creation import md_to_office
-    from ai_core_service.modules.pdf_processing import ocr_tesseract, ocr_nougat
-    from ai_core_service.modules.academic_search import combined_search, core_api as academic_core_api
 except ImportError as e:
     print(f"CRITICAL IMPORT ERROR in app.py: {e}\nSys.path: {sys.path}\nCheck __init__.py files, module names, and ensure all dependencies are installed.")
     sys.exit(1)
@@ -29,6 +28,69 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
+
+class _LazyModule:
+    """Imports a tool module (and its heavy dependencies: yt_dlp, pandas, pptx, ...) on first attribute access."""
+
+    def __init__(self, module_name: str):
+        self._module_name = module_name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    self._module = importlib.import_module(self._module_name)
+                    logger.info(f"Imported tool module '{self._module_name}' in {time.perf_counter() - start:.2f}s")
+        return getattr(self._module, attr)
+
+
+youtube_dl_core = _LazyModule('ai_core_service.modules.web_resources.youtube_dl_core')
+pdf_downloader = _LazyModule('ai_core_service.modules.web_resources.pdf_downloader')
+md_to_office = _LazyModule('ai_core_service.modules.content_creation.md_to_office')
+ocr_tesseract = _LazyModule('ai_core_service.modules.pdf_processing.ocr_tesseract')
+ocr_nougat = _LazyModule('ai_core_service.modules.pdf_processing.ocr_nougat')
+combined_search = _LazyModule('ai_core_service.modules.academic_search.combined_search')
+academic_core_api = _LazyModule('ai_core_service.modules.academic_search.core_api')
+
+# --- Startup State ---
+# Phase timings (seconds) in completion order; 'imports' covers everything up to here
+startup_state = {"status": "starting", "error": None, "phases": {"imports": round(time.perf_counter() - _STARTUP_T0, 3)}}
+
+
+def _is_dataframe(obj) -> bool:
+    """DataFrame check that never imports pandas itself (a DataFrame implies a tool already did)."""
+    pd = sys.modules.get('pandas')
+    return pd is not None and isinstance(obj, pd.DataFrame)
+
+
+def _run_startup_phase(name: str, func):
+    start = time.perf_counter()
+    result = func()
+    startup_state["phases"][name] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run_startup() -> bool:
+    """Loads the embedding model and default index, recording how long each phase takes."""
+    try:
+        _run_startup_phase("faiss_dir", faiss_handler.ensure_faiss_dir)
+        _run_startup_phase("embedding_model", faiss_handler.get_embedding_model)
+        if config.EMBEDDING_WARMUP:
+            _run_startup_phase("embedding_warmup", faiss_handler.warm_up_embedding_model)
+        _run_startup_phase("default_index", lambda: faiss_handler.load_or_create_index(config.DEFAULT_INDEX_USER_ID))
+        startup_state["phases"]["total"] = round(time.perf_counter() - _STARTUP_T0, 3)
+        startup_state["status"] = "ready"
+        logger.info("Startup timings: " + ", ".join(f"{name}={seconds:.2f}s" for name, seconds in startup_state["phases"].items()))
+        return True
+    except Exception as e:
+        startup_state["status"] = "failed"
+        startup_state["error"] = str(e)
+        logger.critical(f"FAISS STARTUP FAIL: {e}", exc_info=True)
+        return False
+
 if not os.path.exists(config.DEFAULT_ASSETS_DIR) or not os.access(config.DEFAULT_ASSETS_DIR, os.W_OK):
     logger.warning(f"WARNING: DEFAULT_ASSETS_DIR '{config.DEFAULT_ASSETS_DIR}' does not exist or is not writable. Attempting to create...")
     try:
@@ -42,7 +104,26 @@ def create_error_response(message, status_code=500, details=None):
     logger.error(f"API Error ({status_code}): {message}" + (f" Details: {details}" if details else ""))
     return jsonify({"error": message, "status": "error", "details": str(details) if details else None}), status_code
 
+@app.errorhandler(ImportError)
+def tool_import_error(e):
+    # Tool modules are imported on first use, so a missing optional dependency surfaces here
+    return create_error_response(f"Tool dependency not available: {e}", 501)
+
 # --- Standard FusedChat Routes ---
+@app.route('/live', methods=['GET'])
+def liveness_check():
+    """Liveness: the process is serving requests (fails only if startup failed for good)."""
+    if startup_state["status"] == "failed":
+        return jsonify({"status": "error", "startup": startup_state}), 500
+    return jsonify({"status": "ok"}), 200
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness: embedding model warmed up and default index loaded."""
+    ready = startup_state["status"] == "ready"
+    return jsonify({"status": startup_state["status"], "ready": ready, "error": startup_state["error"],
+                    "startup_timings": startup_state["phases"]}), 200 if ready else 503
+
 @app.route('/health', methods=['GET'])
 def health_check():
     logger.info("\n--- Received request at /health ---")
@@ -60,6 +141,12 @@ def health_check():
         "message": f"Python AI Core health. FAISS {'OK' if faiss_ok else 'Issue'}.",
         "embedding_model": embedding_model_name,
         "default_index_loaded": faiss_ok,
+        "query_embedding_cache": faiss_handler.query_embedding_cache.stats(),
+        "embedding_store": faiss_handler.get_embedding_store_stats(),
+        "embedding_dispatcher": faiss_handler.get_embedding_dispatcher_stats(),
+        "mmap_indices": faiss_handler.get_mmap_stats(),
+        "index_cache": faiss_handler.get_index_cache_stats(),
+        "startup": startup_state,
         "DEFAULT_ASSETS_DIR_status": "Exists & Writable" if os.path.exists(config.DEFAULT_ASSETS_DIR) and os.access(config.DEFAULT_ASSETS_DIR, os.W_OK) else "MISSING/NOT WRITABLE!",
     }), 200 if faiss_ok else 503
 
@@ -86,6 +173,7 @@ def health_check():
             raise RuntimeError("Embedding model could not be initialized.")
         status_details["sentence_transformer_load"] = "OK"
         status_details["embedding_dimension"] = faiss_handler.get_embedding_dimension(model)
+        status_details["embedding_models"] = faiss_handler.get_loaded_embedding_models()
 
         if config.DEFAULT_INDEX_USER_ID in faiss_handler.loaded_indices:
              status_details["default_index_loaded"] = True
@@ -106,6 +194,45 @@ def health_check():
     return jsonify(status_details), http_status_code
 
 
+# --- Admin: Index Statistics ---
+_INDEX_METRICS = [ # (metric name, stats key, help text)
+    ("ai_core_index_vectors", "vectors", "Vectors stored in the FAISS index"),
+    ("ai_core_index_dimension", "dimension", "Vector dimension of the index"),
+    ("ai_core_index_vector_bytes", "vector_bytes", "Estimated heap bytes of the index vectors"),
+    ("ai_core_index_docstore_bytes", "docstore_bytes", "Estimated bytes of the chunk texts and metadata"),
+    ("ai_core_index_load_seconds", "load_seconds", "Time taken by the last load or creation"),
+    ("ai_core_index_last_access_timestamp", "last_access", "Last query or write (epoch seconds)"),
+    ("ai_core_index_last_save_timestamp", "last_save_at", "Last base snapshot (epoch seconds)"),
+]
+
+def _format_prometheus(indices, cache, process):
+    lines = []
+    for name, key, help_text in _INDEX_METRICS:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for entry in indices:
+            if entry[key] is not None:
+                lines.append(f'{name}{{user_id="{entry["user_id"]}",index_kind="{entry["index_kind"]}"}} {entry[key]}')
+    for name, value in [("ai_core_loaded_indices", cache["loaded"]), ("ai_core_index_cache_bytes", cache["current_bytes"]),
+                        ("ai_core_index_evictions_total", cache["evictions"]), ("ai_core_process_rss_bytes", process["rss_bytes"]),
+                        ("ai_core_process_peak_rss_bytes", process["peak_rss_bytes"])]:
+        if value is not None:
+            lines += [f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+@app.route('/admin/index_stats', methods=['GET'])
+def index_stats_route():
+    """Loaded indices with sizes and timings plus process RSS; ?format=prometheus for the text exposition format."""
+    try:
+        indices = faiss_handler.get_index_stats()
+        cache = faiss_handler.get_index_cache_stats()
+        process = faiss_handler.get_process_memory()
+        if request.args.get('format') == 'prometheus':
+            return _format_prometheus(indices, cache, process), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+        return jsonify({"indices": indices, "index_cache": cache, "process": process,
+                        "embedding_store": faiss_handler.get_embedding_store_stats(), "status": "success"}), 200
+    except Exception as e: return create_error_response(f"Failed to collect index stats: {e}", 500)
+
+
 @app.route('/add_document', methods=['POST'])
 def add_document():
     # This route remains unchanged as it does not interact with LLMs
@@ -120,11 +247,27 @@ def add_document():
         text = file_parser.parse_file(file_path)
         if not text or not text.strip(): return jsonify({"message": f"No text in '{original_name}'.", "status": "skipped"}), 200
         docs = file_parser.chunk_text(text, original_name, user_id)
-        faiss_handler.add_documents_to_index(user_id, docs)
-        return jsonify({"message": f"'{original_name}' added.", "chunks_added": len(docs), "status": "added"}), 200
+        # 'upsert' replaces chunks from an earlier upload of the same file; 'compression' only applies to a new index
+        result = faiss_handler.add_documents_to_index(user_id, docs, compression=data.get('compression'), upsert=bool(data.get('upsert', False)))
+        status = "added" if result["chunks_added"] or result["chunks_replaced"] else "skipped" # 'skipped': every chunk was a duplicate
+        return jsonify({"message": f"'{original_name}' added.", **result, "status": status}), 200
     except Exception as e: return create_error_response(f"Failed to process '{original_name}': {e}", 500)
 
 
+@app.route('/delete_document', methods=['POST'])
+def delete_document():
+    logger.info("\n--- Received request at /delete_document ---")
+    if not request.is_json: return create_error_response("Request must be JSON", 400)
+    data = request.get_json()
+    if data is None: return create_error_response("Invalid or empty JSON body", 400)
+    user_id = data.get('user_id'); document_name = data.get('document_name') or data.get('original_name')
+    if not user_id or not document_name: return create_error_response("Missing user_id or document_name", 400)
+    try:
+        removed = faiss_handler.remove_document(user_id, document_name)
+        return jsonify({"message": f"'{document_name}' removed.", "chunks_removed": removed, "status": "removed" if removed else "not_found"}), 200
+    except Exception as e: return create_error_response(f"Failed to remove '{document_name}': {e}", 500)
+
+
 @app.route('/query_rag_documents', methods=['POST'])
 def query_rag_documents_route():
     # This route remains unchanged as it does not interact with LLMs
@@ -133,14 +276,56 @@ def query_rag_documents_route():
     data = request.get_json()
     if data is None: return create_error_response("Invalid or empty JSON body", 400)
     user_id = data.get('user_id'); query_text = data.get('query'); k = data.get('k', 5)
-    if not user_id or not query_text: return create_error_response("Missing user_id or query", 400)
+    nprobe = data.get('nprobe'); ef_search = data.get('ef_search') # Optional ANN search-breadth overrides
+    rerank = data.get('rerank') # Optional exact re-rank of compressed-index candidates
+    mode = data.get('mode') # 'vector' or 'hybrid' (BM25 + vector, reciprocal-rank fusion)
+    document_names = data.get('document_names') # Optional: only search chunks of these uploads
+    if isinstance(document_names, str): document_names = [document_names]
+    # 'query' may be a single string or a list of strings ('queries' is accepted as an alias)
+    queries = data.get('queries', query_text)
+    if isinstance(queries, str): queries = [queries]
+    if not user_id or not queries or not isinstance(queries, list): return create_error_response("Missing user_id or query", 400)
+    if mode and mode not in faiss_handler.RETRIEVAL_MODES: return create_error_response(f"Unsupported mode '{mode}'", 400)
     try:
-        results = faiss_handler.query_index(user_id, query_text, k=k)
+        results = faiss_handler.query_index_batch(user_id, queries, k=k, nprobe=nprobe, ef_search=ef_search, rerank=rerank, mode=mode,
+                                                  vector_weight=data.get('vector_weight'), lexical_weight=data.get('lexical_weight'),
+                                                  document_names=document_names, binary=data.get('binary'), # binary=false skips the binary index
+                                                  hierarchical=data.get('hierarchical')) # Overrides HIERARCHICAL_RETRIEVAL
         formatted = [{"documentName": d.metadata.get("documentName"), "score": float(s), "content": d.page_content} for d, s in results]
         return jsonify({"relevantDocs": formatted, "status": "success"}), 200
     except Exception as e: return create_error_response(f"Failed to query index: {e}", 500)
 
 
+@app.route('/index/compression', methods=['POST'])
+def convert_index_compression_route():
+    logger.info("\n--- Received request at /index/compression ---")
+    if not request.is_json: return create_error_response("Request must be JSON", 400)
+    data = request.get_json()
+    if data is None: return create_error_response("Invalid or empty JSON body", 400)
+    user_id = data.get('user_id'); compression = data.get('compression')
+    if not user_id or not compression: return create_error_response("Missing user_id or compression", 400)
+    if compression not in faiss_handler.COMPRESSION_CODECS: return create_error_response(f"Unsupported compression '{compression}'", 400)
+    try:
+        result = faiss_handler.convert_index_compression(user_id, compression)
+        return jsonify({**result, "status": "success"}), 200
+    except Exception as e: return create_error_response(f"Failed to convert index: {e}", 500)
+
+
+@app.route('/index/recall', methods=['POST'])
+def evaluate_index_recall_route():
+    logger.info("\n--- Received request at /index/recall ---")
+    if not request.is_json: return create_error_response("Request must be JSON", 400)
+    data = request.get_json()
+    if data is None: return create_error_response("Invalid or empty JSON body", 400)
+    user_id = data.get('user_id'); queries = data.get('queries'); k = data.get('k', 10)
+    if not user_id or not queries or not isinstance(queries, list): return create_error_response("Missing user_id or queries", 400)
+    try:
+        result = faiss_handler.evaluate_index_recall(user_id, queries, k=k, nprobe=data.get('nprobe'), ef_search=data.get('ef_search'), rerank=bool(data.get('rerank', False)))
+        return jsonify({**result, "status": "success"}), 200
+    except ValueError as e: return create_error_response(str(e), 400)
+    except Exception as e: return create_error_response(f"Failed to evaluate recall: {e}", 500)
+
+
 @app.route('/analyze_document', methods=['POST'])
 def analyze_document_route():
     logger.info("\n--- Received request at /analyze_document ---")
@@ -212,6 +397,8 @@ def generate_chat_response_route():
     llm_model_name = data.get('llm_model_name', None)
     perform_rag = data.get('perform_rag', True)
     enable_multi_query = data.get('enable_multi_query', True)
+    document_names = data.get('document_names') # Optional: restrict RAG to these uploads
+    if isinstance(document_names, str): document_names = [document_names]
 
     # --- MODIFIED SECTION: Extract API keys from the nested 'api_keys' object ---
     api_keys_data = data.get('api_keys', {}) # Safely get the api_keys object
@@ -243,15 +430,9 @@ def generate_chat_response_route():
                     queries_to_search.extend(sub_queries)
             except Exception as e: logger.error(f"Error during sub-query generation: {e}", exc_info=True)
 
-        # RAG search logic (does not need keys)
-        unique_chunks = set()
-        docs_for_context = []
-        for q in queries_to_search:
-            results = faiss_handler.query_index(user_id, q, k=config.DEFAULT_RAG_K_PER_SUBQUERY_CONFIG)
-            for doc, score in results:
-                if doc.page_content not in unique_chunks:
-                    unique_chunks.add(doc.page_content)
-                    docs_for_context.append((doc, score))
+        # RAG search logic (does not need keys): all sub-queries are embedded and searched in one batch
+        docs_for_context = faiss_handler.query_index_batch(user_id, queries_to_search, k=config.DEFAULT_RAG_K_PER_SUBQUERY_CONFIG,
+                                                           document_names=document_names)
 
         if docs_for_context:
             context_parts = [f"[{i+1}] Source: {d.metadata.get('documentName')}\n{d.page_content}" for i, (d, s) in enumerate(docs_for_context)]
@@ -295,7 +476,7 @@ def _handle_tool_file_operation(tool_name: str, user_id: str, operation_function
         result_data = operation_function(user_tool_output_dir, *args_for_op)
 
         if not is_file_output_expected:
-            if isinstance(result_data, pd.DataFrame):
+            if _is_dataframe(result_data):
                 csv_filename = f"{tool_name.replace(' ', '_').lower()}_results.csv"
                 csv_full_path = os.path.join(user_tool_output_dir, csv_filename)
                 result_data.to_csv(csv_full_path, index=False, encoding='utf-8')
@@ -331,6 +512,7 @@ def _handle_tool_file_operation(tool_name: str, user_id: str, operation_function
                         "download_links_relative": relative_paths, "status": "success"}), 200
     except FileNotFoundError as e: return create_error_response(f"Tool Dep for {tool_name} not found: {e}", 500, details=str(e))
     except AttributeError as e: return create_error_response(f"Component for {tool_name} misconfigured (AttributeError): {e}", 501, details=str(e))
+    except ImportError: raise # A lazily imported tool dependency is missing: answered with 501 by tool_import_error
     except Exception as e: return create_error_response(f"Failed {tool_name} operation: {e}", 500, details=str(e))
 
 # --- Tool Routes ---
@@ -476,11 +658,13 @@ def serve_tool_generated_file(requested_path):
 
 # --- Main Startup ---
 if __name__ == '__main__':
-    try:
-        faiss_handler.ensure_faiss_dir(); faiss_handler.get_embedding_model(); faiss_handler.load_or_create_index(config.DEFAULT_INDEX_USER_ID)
+    if config.STARTUP_BACKGROUND_LOAD:
+        # Serve /live immediately; /ready flips once the model and default index are loaded
+        threading.Thread(target=run_startup, name="ai-core-startup", daemon=True).start()
+    else:
+        if not run_startup(): sys.exit(1)
         logger.info("FAISS init OK.")
-    except Exception as e: logger.critical(f"FAISS STARTUP FAIL: {e}", exc_info=True); sys.exit(1)
-    
+
     port, host = config.AI_CORE_SERVICE_PORT, '0.0.0.0'
     logger.info(f"--- Starting Flask on http://{host}:{port} ---")
     logger.info(f"Assets Dir: {os.path.abspath(config.DEFAULT_ASSETS_DIR)}")
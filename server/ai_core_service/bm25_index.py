@@ -0,0 +1,185 @@
+# server/ai_core_service/bm25_index.py
+"""
+On-disk BM25 inverted index kept next to each FAISS index (bm25.sqlite in the index
+directory). Documents are keyed by their FAISS id so lexical and vector hits can be
+fused directly. Writes happen under the owning index's state lock; reads may run
+concurrently (sqlite WAL mode, one connection per thread).
+"""
+import os
+import re
+import math
+import heapq
+import sqlite3
+import threading
+import unicodedata
+import logging
+from collections import Counter
+from ai_core_service import config
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s')
+handler.setFormatter(formatter)
+if not logger.hasHandlers():
+    logger.addHandler(handler)
+
+BM25_FILENAME = "bm25.sqlite"
+# Identifiers such as "CS-101", "H2SO4", "x.509" or "M8x1.25" stay whole; their parts are indexed too
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[._\-/][a-z0-9]+)*")
+_PART_RE = re.compile(r"[a-z0-9]+")
+_WRITE_BATCH_SIZE = 5000
+_LOOKUP_BATCH_SIZE = 500 # Ids per IN (...) lookup, below sqlite's bound-parameter limit
+
+
+def tokenize(text: str) -> list[str]:
+    """Lower-cased NFKC tokens; compound identifiers yield the whole token plus its parts."""
+    tokens = []
+    for token in _TOKEN_RE.findall(unicodedata.normalize('NFKC', text).lower()):
+        tokens.append(token)
+        parts = _PART_RE.findall(token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+class BM25Index:
+    """BM25 (Okapi) scoring over a sqlite term -> (FAISS id, term frequency) posting table."""
+
+    def __init__(self, index_dir: str):
+        os.makedirs(index_dir, exist_ok=True)
+        self.path = os.path.join(index_dir, BM25_FILENAME)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS docs (faiss_id INTEGER PRIMARY KEY, length INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, faiss_id INTEGER NOT NULL, tf INTEGER NOT NULL, "
+                     "PRIMARY KEY (term, faiss_id)) WITHOUT ROWID")
+        conn.execute("CREATE INDEX IF NOT EXISTS postings_by_doc ON postings (faiss_id)")
+        # Corpus totals for the BM25 average length, kept current by add/remove/clear so searches never scan docs
+        conn.execute("CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), doc_count INTEGER NOT NULL, total_length INTEGER NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO stats (id, doc_count, total_length) SELECT 0, COUNT(*), COALESCE(SUM(length), 0) FROM docs")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._connections = []
+        self._local = threading.local()
+
+    @staticmethod
+    def _existing_totals(conn, faiss_ids) -> tuple[int, int]:
+        """(count, summed length) of the given ids already in docs."""
+        count, length = 0, 0
+        for start in range(0, len(faiss_ids), _LOOKUP_BATCH_SIZE):
+            batch = faiss_ids[start:start + _LOOKUP_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            batch_count, batch_length = conn.execute(f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs WHERE faiss_id IN ({placeholders})",
+                                                     batch).fetchone()
+            count, length = count + batch_count, length + batch_length
+        return count, length
+
+    def add(self, faiss_ids, texts):
+        """Indexes chunks under their FAISS ids (re-adding an id replaces it)."""
+        rows_docs, rows_postings = [], []
+        for faiss_id, text in zip(faiss_ids, texts):
+            counts = Counter(tokenize(text))
+            rows_docs.append((int(faiss_id), sum(counts.values())))
+            rows_postings.extend((term, int(faiss_id), tf) for term, tf in counts.items())
+        if not rows_docs:
+            return
+        ids = list(dict.fromkeys(row[0] for row in rows_docs))
+        rows_docs = list({row[0]: row for row in rows_docs}.values()) # Last text wins for a repeated id
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            replaced_count, replaced_length = self._existing_totals(conn, ids)
+            conn.executemany("DELETE FROM postings WHERE faiss_id = ?", [(faiss_id,) for faiss_id in ids])
+            conn.executemany("INSERT OR REPLACE INTO docs (faiss_id, length) VALUES (?, ?)", rows_docs)
+            conn.execute("UPDATE stats SET doc_count = doc_count + ?, total_length = total_length + ? WHERE id = 0",
+                         (len(rows_docs) - replaced_count, sum(row[1] for row in rows_docs) - replaced_length))
+            for start in range(0, len(rows_postings), _WRITE_BATCH_SIZE):
+                conn.executemany("INSERT OR REPLACE INTO postings (term, faiss_id, tf) VALUES (?, ?, ?)",
+                                 rows_postings[start:start + _WRITE_BATCH_SIZE])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def remove(self, faiss_ids):
+        ids = list(dict.fromkeys(int(faiss_id) for faiss_id in faiss_ids))
+        if not ids:
+            return
+        rows = [(faiss_id,) for faiss_id in ids]
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            removed_count, removed_length = self._existing_totals(conn, ids)
+            conn.executemany("DELETE FROM postings WHERE faiss_id = ?", rows)
+            conn.executemany("DELETE FROM docs WHERE faiss_id = ?", rows)
+            conn.execute("UPDATE stats SET doc_count = doc_count - ?, total_length = total_length - ? WHERE id = 0",
+                         (removed_count, removed_length))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM postings")
+        conn.execute("DELETE FROM docs")
+        conn.execute("UPDATE stats SET doc_count = 0, total_length = 0 WHERE id = 0")
+        conn.execute("COMMIT")
+
+    def count(self) -> int:
+        return self._connect().execute("SELECT doc_count FROM stats WHERE id = 0").fetchone()[0]
+
+    def search(self, query: str, k: int, allowed_ids=None) -> list[tuple[int, float]]:
+        """Top-k (faiss_id, BM25 score) pairs for the query, best first, optionally restricted to `allowed_ids`."""
+        terms = Counter(tokenize(query))
+        if not terms or k <= 0:
+            return []
+        conn = self._connect()
+        doc_count, total_length = conn.execute("SELECT doc_count, total_length FROM stats WHERE id = 0").fetchone()
+        if doc_count == 0:
+            return []
+        avg_length = total_length / doc_count
+        k1, b = config.BM25_K1, config.BM25_B
+        scores = {}
+        for term, query_tf in terms.items():
+            postings = conn.execute("SELECT p.faiss_id, p.tf, d.length FROM postings p JOIN docs d ON d.faiss_id = p.faiss_id "
+                                    "WHERE p.term = ?", (term,)).fetchall()
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for faiss_id, tf, length in postings:
+                if allowed_ids is not None and faiss_id not in allowed_ids:
+                    continue
+                norm = tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_length))
+                scores[faiss_id] = scores.get(faiss_id, 0.0) + query_tf * idf * norm
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+def reciprocal_rank_fusion(ranked_lists, weights, rrf_k: int) -> dict:
+    """Fuses ranked id lists: score(id) = sum of weight / (rrf_k + rank), ranks starting at 1."""
+    fused = {}
+    for ranked_ids, weight in zip(ranked_lists, weights):
+        for rank, item_id in enumerate(ranked_ids, start=1):
+            fused[item_id] = fused.get(item_id, 0.0) + weight / (rrf_k + rank)
+    return fused
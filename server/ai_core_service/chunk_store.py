@@ -0,0 +1,295 @@
+# server/ai_core_service/chunk_store.py
+"""
+Array-backed in-memory chunk store (config.DOCSTORE_BACKEND = 'compact').
+
+Instead of one LangChain Document, metadata dict and UUID string per chunk, chunks are
+kept column-wise and keyed directly by their FAISS id:
+  - ids:          sorted int64 array; new chunks get sequential ids (allocate_ids)
+  - text:         one contiguous UTF-8 buffer, addressed by offset/length arrays
+  - documentName/userId: interned, stored as int32 codes into a shared string table
+  - chunkIndex:   int32 column; chunkHash: 32 raw bytes instead of 64 hex characters
+Any other metadata is kept per chunk in a small side dict. Documents are only built
+for the ids a caller asks for (search hits). ChunkIdMap stands in for
+index_to_docstore_id, since every FAISS id is its own docstore id.
+Mutations must run under the owning index's write lock; lookups may run concurrently.
+"""
+import threading
+import numpy as np
+from langchain_core.documents import Document as LangchainDocument
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+_INITIAL_CAPACITY = 1024
+_COMPACT_MIN_DEAD = 1024 # Rows of deleted chunks are dropped once they outnumber live ones
+_HASH_BYTES = 32
+_INT32_MAX = 2**31 - 1
+
+
+class ChunkStore(Docstore, AddableMixin):
+    """Docstore (search/mget/add/delete) keyed by FAISS id, with chunk data in flat arrays."""
+
+    def __init__(self):
+        self._strings = [] # Interned documentName / userId values
+        self._string_codes = {}
+        self._extra = {} # FAISS id -> metadata keys without a column
+        self._text = bytearray()
+        self._size = 0 # Rows in use, live or deleted
+        self._live = 0
+        self.next_id = 0
+        self._id_lock = threading.Lock()
+        self._allocate(_INITIAL_CAPACITY)
+
+    def _allocate(self, capacity: int):
+        """(Re)allocates the column arrays, keeping the first _size rows."""
+        columns = {
+            "_ids": np.int64, "_offsets": np.int64, "_lengths": np.int32, "_names": np.int32,
+            "_users": np.int32, "_chunk_index": np.int32, "_has_hash": bool, "_alive": bool,
+        }
+        for name, dtype in columns.items():
+            column = np.zeros(capacity, dtype=dtype)
+            if hasattr(self, name):
+                column[:self._size] = getattr(self, name)[:self._size]
+            setattr(self, name, column)
+        hashes = np.zeros((capacity, _HASH_BYTES), dtype=np.uint8)
+        if hasattr(self, "_hashes"):
+            hashes[:self._size] = self._hashes[:self._size]
+        self._hashes = hashes
+
+    def __getstate__(self):
+        """Pickles the live rows only, copied so concurrent readers are unaffected."""
+        rows = np.flatnonzero(self._alive[:self._size])
+        offsets, text = self._gather_text(rows)
+        live_ids = set(self._ids[rows].tolist())
+        return {
+            "strings": self._strings, "next_id": self.next_id, "text": text,
+            "ids": self._ids[rows], "offsets": offsets, "lengths": self._lengths[rows],
+            "names": self._names[rows], "users": self._users[rows], "chunk_index": self._chunk_index[rows],
+            "has_hash": self._has_hash[rows], "hashes": self._hashes[rows],
+            "extra": {faiss_id: meta for faiss_id, meta in self._extra.items() if faiss_id in live_ids},
+        }
+
+    def __setstate__(self, state):
+        self._strings = list(state["strings"])
+        self._string_codes = {value: code for code, value in enumerate(self._strings)}
+        self._extra = dict(state["extra"])
+        self._text = bytearray(state["text"])
+        self.next_id = int(state["next_id"])
+        self._id_lock = threading.Lock()
+        self._size = self._live = len(state["ids"])
+        self._ids, self._offsets, self._lengths = state["ids"], state["offsets"], state["lengths"]
+        self._names, self._users, self._chunk_index = state["names"], state["users"], state["chunk_index"]
+        self._has_hash, self._hashes = state["has_hash"], state["hashes"]
+        self._alive = np.ones(self._size, dtype=bool)
+        self._allocate(max(_INITIAL_CAPACITY, self._size))
+
+    def allocate_ids(self, count: int) -> np.ndarray:
+        """Reserves `count` sequential FAISS ids for new chunks."""
+        with self._id_lock:
+            start = self.next_id
+            self.next_id += count
+        return np.arange(start, start + count, dtype=np.int64)
+
+    def _intern(self, value) -> int:
+        code = self._string_codes.get(value)
+        if code is None:
+            code = len(self._strings)
+            self._strings.append(value)
+            self._string_codes[value] = code
+        return code
+
+    def _rows(self, ids) -> np.ndarray:
+        """Row of each id (the newest one if re-added), or -1 when absent or deleted."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not self._size or not len(ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+        rows = np.searchsorted(self._ids[:self._size], ids, side='right') - 1
+        found = (rows >= 0) & (self._ids[np.maximum(rows, 0)] == ids) & self._alive[np.maximum(rows, 0)]
+        return np.where(found, rows, -1)
+
+    def __contains__(self, faiss_id) -> bool:
+        return self._rows([int(faiss_id)])[0] >= 0
+
+    def _materialize(self, row: int) -> LangchainDocument:
+        start = int(self._offsets[row])
+        text = self._text[start:start + int(self._lengths[row])].decode('utf-8')
+        metadata = {}
+        if self._users[row] >= 0:
+            metadata['userId'] = self._strings[self._users[row]]
+        if self._names[row] >= 0:
+            metadata['documentName'] = self._strings[self._names[row]]
+        if self._chunk_index[row] >= 0:
+            metadata['chunkIndex'] = int(self._chunk_index[row])
+        if self._has_hash[row]:
+            metadata['chunkHash'] = self._hashes[row].tobytes().hex()
+        metadata.update(self._extra.get(int(self._ids[row]), {}))
+        return LangchainDocument(page_content=text, metadata=metadata)
+
+    def search(self, search):
+        """The Document stored under FAISS id `search`, or a not-found message (like InMemoryDocstore)."""
+        if search is None:
+            return f"ID {search} not found."
+        row = self._rows([int(search)])[0]
+        return self._materialize(row) if row >= 0 else f"ID {search} not found."
+
+    def mget(self, ids) -> dict:
+        """{faiss_id: Document} for the ids present."""
+        ids = [int(faiss_id) for faiss_id in dict.fromkeys(ids) if faiss_id is not None]
+        return {faiss_id: self._materialize(row) for faiss_id, row in zip(ids, self._rows(ids)) if row >= 0}
+
+    def add(self, texts: dict) -> None:
+        """Stores documents under their FAISS ids. Re-adding an id replaces it, so replaying a segment is harmless."""
+        if not texts:
+            return
+        ids = np.fromiter((int(faiss_id) for faiss_id in texts), dtype=np.int64, count=len(texts))
+        self.delete(ids[self._rows(ids) >= 0], compact=False)
+        if self._size + len(ids) > len(self._ids):
+            self._allocate(max(2 * len(self._ids), self._size + len(ids)))
+        needs_sort = self._size > 0 and ids.min() <= self._ids[self._size - 1] or np.any(np.diff(ids) < 0)
+        for row, (faiss_id, doc) in enumerate(zip(ids.tolist(), texts.values()), start=self._size):
+            encoded = doc.page_content.encode('utf-8')
+            self._ids[row] = faiss_id
+            self._offsets[row] = len(self._text)
+            self._lengths[row] = len(encoded)
+            self._text += encoded
+            self._store_metadata(row, faiss_id, doc.metadata)
+            self._alive[row] = True
+        self._size += len(ids)
+        self._live += len(ids)
+        self.next_id = max(self.next_id, int(ids.max()) + 1)
+        if needs_sort:
+            self._sort()
+
+    def _store_metadata(self, row: int, faiss_id: int, metadata: dict):
+        extra = {}
+        self._users[row] = self._names[row] = self._chunk_index[row] = -1
+        self._has_hash[row] = False
+        for key, value in metadata.items():
+            if key in ('userId', 'documentName') and isinstance(value, str):
+                (self._users if key == 'userId' else self._names)[row] = self._intern(value)
+            elif key == 'chunkIndex' and type(value) is int and 0 <= value <= _INT32_MAX:
+                self._chunk_index[row] = value
+            elif key == 'chunkHash' and isinstance(value, str) and len(value) == 2 * _HASH_BYTES:
+                try:
+                    self._hashes[row] = np.frombuffer(bytes.fromhex(value), dtype=np.uint8)
+                    self._has_hash[row] = value == value.lower() # Upper-case hex would not round-trip
+                except ValueError:
+                    pass
+                if not self._has_hash[row]:
+                    extra[key] = value
+            else:
+                extra[key] = value
+        if extra:
+            self._extra[faiss_id] = extra
+        else:
+            self._extra.pop(faiss_id, None)
+
+    def _sort(self):
+        """Restores id order after out-of-order adds (concurrent allocations or migrated ids)."""
+        order = np.argsort(self._ids[:self._size], kind='stable') # Stable: a re-added id's newest row stays last
+        for column in (self._ids, self._offsets, self._lengths, self._names, self._users,
+                       self._chunk_index, self._has_hash, self._alive, self._hashes):
+            column[:self._size] = column[:self._size][order]
+
+    def delete(self, ids, compact=True) -> None:
+        """Removes documents by FAISS id; unknown ids are ignored."""
+        rows = self._rows(list(ids))
+        rows = np.unique(rows[rows >= 0])
+        if not len(rows):
+            return
+        for faiss_id in self._ids[rows].tolist():
+            self._extra.pop(faiss_id, None)
+        self._alive[rows] = False
+        self._live -= len(rows)
+        dead = self._size - self._live
+        if compact and dead >= _COMPACT_MIN_DEAD and dead > self._live:
+            self.compact()
+
+    def _gather_text(self, rows: np.ndarray):
+        """(new offsets, bytes) of the given rows' texts laid out back to back."""
+        lengths = self._lengths[rows].astype(np.int64)
+        new_offsets = np.cumsum(lengths) - lengths
+        source = np.repeat(self._offsets[rows] - new_offsets, lengths) + np.arange(int(lengths.sum()), dtype=np.int64)
+        return new_offsets, np.frombuffer(self._text, dtype=np.uint8)[source].tobytes()
+
+    def compact(self):
+        """Drops the rows and text bytes of deleted chunks."""
+        rows = np.flatnonzero(self._alive[:self._size])
+        offsets, text = self._gather_text(rows)
+        for column in (self._ids, self._lengths, self._names, self._users,
+                       self._chunk_index, self._has_hash, self._hashes):
+            column[:len(rows)] = column[rows]
+        self._offsets[:len(rows)] = offsets
+        self._alive[:len(rows)] = True
+        self._alive[len(rows):self._size] = False
+        self._text = bytearray(text)
+        self._size = len(rows)
+
+    def clear(self):
+        self.__init__()
+
+    def __len__(self) -> int:
+        return self._live
+
+    def live_ids(self) -> np.ndarray:
+        return self._ids[:self._size][self._alive[:self._size]]
+
+    def iter_items(self):
+        """Yields (faiss_id, Document) for every stored chunk in id order."""
+        for row in np.flatnonzero(self._alive[:self._size]).tolist():
+            yield int(self._ids[row]), self._materialize(row)
+
+    def nbytes(self) -> int:
+        """Approximate heap size: columns, text buffer, string table and side metadata."""
+        columns = sum(column.nbytes for column in (self._ids, self._offsets, self._lengths, self._names, self._users,
+                                                   self._chunk_index, self._has_hash, self._alive, self._hashes))
+        strings = sum(len(value) + 50 for value in self._strings) * 2 # String plus its interning dict entry
+        return columns + len(self._text) + strings + 300 * len(self._extra)
+
+
+class ChunkIdMap:
+    """
+    index_to_docstore_id for a ChunkStore: every live FAISS id maps to itself. Entries
+    follow the store; pop() only reports the id and the chunk is removed by
+    ChunkStore.delete, and update() is a no-op since ChunkStore.add registers ids.
+    """
+
+    def __init__(self, store: ChunkStore):
+        self.store = store
+
+    def __reduce__(self):
+        return (ChunkIdMap, (self.store,))
+
+    def __contains__(self, faiss_id) -> bool:
+        return faiss_id is not None and int(faiss_id) in self.store
+
+    def get(self, faiss_id, default=None):
+        return int(faiss_id) if faiss_id in self else default
+
+    def __getitem__(self, faiss_id):
+        if faiss_id not in self:
+            raise KeyError(faiss_id)
+        return int(faiss_id)
+
+    def pop(self, faiss_id, *default):
+        if faiss_id in self:
+            return int(faiss_id)
+        if default:
+            return default[0]
+        raise KeyError(faiss_id)
+
+    def update(self, mapping):
+        pass
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __iter__(self):
+        return iter(self.store.live_ids().tolist())
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return [(faiss_id, faiss_id) for faiss_id in self]
@@ -6,10 +6,42 @@ CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 SERVER_DIR = os.path.abspath(os.path.join(CURRENT_DIR, '..'))
 
 # --- Embedding Model Configuration ---
-EMBEDDING_TYPE = 'sentence-transformer'
+# 'sentence-transformer' (PyTorch via HuggingFaceEmbeddings) or 'onnx' (ONNX Runtime on CPU, int8 by default)
+EMBEDDING_TYPE = os.getenv('EMBEDDING_TYPE', 'sentence-transformer').lower()
 EMBEDDING_MODEL_NAME_ST = os.getenv('SENTENCE_TRANSFORMER_MODEL', 'mixedbread-ai/mxbai-embed-large-v1')
 EMBEDDING_MODEL_NAME = EMBEDDING_MODEL_NAME_ST
 
+# Matryoshka-style truncation: keep only the first N dimensions of every embedding (re-normalized),
+# e.g. 256 or 512 for mxbai-embed-large-v1. 0 keeps the model's full dimension. Existing indices
+# are converted on load from the full vectors in the embedding store.
+EMBEDDING_OUTPUT_DIM = int(os.getenv('EMBEDDING_OUTPUT_DIM', 0))
+
+# --- ONNX Runtime Embedding Backend (EMBEDDING_TYPE='onnx') ---
+# The model is exported (and quantized) once into ONNX_MODEL_DIR; check parity with
+# `python -m ai_core_service.onnx_embeddings` before switching a deployment over.
+ONNX_MODEL_DIR = os.getenv('ONNX_MODEL_DIR', os.path.join(SERVER_DIR, 'onnx_models'))
+ONNX_QUANTIZE = os.getenv('ONNX_QUANTIZE', 'true').lower() == 'true' # int8 dynamic quantization
+ONNX_NUM_THREADS = int(os.getenv('ONNX_NUM_THREADS', 0)) # 0 = ONNX Runtime default (all physical cores)
+ONNX_BATCH_SIZE = int(os.getenv('ONNX_BATCH_SIZE', 32))
+ONNX_MAX_SEQ_LENGTH = int(os.getenv('ONNX_MAX_SEQ_LENGTH', 512))
+ONNX_POOLING = os.getenv('ONNX_POOLING', 'auto').lower() # 'auto' (from the model's pooling config), 'cls' or 'mean'
+ONNX_PARITY_MIN_COSINE = float(os.getenv('ONNX_PARITY_MIN_COSINE', 0.99))
+
+# Identifies the vectors a backend produces; keys the query cache and the embedding store
+# so quantized ONNX vectors are never mixed with fp32 ones.
+EMBEDDING_MODEL_ID = EMBEDDING_MODEL_NAME
+if EMBEDDING_TYPE == 'onnx':
+    EMBEDDING_MODEL_ID = f"{EMBEDDING_MODEL_NAME}@onnx-{'int8' if ONNX_QUANTIZE else 'fp32'}"
+
+# --- Per-Index Embedding Models ---
+# The shared default index (often the largest corpus) can use its own, smaller model while user
+# indices keep the one above. Each index records its model and dimension in its manifest and
+# queries are embedded once per distinct model. Changing these re-embeds the default index in
+# the background. Empty / -1 inherit EMBEDDING_MODEL_NAME, EMBEDDING_TYPE and EMBEDDING_OUTPUT_DIM.
+DEFAULT_INDEX_EMBEDDING_MODEL = os.getenv('DEFAULT_INDEX_EMBEDDING_MODEL', '') # e.g. 'sentence-transformers/all-MiniLM-L6-v2'
+DEFAULT_INDEX_EMBEDDING_TYPE = os.getenv('DEFAULT_INDEX_EMBEDDING_TYPE', '').lower()
+DEFAULT_INDEX_EMBEDDING_OUTPUT_DIM = int(os.getenv('DEFAULT_INDEX_EMBEDDING_OUTPUT_DIM', -1))
+
 # --- FAISS Configuration ---
 FAISS_INDEX_DIR = os.path.join(SERVER_DIR, 'faiss_indices')
 # CRITICAL: This directory is used for ALL tool outputs (PDFs, PPTs, MDs, CSVs)
@@ -18,6 +50,134 @@ DEFAULT_ASSETS_DIR = os.path.join(SERVER_DIR, 'python_tool_assets') # Using a ge
 # If you strongly prefer 'default_assets/engineering', change it back, but ensure it's clear this is for tool outputs.
 DEFAULT_INDEX_USER_ID = '__DEFAULT__'
 
+# --- FAISS ANN (Approximate Nearest Neighbour) Configuration ---
+# Indices start as exact IndexFlatIP and are promoted to FAISS_ANN_MODE once they
+# hold FAISS_ANN_PROMOTION_THRESHOLD vectors. Set FAISS_ANN_MODE='flat' to disable.
+FAISS_ANN_MODE = os.getenv('FAISS_ANN_MODE', 'ivf_flat').lower() # 'flat', 'ivf_flat', 'ivf_pq' or 'hnsw'
+FAISS_ANN_PROMOTION_THRESHOLD = int(os.getenv('FAISS_ANN_PROMOTION_THRESHOLD', 100000))
+FAISS_ANN_TRAIN_SAMPLE = int(os.getenv('FAISS_ANN_TRAIN_SAMPLE', 65536)) # Max vectors used to train IVF/PQ
+FAISS_IVF_NLIST = int(os.getenv('FAISS_IVF_NLIST', 0)) # 0 = derive from index size (~4*sqrt(ntotal))
+FAISS_IVF_NPROBE = int(os.getenv('FAISS_IVF_NPROBE', 16))
+FAISS_PQ_M = int(os.getenv('FAISS_PQ_M', 64)) # Sub-quantizers; must divide the embedding dimension
+FAISS_PQ_NBITS = int(os.getenv('FAISS_PQ_NBITS', 8))
+FAISS_HNSW_M = int(os.getenv('FAISS_HNSW_M', 32))
+FAISS_HNSW_EF_CONSTRUCTION = int(os.getenv('FAISS_HNSW_EF_CONSTRUCTION', 80))
+FAISS_HNSW_EF_SEARCH = int(os.getenv('FAISS_HNSW_EF_SEARCH', 64))
+
+# --- FAISS Vector Compression ---
+# Codec used to store vectors of newly created indices: 'none' (float32), 'sq8'
+# (1 byte/dim), 'sqfp16' (2 bytes/dim) or 'pq' (FAISS_PQ_M x FAISS_PQ_NBITS bits per vector).
+# Existing indices keep theirs until converted. Trained codecs (sq8, pq) are applied once
+# an index holds enough vectors to train them.
+FAISS_INDEX_COMPRESSION = os.getenv('FAISS_INDEX_COMPRESSION', 'none').lower()
+FAISS_DEFAULT_INDEX_COMPRESSION = os.getenv('FAISS_DEFAULT_INDEX_COMPRESSION', FAISS_INDEX_COMPRESSION).lower()
+FAISS_COMPRESSION_MIN_TRAIN = int(os.getenv('FAISS_COMPRESSION_MIN_TRAIN', 1000))
+# Exact re-ranking: compressed indices are over-fetched by this factor and rescored in float32
+FAISS_RERANK_ENABLED = os.getenv('FAISS_RERANK_ENABLED', 'false').lower() == 'true'
+FAISS_RERANK_FACTOR = int(os.getenv('FAISS_RERANK_FACTOR', 4))
+
+# --- Binary First-Stage Index ---
+# 'off', 'default' (only the shared default index) or 'all'. Keeps a 1-bit-per-dimension
+# copy of the vectors searched by Hamming distance; FAISS_BINARY_RESCORE_FACTOR * k
+# candidates are rescored with full vectors from the embedding store (which must be enabled).
+FAISS_BINARY_INDEX = os.getenv('FAISS_BINARY_INDEX', 'off').lower()
+FAISS_BINARY_STRUCTURE = os.getenv('FAISS_BINARY_STRUCTURE', 'flat').lower() # 'flat' or 'hnsw'
+FAISS_BINARY_HNSW_M = int(os.getenv('FAISS_BINARY_HNSW_M', 32))
+FAISS_BINARY_EF_SEARCH = int(os.getenv('FAISS_BINARY_EF_SEARCH', 128))
+FAISS_BINARY_RESCORE_FACTOR = int(os.getenv('FAISS_BINARY_RESCORE_FACTOR', 10))
+
+# --- Hierarchical (Document-Then-Chunk) Retrieval ---
+# 'off', 'default' (only the shared default index) or 'all'. Keeps one centroid vector per
+# documentName (the normalized mean of its chunk vectors). Queries first pick the
+# HIERARCHICAL_TOP_DOCUMENTS closest documents, then search only their chunks through an
+# IDSelector (so the binary index is bypassed). Applies to indices with more than
+# HIERARCHICAL_MIN_DOCUMENTS documents; explicit document filters take precedence and the
+# BM25 side of hybrid search still covers every document.
+HIERARCHICAL_RETRIEVAL = os.getenv('HIERARCHICAL_RETRIEVAL', 'off').lower()
+HIERARCHICAL_TOP_DOCUMENTS = int(os.getenv('HIERARCHICAL_TOP_DOCUMENTS', 20))
+HIERARCHICAL_MIN_DOCUMENTS = int(os.getenv('HIERARCHICAL_MIN_DOCUMENTS', 100))
+
+# --- Segmented Index Storage ---
+# Uploads are appended as delta segments; a background compaction rewrites the base
+# once there are too many segments or they hold too large a share of the vectors.
+FAISS_COMPACTION_MAX_SEGMENTS = int(os.getenv('FAISS_COMPACTION_MAX_SEGMENTS', 16))
+FAISS_COMPACTION_DELTA_RATIO = float(os.getenv('FAISS_COMPACTION_DELTA_RATIO', 0.25))
+
+# --- Memory-Mapped Index Loading ---
+# 'off': read indices fully into memory; 'default': memory-map only the shared default
+# index; 'all': memory-map every flat/IVF index that has no pending delta segments.
+FAISS_MMAP_MODE = os.getenv('FAISS_MMAP_MODE', 'default').lower()
+
+# --- Loaded Index Cache ---
+# Idle indices are evicted least-recently-used first once either limit is exceeded
+# (0 disables a limit). The default index is always pinned in memory.
+FAISS_INDEX_MEMORY_BUDGET_MB = int(os.getenv('FAISS_INDEX_MEMORY_BUDGET_MB', 4096))
+FAISS_MAX_LOADED_INDICES = int(os.getenv('FAISS_MAX_LOADED_INDICES', 64))
+
+# --- Query Embedding Cache ---
+QUERY_EMBEDDING_CACHE_MB = int(os.getenv('QUERY_EMBEDDING_CACHE_MB', 32)) # 0 disables the in-process LRU cache
+
+# --- Cross-Request Embedding Batching ---
+# Concurrent embedding calls (queries, small uploads) are merged into one model batch.
+# A batch is sent once it holds EMBEDDING_BATCH_MAX_SIZE texts or EMBEDDING_BATCH_WAIT_MS
+# has passed since its first request; calls with at least MAX_SIZE texts bypass it.
+EMBEDDING_BATCH_ENABLED = os.getenv('EMBEDDING_BATCH_ENABLED', 'true').lower() == 'true'
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv('EMBEDDING_BATCH_MAX_SIZE', 32))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv('EMBEDDING_BATCH_WAIT_MS', 2))
+
+# --- Persistent Embedding Store ---
+# Chunk embeddings keyed by (model name, sha256(chunk text)), shared by all indices and processes
+EMBEDDING_STORE_ENABLED = os.getenv('EMBEDDING_STORE_ENABLED', 'true').lower() == 'true'
+EMBEDDING_STORE_DIR = os.getenv('EMBEDDING_STORE_DIR', os.path.join(SERVER_DIR, 'embedding_store'))
+
+# --- Hybrid (Lexical + Vector) Retrieval ---
+# Every index keeps a BM25 inverted index (bm25.sqlite) next to its FAISS files.
+# 'hybrid' fuses the BM25 and dense rankings with weighted reciprocal-rank fusion.
+BM25_ENABLED = os.getenv('BM25_ENABLED', 'true').lower() == 'true'
+BM25_K1 = float(os.getenv('BM25_K1', 1.2))
+BM25_B = float(os.getenv('BM25_B', 0.75))
+RETRIEVAL_MODE = os.getenv('RETRIEVAL_MODE', 'vector').lower() # 'vector' or 'hybrid'
+HYBRID_RRF_K = int(os.getenv('HYBRID_RRF_K', 60))
+HYBRID_VECTOR_WEIGHT = float(os.getenv('HYBRID_VECTOR_WEIGHT', 1.0))
+HYBRID_LEXICAL_WEIGHT = float(os.getenv('HYBRID_LEXICAL_WEIGHT', 1.0))
+HYBRID_CANDIDATE_FACTOR = int(os.getenv('HYBRID_CANDIDATE_FACTOR', 4)) # Each ranking contributes k * factor candidates
+
+# --- Docstore ---
+# 'sqlite': chunk texts and metadata live in docstore.sqlite next to each index and are read
+# per hit; 'compact': in memory as flat arrays keyed by sequential FAISS ids (chunk_store.py);
+# 'memory': the pickled InMemoryDocstore. Existing indices are converted on load.
+DOCSTORE_BACKEND = os.getenv('DOCSTORE_BACKEND', 'sqlite').lower()
+
+# --- Re-embedding on Model Change ---
+# Index manifests record the embedding model. An index from another model keeps serving while
+# its chunk texts are re-embedded in the background into a shadow index that is swapped in.
+REEMBED_BATCH_SIZE = int(os.getenv('REEMBED_BATCH_SIZE', 256))
+REEMBED_BATCH_PAUSE_MS = float(os.getenv('REEMBED_BATCH_PAUSE_MS', 50)) # Between batches, so live queries keep the model
+# Load the previous model to embed queries (and uploads) for indices still being re-embedded;
+# without it those indices answer from BM25 only and reject uploads until the swap.
+REEMBED_SERVE_PREVIOUS_MODEL = os.getenv('REEMBED_SERVE_PREVIOUS_MODEL', 'true').lower() == 'true'
+
+# --- Ingest Deduplication ---
+# Store each normalized chunk text (NFKC, collapsed whitespace) once per index: a chunk already
+# stored under another document is referenced by the new documentName instead of stored again,
+# and is deleted once no document references it
+DEDUPLICATE_CHUNKS = os.getenv('DEDUPLICATE_CHUNKS', 'true').lower() == 'true'
+# Near-duplicates are referenced the same way: chunks whose estimated Jaccard similarity (MinHash
+# over word shingles) with a chunk of any document reaches NEAR_DUPLICATE_THRESHOLD (repeated
+# headers, footers, copyright pages, boilerplate shared across documents, overlapping text)
+# are not stored again. Nothing is lost when the first document is removed, so this is on by
+# default. Signatures are kept per index in minhash.sqlite.
+NEAR_DUPLICATE_ENABLED = os.getenv('NEAR_DUPLICATE_ENABLED', 'true').lower() == 'true'
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', 0.8))
+NEAR_DUPLICATE_NUM_PERM = int(os.getenv('NEAR_DUPLICATE_NUM_PERM', 128))
+NEAR_DUPLICATE_SHINGLE_SIZE = int(os.getenv('NEAR_DUPLICATE_SHINGLE_SIZE', 3)) # Words per shingle
+
+# --- Service Startup ---
+# Load the embedding model and default index in a background thread so the HTTP server
+# (and its /live probe) comes up immediately; /ready reports 503 until loading finishes.
+STARTUP_BACKGROUND_LOAD = os.getenv('STARTUP_BACKGROUND_LOAD', 'true').lower() == 'true'
+EMBEDDING_WARMUP = os.getenv('EMBEDDING_WARMUP', 'true').lower() == 'true' # One embedding pass before reporting ready
+
 # --- Text Splitting Configuration ---
 CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 512))
 CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', 100))
@@ -62,6 +222,11 @@ if os.getenv('DEBUG_CONFIG', 'true').lower() == 'true': # Default to true for ea
     print(f"SERVER_DIR: {SERVER_DIR}")
     print(f"DEFAULT_ASSETS_DIR (for tool outputs): {DEFAULT_ASSETS_DIR}")
     print(f"FAISS_INDEX_DIR: {FAISS_INDEX_DIR}")
+    print(f"Embedding Backend: {EMBEDDING_TYPE} (model: {EMBEDDING_MODEL_ID}, output dim: {EMBEDDING_OUTPUT_DIM or 'full'})")
+    if DEFAULT_INDEX_EMBEDDING_MODEL:
+        print(f"Default Index Embedding Model: {DEFAULT_INDEX_EMBEDDING_MODEL} ({DEFAULT_INDEX_EMBEDDING_TYPE or EMBEDDING_TYPE})")
+    print(f"FAISS ANN Mode: {FAISS_ANN_MODE} (promotion at {FAISS_ANN_PROMOTION_THRESHOLD} vectors)")
+    print(f"FAISS Compression: {FAISS_INDEX_COMPRESSION} (default index: {FAISS_DEFAULT_INDEX_COMPRESSION}, re-rank: {FAISS_RERANK_ENABLED})")
     print(f"AI_CORE_SERVICE_PORT: {AI_CORE_SERVICE_PORT}")
     print(f"Tesseract CMD Path: {TESSERACT_CMD_PATH or 'Not Set (using system PATH)'}")
     print(f"Poppler Path: {POPPLER_PATH or 'Not Set (using system PATH)'}")
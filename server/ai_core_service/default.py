@@ -48,8 +48,6 @@ class DefaultVectorDBBuilder:
         self.default_user_id = config.DEFAULT_INDEX_USER_ID
 
         self.default_index_user_path = faiss_handler.get_user_index_path(self.default_user_id)
-        self.index_file_path = os.path.join(self.default_index_user_path, "index.faiss")
-        self.pkl_file_path = os.path.join(self.default_index_user_path, "index.pkl")
 
         try:
             faiss_handler.ensure_faiss_dir()
@@ -67,19 +65,15 @@ class DefaultVectorDBBuilder:
         logger.info("--- Starting Default Index Creation ---")
 
         # --- Force Rebuild Logic ---
-        if force_rebuild and (os.path.exists(self.index_file_path) or os.path.exists(self.pkl_file_path)):
+        if force_rebuild and faiss_handler.index_exists(self.default_user_id):
             logger.warning(f"force_rebuild=True. Deleting existing default index files in {self.default_index_user_path}.")
-            try:
-                if os.path.exists(self.index_file_path): os.remove(self.index_file_path)
-                if os.path.exists(self.pkl_file_path): os.remove(self.pkl_file_path)
-                # Clear from cache if loaded
-                if self.default_user_id in faiss_handler.loaded_indices:
-                    del faiss_handler.loaded_indices[self.default_user_id]
-                logger.info("Removed existing default index files and cleared cache.")
-            except OSError as e:
-                logger.error(f"Error removing existing index files: {e}")
+            # Removes the base snapshot and all delta segments, and clears the cache
+            faiss_handler.delete_index(self.default_user_id)
+            if faiss_handler.index_exists(self.default_user_id):
+                logger.error("Error removing existing index files.")
                 return False # Stop if we can't remove old files
-        elif not force_rebuild and (os.path.exists(self.index_file_path) or os.path.exists(self.pkl_file_path)):
+            logger.info("Removed existing default index files and cleared cache.")
+        elif not force_rebuild and faiss_handler.index_exists(self.default_user_id):
              logger.info("Default index already exists and force_rebuild=False. Skipping creation.")
              # Try loading it to confirm validity
              try:
@@ -152,8 +146,13 @@ class DefaultVectorDBBuilder:
             # Use the updated handler function which now manages IDs correctly
             faiss_handler.add_documents_to_index(self.default_user_id, all_documents)
 
+            # Fold the delta segment into a compacted base before the builder exits
+            faiss_handler.save_index(self.default_user_id)
+            # Chunks seen in an earlier build (or uploaded by a user) were served by the embedding store
+            logger.info(f"Embedding store: {faiss_handler.get_embedding_store_stats()}")
+
             # Verify save occurred
-            if not os.path.exists(self.index_file_path) or not os.path.exists(self.pkl_file_path):
+            if not faiss_handler.index_exists(self.default_user_id):
                  logger.error("Index files were not found after adding documents. Check permissions or disk space.")
                  return False
 
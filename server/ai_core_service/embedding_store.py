@@ -0,0 +1,207 @@
+# server/ai_core_service/embedding_store.py
+"""
+Persistent embedding store shared by every index (user and default).
+
+Vectors are keyed by (model name, sha256 of the exact chunk text). Each model gets a
+directory under config.EMBEDDING_STORE_DIR holding:
+  - vectors.f32:   append-only float32 rows, read through numpy.memmap
+  - index.sqlite:  text hash -> row number, plus the vector dimension
+Writers allocate rows inside a sqlite write transaction, so several processes can
+share one store; a row only becomes visible once its vector bytes are written.
+"""
+import os
+import sqlite3
+import hashlib
+import threading
+import logging
+import numpy as np
+from ai_core_service import config
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s')
+handler.setFormatter(formatter)
+if not logger.hasHandlers():
+    logger.addHandler(handler)
+
+VECTORS_FILENAME = "vectors.f32"
+INDEX_FILENAME = "index.sqlite"
+_SQLITE_MAX_VARIABLES = 900 # Stay below SQLITE_MAX_VARIABLE_NUMBER on older builds
+
+
+def text_hash(text: str) -> str:
+    """Store key for a chunk: SHA-256 of its exact UTF-8 text."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """On-disk (text hash -> vector) cache for one embedding model."""
+
+    def __init__(self, model_name: str, base_dir: str):
+        self.model_name = model_name
+        safe_name = "".join(c if c.isalnum() or c in '-_.' else '_' for c in model_name)
+        self.path = os.path.join(base_dir, safe_name)
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors_path = os.path.join(self.path, VECTORS_FILENAME)
+        self._lock = threading.Lock() # Guards the memmap and the hit/miss counters
+        self._local = threading.local() # sqlite connections are per thread
+        self._memmap = None
+        self._memmap_rows = 0
+        self.dimension = None
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._load_dimension()
+
+    def _load_dimension(self):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = 'dimension'").fetchone()
+        self.dimension = int(row[0]) if row else None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.path, INDEX_FILENAME), timeout=30, isolation_level=None) # Explicit transactions only
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _vectors(self, needed_rows: int):
+        """memmap of the vector file covering at least `needed_rows` rows (remapped as the file grows)."""
+        with self._lock:
+            if self._memmap is None or self._memmap_rows < needed_rows:
+                row_bytes = self.dimension * 4
+                rows = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+                self._memmap = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, self.dimension)) if rows else None
+                self._memmap_rows = rows
+            return self._memmap
+
+    def get_many(self, hashes: list[str]) -> dict:
+        """Returns {hash: vector} for the hashes present in the store."""
+        if self.dimension is None:
+            self._load_dimension() # Another process may have written the first vectors
+        if not hashes or self.dimension is None:
+            self._count_lookups(0, len(hashes))
+            return {}
+        conn = self._connect()
+        rows = {}
+        unique = list(dict.fromkeys(hashes))
+        for start in range(0, len(unique), _SQLITE_MAX_VARIABLES):
+            batch = unique[start:start + _SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(batch))
+            rows.update(conn.execute(f"SELECT hash, row FROM embeddings WHERE hash IN ({placeholders})", batch).fetchall())
+        found = {}
+        if rows:
+            vectors = self._vectors(max(rows.values()) + 1)
+            if vectors is not None:
+                found = {h: np.array(vectors[row]) for h, row in rows.items() if row < len(vectors)}
+        hits = sum(1 for h in hashes if h in found)
+        self._count_lookups(hits, len(hashes) - hits)
+        return found
+
+    def _count_lookups(self, hits: int, misses: int):
+        with self._lock: # get_many runs concurrently from query and ingest threads
+            self.hits += hits
+            self.misses += misses
+
+    def put_many(self, hashes: list[str], vectors: np.ndarray):
+        """Appends vectors for hashes not yet stored. Rows are allocated under a sqlite write lock."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if not hashes or vectors.ndim != 2:
+            return
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE") # Serializes writers across threads and processes
+            if self.dimension is None:
+                self._load_dimension()
+                self.dimension = self.dimension or vectors.shape[1]
+                conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('dimension', ?)", (str(self.dimension),))
+            if vectors.shape[1] != self.dimension:
+                conn.rollback()
+                logger.warning(f"Not caching {len(hashes)} embeddings for '{self.model_name}': dimension {vectors.shape[1]} != stored {self.dimension}.")
+                return
+            new_items = {}
+            for h, vector in zip(hashes, vectors):
+                new_items.setdefault(h, vector)
+            existing = set()
+            keys = list(new_items)
+            for start in range(0, len(keys), _SQLITE_MAX_VARIABLES):
+                batch = keys[start:start + _SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                existing.update(r[0] for r in conn.execute(f"SELECT hash FROM embeddings WHERE hash IN ({placeholders})", batch))
+            new_items = {h: v for h, v in new_items.items() if h not in existing}
+            if not new_items:
+                conn.rollback()
+                return
+            row_bytes = self.dimension * 4
+            # New rows follow the last committed one; bytes left by an interrupted write are simply overwritten
+            first_row = conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM embeddings").fetchone()[0]
+            with open(self.vectors_path, 'r+b' if os.path.exists(self.vectors_path) else 'wb') as f:
+                f.seek(first_row * row_bytes)
+                f.write(np.vstack(list(new_items.values())).astype(np.float32).tobytes())
+                f.flush()
+                os.fsync(f.fileno()) # Vector bytes are durable before the rows pointing at them commit
+            conn.executemany("INSERT INTO embeddings (hash, row) VALUES (?, ?)",
+                             [(h, first_row + i) for i, h in enumerate(new_items)])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {"model": self.model_name, "vectors": self.count(), "dimension": self.dimension,
+                "file_bytes": os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0,
+                "hits": hits, "misses": misses, "hit_rate": round(hits / total, 4) if total else 0.0}
+
+
+_stores: dict[str, EmbeddingStore] = {}
+_stores_lock = threading.Lock()
+
+def get_embedding_store(model_name: str):
+    """The store for `model_name`, or None when config.EMBEDDING_STORE_ENABLED is off."""
+    if not config.EMBEDDING_STORE_ENABLED:
+        return None
+    with _stores_lock:
+        store = _stores.get(model_name)
+        if store is None:
+            store = _stores[model_name] = EmbeddingStore(model_name, config.EMBEDDING_STORE_DIR)
+            logger.info(f"Opened embedding store for '{model_name}' at {store.path}")
+        return store
+
+
+def embed_texts(embedder, model_name: str, texts: list[str]) -> np.ndarray:
+    """
+    Embeds `texts` as a float32 matrix, reading known chunks from the store and
+    computing only the misses with one `embed_documents` call (which are then stored).
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    store = get_embedding_store(model_name)
+    if store is None:
+        return np.array(embedder.embed_documents(texts), dtype=np.float32)
+    hashes = [text_hash(text) for text in texts]
+    try:
+        found = store.get_many(hashes)
+    except Exception as e:
+        logger.error(f"Embedding store lookup failed for '{model_name}', embedding everything: {e}")
+        found = {}
+    missing = [i for i, h in enumerate(hashes) if h not in found]
+    computed = {}
+    if missing:
+        missing_vectors = np.array(embedder.embed_documents([texts[i] for i in missing]), dtype=np.float32)
+        computed = {hashes[i]: vector for i, vector in zip(missing, missing_vectors)}
+        try:
+            store.put_many(list(computed), np.array(list(computed.values()), dtype=np.float32))
+        except Exception as e:
+            logger.error(f"Failed to persist {len(computed)} embeddings for '{model_name}': {e}")
+    if texts and len(missing) < len(texts):
+        logger.info(f"Embedding store served {len(texts) - len(missing)}/{len(texts)} chunks for '{model_name}'.")
+    return np.vstack([found[h] if h in found else computed[h] for h in hashes]).astype(np.float32)
@@ -8,12 +8,28 @@ from langchain_core.embeddings import Embeddings as LangchainEmbeddings
 from langchain_core.documents import Document as LangchainDocument
 from langchain_community.docstore import InMemoryDocstore
 from ai_core_service import config
+from ai_core_service import embedding_store
+from ai_core_service import bm25_index
+from ai_core_service import near_duplicates
+from ai_core_service import onnx_embeddings
+from ai_core_service.sqlite_docstore import SQLiteDocstore
+from ai_core_service.chunk_store import ChunkStore, ChunkIdMap
 import numpy as np
 import time
 import logging
 import pickle
 import uuid
 import shutil # Import shutil for removing directories
+import threading
+import queue
+import json
+import sys
+import unicodedata
+import hashlib
+import functools
+from collections import OrderedDict, Counter
+from concurrent.futures import Future
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -23,18 +39,360 @@ handler.setFormatter(formatter)
 if not logger.hasHandlers():
     logger.addHandler(handler)
 
+class IndexRegistry(OrderedDict):
+    """
+    The loaded_indices cache: user_id -> langchain FAISS object, kept in least- to
+    most-recently-used order. Behaves like a dict for existing callers; when the
+    configured index count or memory budget is exceeded, idle unpinned indices are
+    evicted LRU-first by enforce_budget(). Indices with an operation in flight (see
+    using()) are never evicted: the operation would keep mutating a detached object
+    while the next request loads a copy from disk without its changes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.RLock()
+        self.pinned = {config.DEFAULT_INDEX_USER_ID} # Shared by every user; never evicted
+        self.loads = 0
+        self.reloads = 0 # Loads of an index that was previously evicted
+        self.evictions = 0
+        self._evicted = set()
+        self.last_access = {}
+        self.in_use = Counter() # user_id -> operations holding the index
+
+    @contextmanager
+    def using(self, user_id):
+        """Marks an index as in use for the duration of an operation, so it is not evicted under it."""
+        with self.lock:
+            self.in_use[user_id] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_use[user_id] -= 1
+                if self.in_use[user_id] <= 0:
+                    del self.in_use[user_id]
+
+    def is_evictable(self, user_id) -> bool:
+        with self.lock:
+            return user_id in self and user_id not in self.pinned and user_id not in self.in_use
+
+    def __setitem__(self, user_id, index):
+        with self.lock:
+            super().__setitem__(user_id, index)
+            self.move_to_end(user_id)
+            self.last_access[user_id] = time.time()
+
+    def touch(self, user_id):
+        """Marks an index as most recently used."""
+        with self.lock:
+            if user_id in self:
+                self.move_to_end(user_id)
+                self.last_access[user_id] = time.time()
+
+    def record_load(self, user_id):
+        with self.lock:
+            self.loads += 1
+            if user_id in self._evicted:
+                self._evicted.discard(user_id)
+                self.reloads += 1
+
+    def current_bytes(self) -> int:
+        with self.lock:
+            return sum(_get_index_state(user_id).memory_bytes() for user_id in self)
+
+    def _over_budget(self) -> bool:
+        if config.FAISS_MAX_LOADED_INDICES > 0 and len(self) > config.FAISS_MAX_LOADED_INDICES:
+            return True
+        budget_bytes = config.FAISS_INDEX_MEMORY_BUDGET_MB * 1024 * 1024
+        return budget_bytes > 0 and self.current_bytes() > budget_bytes
+
+    def enforce_budget(self, protect=None):
+        """Evicts least-recently-used unpinned indices (never `protect`) until within budget."""
+        while True:
+            with self.lock:
+                if not self._over_budget():
+                    return
+                victim = next((user_id for user_id in self if self.is_evictable(user_id) and user_id != protect), None)
+                if victim is None:
+                    logger.warning(f"Index cache is over budget ({len(self)} indices, {self.current_bytes()} bytes) but only pinned or in-use indices remain.")
+                    return
+            _evict_index(victim)
+
+    def discard(self, user_id):
+        """Removes an index that is being dropped (deleted or invalid) rather than evicted; returns it, or None."""
+        with self.lock:
+            self.last_access.pop(user_id, None)
+            return self.pop(user_id, None)
+
+    def mark_evicted(self, user_id):
+        with self.lock:
+            if self.pop(user_id, None) is not None:
+                self.evictions += 1
+                self._evicted.add(user_id)
+            self.last_access.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "loaded": len(self),
+                "pinned": sorted(self.pinned),
+                "current_bytes": self.current_bytes(),
+                "budget_bytes": config.FAISS_INDEX_MEMORY_BUDGET_MB * 1024 * 1024,
+                "max_indices": config.FAISS_MAX_LOADED_INDICES,
+                "loads": self.loads,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+            }
+
 embedding_model: LangchainEmbeddings | None = None
-loaded_indices = {}
+loaded_indices = IndexRegistry()
 _embedding_dimension = None # Cache the dimension
+_embedding_model_lock = threading.Lock() # Startup warm-up and early requests may race to load the model
+
+# --- Query Embedding Cache ---
+_CACHE_ENTRY_OVERHEAD_BYTES = 128 # Rough per-entry cost of the key tuple, OrderedDict node and array header
+
+def _normalize_query_text(text: str) -> str:
+    """Canonical form used as the cache key: NFKC-normalized with collapsed whitespace."""
+    return " ".join(unicodedata.normalize('NFKC', text).split())
+
+class QueryEmbeddingCache:
+    """
+    Thread-safe LRU cache of query embeddings keyed by (model name, normalized query),
+    bounded by the total bytes of the stored float32 vectors. Several models (one per
+    index model, see _target_model) share it; entries of models no longer used age out.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple[str, str], np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_bytes(key, vector) -> int:
+        return vector.nbytes + len(key[1]) + _CACHE_ENTRY_OVERHEAD_BYTES
+
+    def get(self, model_name: str, text: str) -> np.ndarray | None:
+        key = (model_name, _normalize_query_text(text))
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, model_name: str, text: str, vector) -> None:
+        if self.max_bytes <= 0:
+            return
+        key = (model_name, _normalize_query_text(text))
+        vector = np.array(vector, dtype=np.float32)
+        vector.setflags(write=False) # Shared between requests; must never be mutated in place
+        entry_bytes = self._entry_bytes(key, vector)
+        if entry_bytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= self._entry_bytes(key, previous)
+            self._entries[key] = vector
+            self.current_bytes += entry_bytes
+            while self.current_bytes > self.max_bytes:
+                old_key, old_vector = self._entries.popitem(last=False)
+                self.current_bytes -= self._entry_bytes(old_key, old_vector)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "models": sorted({key[0] for key in self._entries}),
+                "entries": len(self._entries),
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+query_embedding_cache = QueryEmbeddingCache(config.QUERY_EMBEDDING_CACHE_MB * 1024 * 1024)
+
+# --- Cross-Request Embedding Batching ---
+class EmbeddingDispatcher:
+    """
+    Coalesces concurrent `embed_documents` calls from request threads into shared model
+    batches. A single worker takes the first waiting request, gathers more for up to
+    `max_wait_ms` (or until `max_batch` texts), runs one forward pass and resolves each
+    caller's future with its slice. Calls already holding `max_batch` texts (ingest)
+    run directly on the caller's thread.
+    """
+
+    def __init__(self, embedder: LangchainEmbeddings, max_batch: int, max_wait_ms: float):
+        self.embedder = embedder
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue: queue.Queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.batched_texts = 0
+        self.direct_calls = 0
+        self._last_batch_requests = 0
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="embedding-dispatcher", daemon=True)
+        self._worker.start()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        texts = list(texts)
+        if not texts:
+            return []
+        if len(texts) >= self.max_batch:
+            with self._stats_lock:
+                self.direct_calls += 1
+            return self.embedder.embed_documents(texts)
+        future = Future()
+        with self._close_lock:
+            if self._closed:
+                return self.embedder.embed_documents(texts)
+            self._queue.put((texts, future))
+        return future.result()
+
+    def close(self):
+        """Stops the worker once the requests queued so far are served; later calls run directly."""
+        with self._close_lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    def _collect(self) -> list:
+        first = self._queue.get()
+        if first is None: # close() sentinel
+            return []
+        batch = [first]
+        size = len(first[0])
+        # Only hold a request back when there is concurrent load, so a lone request keeps its latency
+        under_load = self._last_batch_requests > 1 or not self._queue.empty()
+        deadline = time.perf_counter() + (self.max_wait if under_load else 0.0)
+        while size < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                # Past the deadline, still take whatever is already queued
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None) # Stop after this batch
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                return
+            self._last_batch_requests = len(batch)
+            texts = [text for request_texts, _ in batch for text in request_texts]
+            try:
+                vectors = self.embedder.embed_documents(texts)
+                if len(vectors) != len(texts):
+                    raise ValueError(f"Embedder returned {len(vectors)} vectors for {len(texts)} texts.")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self._stats_lock:
+                self.requests += len(batch)
+                self.batches += 1
+                self.batched_texts += len(texts)
+            offset = 0
+            for request_texts, future in batch:
+                future.set_result(vectors[offset:offset + len(request_texts)])
+                offset += len(request_texts)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "texts": self.batched_texts,
+                "avg_batch_texts": round(self.batched_texts / self.batches, 2) if self.batches else None,
+                "direct_calls": self.direct_calls,
+                "queued": self._queue.qsize(),
+                "max_batch": self.max_batch,
+                "max_wait_ms": self.max_wait * 1000.0,
+            }
+
+_embedding_dispatcher: EmbeddingDispatcher | None = None
+_embedding_dispatcher_lock = threading.Lock()
+
+_model_dispatchers: dict[str, EmbeddingDispatcher] = {} # Model id -> dispatcher for registry models (see get_embedder)
+
+def get_embedding_dispatcher(model: dict = None):
+    """
+    Embedder used for request-path embedding calls: the shared EmbeddingDispatcher for
+    `model` (a _model_spec; default: the configured model), or the model itself when
+    config.EMBEDDING_BATCH_ENABLED is off.
+    """
+    global _embedding_dispatcher
+    embedder = get_embedder(model)
+    if not config.EMBEDDING_BATCH_ENABLED:
+        return embedder
+    with _embedding_dispatcher_lock:
+        if not _is_default_model(model):
+            dispatcher = _model_dispatchers.get(model["embedding_model"])
+            if dispatcher is None or dispatcher.embedder is not embedder:
+                dispatcher = _model_dispatchers[model["embedding_model"]] = EmbeddingDispatcher(embedder, config.EMBEDDING_BATCH_MAX_SIZE, config.EMBEDDING_BATCH_WAIT_MS)
+            return dispatcher
+        if _embedding_dispatcher is None or _embedding_dispatcher.embedder is not embedder:
+            # The previous worker (if any) idles on its empty queue
+            _embedding_dispatcher = EmbeddingDispatcher(embedder, config.EMBEDDING_BATCH_MAX_SIZE, config.EMBEDDING_BATCH_WAIT_MS)
+        return _embedding_dispatcher
+
+def get_embedding_dispatcher_stats():
+    """Batching stats of the embedding dispatcher, or None before first use / when disabled."""
+    dispatcher = _embedding_dispatcher
+    return dispatcher.stats() if dispatcher and config.EMBEDDING_BATCH_ENABLED else None
+
+def _configured_embedding_dimension(embedder: LangchainEmbeddings) -> int | None:
+    """Dimension declared by the underlying model's config, without running an embedding."""
+    client = getattr(embedder, 'client', None) or getattr(embedder, '_client', None) or embedder
+    get_dimension = getattr(client, 'get_sentence_embedding_dimension', None)
+    if get_dimension is None:
+        return None
+    try:
+        dimension = get_dimension()
+    except Exception as e:
+        logger.warning(f"Could not read embedding dimension from model config: {e}")
+        return None
+    return int(dimension) if dimension else None
 
 def get_embedding_dimension(embedder: LangchainEmbeddings) -> int:
-    """Gets and caches the embedding dimension."""
+    """Gets and caches the embedding dimension (from model config, else from one test embedding)."""
     global _embedding_dimension
     if _embedding_dimension is None:
         try:
-            logger.info("Determining embedding dimension...")
-            dummy_embedding = embedder.embed_query("dimension_check")
-            dimension = len(dummy_embedding)
+            dimension = _configured_embedding_dimension(embedder)
+            if dimension is None:
+                logger.info("Determining embedding dimension from a test embedding...")
+                dimension = len(embedder.embed_query("dimension_check"))
             if not isinstance(dimension, int) or dimension <= 0:
                 raise ValueError(f"Invalid embedding dimension obtained: {dimension}")
             _embedding_dimension = dimension
@@ -44,46 +402,186 @@ def get_embedding_dimension(embedder: LangchainEmbeddings) -> int:
             raise RuntimeError(f"Failed to determine embedding dimension: {e}")
     return _embedding_dimension
 
+def get_model_dimension(model: dict = None) -> int:
+    """Full output dimension of `model` (a _model_spec; default: the configured model), loading it if needed."""
+    if _is_default_model(model):
+        return get_embedding_dimension(get_embedding_model())
+    get_embedder(model)
+    return _embedder_dimensions[model["embedding_model"]]
+
+def get_index_dimension(embedder: LangchainEmbeddings = None, model: dict = None) -> int:
+    """
+    Dimension of stored and searched vectors: config.EMBEDDING_OUTPUT_DIM (or the output
+    dimension of `model`) when it truncates the model output (Matryoshka-style),
+    otherwise the model's full dimension.
+    """
+    if model is None:
+        native_dim, output_dim = get_embedding_dimension(embedder or get_embedding_model()), config.EMBEDDING_OUTPUT_DIM
+    else:
+        native_dim, output_dim = get_model_dimension(model), model.get("embedding_output_dim") or 0
+    return output_dim if 0 < output_dim < native_dim else native_dim
+
+def _embedding_cache_key(model: dict = None, dimension: int = None) -> str:
+    """Query cache namespace: the model id, plus the output dimension when truncating."""
+    index_dim = dimension or get_index_dimension(model=model)
+    return _model_id(model) if index_dim == get_model_dimension(model) else f"{_model_id(model)}@{index_dim}d"
+
+def _project_embeddings(vectors: np.ndarray, dimension: int = None) -> np.ndarray:
+    """Truncates full model embeddings to `dimension` (default: get_index_dimension) and re-normalizes them."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    dimension = dimension or get_index_dimension()
+    if vectors.ndim != 2 or vectors.shape[1] <= dimension:
+        return vectors
+    truncated = np.ascontiguousarray(vectors[:, :dimension])
+    truncated /= np.clip(np.linalg.norm(truncated, axis=1, keepdims=True), 1e-12, None)
+    return truncated
+
+def _create_embedding_model(model_name: str, embedding_type: str, quantize: bool = None) -> LangchainEmbeddings:
+    """Instantiates an embedding backend ('sentence-transformer' or 'onnx') for `model_name`."""
+    if embedding_type not in ('sentence-transformer', 'onnx'):
+        raise ValueError(f"Unsupported embedding type in config: {embedding_type}. Expected 'sentence-transformer' or 'onnx'.")
+    if embedding_type == 'onnx':
+        logger.info(f"Initializing ONNX Runtime embeddings (Model: {model_name})")
+        return onnx_embeddings.OnnxEmbeddings(model_name, quantize=quantize)
+    logger.info(f"Initializing HuggingFace Embeddings for Sentence Transformer (Model: {model_name})")
+    # Try CUDA first, fallback to CPU
+    try:
+        if faiss.get_num_gpus() > 0:
+            device = 'cuda'
+            logger.info("CUDA detected. Using GPU for embeddings.")
+        else:
+            raise RuntimeError("No GPU found") # Force fallback
+    except Exception:
+        device = 'cpu'
+        logger.warning("CUDA not available or GPU check failed. Using CPU for embeddings. This might be slow. Consider EMBEDDING_TYPE='onnx'.")
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={'device': device},
+        encode_kwargs={'normalize_embeddings': True} # Often recommended for cosine similarity / MIPS with FAISS
+    )
+
 def get_embedding_model():
     global embedding_model
-    if embedding_model is None:
-        if config.EMBEDDING_TYPE == 'sentence-transformer':
-            logger.info(f"Initializing HuggingFace Embeddings for Sentence Transformer (Model: {config.EMBEDDING_MODEL_NAME})")
+    if embedding_model is not None:
+        return embedding_model
+    with _embedding_model_lock:
+        if embedding_model is None:
+            if config.EMBEDDING_TYPE not in ('sentence-transformer', 'onnx'):
+                raise ValueError(f"Unsupported embedding type in config: {config.EMBEDDING_TYPE}. Expected 'sentence-transformer' or 'onnx'.")
             try:
-                # Try CUDA first, fallback to CPU
-                try:
-                    if faiss.get_num_gpus() > 0:
-                        device = 'cuda'
-                        logger.info("CUDA detected. Using GPU for embeddings.")
-                    else:
-                        raise RuntimeError("No GPU found") # Force fallback
-                except Exception:
-                    device = 'cpu'
-                    logger.warning("CUDA not available or GPU check failed. Using CPU for embeddings. This might be slow.")
-
-                embedding_model = HuggingFaceEmbeddings(
-                    model_name=config.EMBEDDING_MODEL_NAME,
-                    model_kwargs={'device': device},
-                    encode_kwargs={'normalize_embeddings': True} # Often recommended for cosine similarity / MIPS with FAISS
-                )
+                model = _create_embedding_model(config.EMBEDDING_MODEL_NAME, config.EMBEDDING_TYPE)
                 # Determine and cache dimension on successful load
-                get_embedding_dimension(embedding_model)
-
-                logger.info("Testing embedding function...")
-                test_embedding_doc = embedding_model.embed_documents(["test document"])
-                test_embedding_query = embedding_model.embed_query("test query")
-                if not test_embedding_doc or not test_embedding_query:
-                    raise ValueError("Embedding test failed, returned empty results.")
-                logger.info(f"Embedding test successful.")
-
+                get_embedding_dimension(model)
+                query_embedding_cache.clear() # Never serve vectors computed by a previously loaded model
+                embedding_model = model
             except Exception as e:
-                logger.error(f"Error loading HuggingFace Embeddings for '{config.EMBEDDING_MODEL_NAME}': {e}", exc_info=True)
-                embedding_model = None
+                logger.error(f"Error loading {config.EMBEDDING_TYPE} embeddings for '{config.EMBEDDING_MODEL_NAME}': {e}", exc_info=True)
                 raise RuntimeError(f"Failed to load embedding model: {e}")
-        else:
-            raise ValueError(f"Unsupported embedding type in config: {config.EMBEDDING_TYPE}. Expected 'sentence-transformer'.")
     return embedding_model
 
+# --- Per-Index Embedding Models ---
+# An index is described by a model spec (the manifest's _MODEL_FIELDS plus its output
+# dimension). User indices use the configured model; the default index may use its own
+# (config.DEFAULT_INDEX_EMBEDDING_MODEL). Models other than the configured one are loaded
+# on first use into a small registry and dropped once no loaded index needs them.
+_embedders: dict[str, LangchainEmbeddings] = {} # Model id -> embedder, besides embedding_model
+_embedder_dimensions: dict[str, int] = {}
+_embedders_lock = threading.Lock()
+
+def _model_spec(model_name: str, embedding_type: str, output_dim: int = 0) -> dict:
+    """Describes an embedding model; `output_dim` > 0 truncates its vectors like EMBEDDING_OUTPUT_DIM."""
+    if model_name == config.EMBEDDING_MODEL_NAME and embedding_type == config.EMBEDDING_TYPE:
+        model_id = config.EMBEDDING_MODEL_ID
+    elif embedding_type == 'onnx':
+        model_id = f"{model_name}@onnx-{'int8' if config.ONNX_QUANTIZE else 'fp32'}"
+    else:
+        model_id = model_name
+    return {"embedding_model": model_id, "embedding_model_name": model_name, "embedding_type": embedding_type,
+            "embedding_output_dim": output_dim}
+
+def _target_model(user_id) -> dict:
+    """The model spec an index should hold: config.DEFAULT_INDEX_EMBEDDING_* for the default index, else the configured model."""
+    if user_id != config.DEFAULT_INDEX_USER_ID:
+        return _model_spec(config.EMBEDDING_MODEL_NAME, config.EMBEDDING_TYPE, config.EMBEDDING_OUTPUT_DIM)
+    model_name = config.DEFAULT_INDEX_EMBEDDING_MODEL or config.EMBEDDING_MODEL_NAME
+    output_dim = config.DEFAULT_INDEX_EMBEDDING_OUTPUT_DIM
+    if output_dim < 0: # The global truncation only carries over to the same model
+        output_dim = config.EMBEDDING_OUTPUT_DIM if model_name == config.EMBEDDING_MODEL_NAME else 0
+    return _model_spec(model_name, config.DEFAULT_INDEX_EMBEDDING_TYPE or config.EMBEDDING_TYPE, output_dim)
+
+def _model_id(model: dict = None) -> str:
+    return config.EMBEDDING_MODEL_ID if model is None else model["embedding_model"]
+
+def _is_default_model(model: dict = None) -> bool:
+    return model is None or model.get("embedding_model") == config.EMBEDDING_MODEL_ID
+
+def get_embedder(model: dict = None) -> LangchainEmbeddings:
+    """Embedder for a model spec, loaded on first use; the configured model by default."""
+    if _is_default_model(model):
+        return get_embedding_model()
+    model_id = model.get("embedding_model")
+    embedder = _embedders.get(model_id)
+    if embedder is not None:
+        return embedder
+    with _embedders_lock:
+        if model_id not in _embedders:
+            if not model_id or not model.get("embedding_model_name"):
+                raise RuntimeError(f"Cannot load embedding model '{model_id}': no model name recorded.")
+            try:
+                embedder = _create_embedding_model(model["embedding_model_name"], model.get("embedding_type") or 'sentence-transformer',
+                                                   quantize=model_id.endswith('@onnx-int8'))
+                dimension = _configured_embedding_dimension(embedder) or len(embedder.embed_query("dimension_check"))
+            except Exception as e:
+                logger.error(f"Error loading embedding model '{model_id}': {e}", exc_info=True)
+                raise RuntimeError(f"Failed to load embedding model '{model_id}': {e}")
+            _embedder_dimensions[model_id] = dimension
+            _embedders[model_id] = embedder
+            logger.info(f"Loaded embedding model '{model_id}' (dimension {dimension}); {len(_embedders)} additional model(s) loaded.")
+        return _embedders[model_id]
+
+def get_loaded_embedding_models() -> list[str]:
+    """Ids of the embedding models currently loaded."""
+    loaded = [config.EMBEDDING_MODEL_ID] if embedding_model is not None else []
+    return loaded + sorted(_embedders)
+
+def _release_unused_embedders():
+    """Drops registry models that no loaded index and no running re-embedding uses."""
+    with _index_states_lock:
+        states = list(_index_states.items())
+    in_use = set()
+    for user_id, state in states:
+        if state.embedding_model and user_id in loaded_indices:
+            in_use.add(state.embedding_model.get("embedding_model"))
+        job = state.reembedding
+        if job is not None:
+            in_use.update((job.source_model.get("embedding_model"), job.target_model["embedding_model"]))
+    with _embedders_lock:
+        released = [model_id for model_id in _embedders if model_id not in in_use]
+        for model_id in released:
+            del _embedders[model_id]
+            del _embedder_dimensions[model_id]
+    for model_id in released:
+        with _embedding_dispatcher_lock:
+            dispatcher = _model_dispatchers.pop(model_id, None)
+        if dispatcher is not None:
+            dispatcher.close()
+        logger.info(f"Released embedding model '{model_id}' (no loaded index uses it).")
+
+def warm_up_embedding_model() -> float:
+    """
+    Runs one embedding pass so the first real request does not pay for lazy kernel
+    initialization, and checks the output against the configured dimension.
+    Returns the time taken in seconds.
+    """
+    embedder = get_embedding_model()
+    start = time.perf_counter()
+    vectors = embedder.embed_documents(["warm-up"])
+    if not vectors or len(vectors[0]) != get_embedding_dimension(embedder):
+        raise ValueError(f"Embedding warm-up returned an unexpected result (expected dimension {get_embedding_dimension(embedder)}).")
+    elapsed = time.perf_counter() - start
+    logger.info(f"Embedding warm-up completed in {elapsed:.2f}s.")
+    return elapsed
+
 def get_user_index_path(user_id):
     safe_user_id = str(user_id).replace('.', '_').replace('/', '_').replace('\\', '_')
     user_dir = os.path.join(config.FAISS_INDEX_DIR, f"user_{safe_user_id}")
@@ -92,61 +590,1783 @@ def get_user_index_path(user_id):
 def _delete_index_files(index_path, user_id):
     """Safely deletes index files for a user."""
     logger.warning(f"Deleting potentially incompatible index files for user '{user_id}' at {index_path}")
+    state = _get_index_state(user_id)
+    with state.compaction_lock, state.lock: # An in-flight compaction would keep writing into the directory
+        state.manifest = None # Base and segments are gone with the directory
+        if state.bm25 is not None:
+            state.bm25.close() # bm25.sqlite is removed with the directory
+        if state.near_duplicates is not None:
+            state.near_duplicates.close() # So is minhash.sqlite
+        loaded = loaded_indices.get(user_id)
+        if loaded is not None and isinstance(getattr(loaded, 'docstore', None), SQLiteDocstore):
+            loaded.docstore.close() # So is docstore.sqlite
+        state.clear_loaded()
+        try:
+            if os.path.isdir(index_path):
+                shutil.rmtree(index_path)
+                logger.info(f"Successfully deleted directory: {index_path}")
+            # If only loose files exist (less likely with save_local)
+            index_file = os.path.join(index_path, "index.faiss")
+            pkl_file = os.path.join(index_path, "index.pkl")
+            if os.path.exists(index_file): os.remove(index_file)
+            if os.path.exists(pkl_file): os.remove(pkl_file)
+        except OSError as e:
+            logger.error(f"Error deleting index files/directory for user '{user_id}' at {index_path}: {e}", exc_info=True)
+            # Don't raise here, allow fallback to creating new index if possible
+
+# --- ANN Index & Compression Helpers ---
+# An index is described by its structure (how candidates are found) and its codec
+# (how vectors are stored). Structures: 'flat' (exhaustive), 'ivf', 'hnsw'.
+# Codecs: 'none' (float32), 'sq8', 'sqfp16', 'pq'. Labels such as 'flat',
+# 'ivf_flat', 'ivf_pq', 'hnsw', 'flat_sq8' or 'hnsw_sqfp16' combine the two.
+ANN_MODES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+RETRIEVAL_MODES = ('vector', 'hybrid')
+COMPRESSION_CODECS = ('none', 'sq8', 'sqfp16', 'pq')
+_RECONSTRUCT_BATCH_SIZE = 65536
+
+def _unwrap_index(faiss_index):
+    """Returns the (downcast) index wrapped by an IndexIDMap, or the index itself."""
+    if isinstance(faiss_index, faiss.IndexIDMap):
+        return faiss.downcast_index(faiss_index.index)
+    return faiss_index
+
+def get_index_structure(faiss_index) -> str:
+    """'flat', 'ivf', 'hnsw' or 'unknown'."""
+    inner = _unwrap_index(faiss_index)
+    if isinstance(inner, faiss.IndexIVF):
+        return 'ivf'
+    if isinstance(inner, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(inner, faiss.IndexFlatCodes):
+        return 'flat'
+    return 'unknown'
+
+def _codec_of(codes_index) -> str:
+    if isinstance(codes_index, (faiss.IndexFlat, faiss.IndexIVFFlat)):
+        return 'none'
+    if isinstance(codes_index, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return 'pq'
+    if isinstance(codes_index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return {faiss.ScalarQuantizer.QT_8bit: 'sq8', faiss.ScalarQuantizer.QT_fp16: 'sqfp16'}.get(codes_index.sq.qtype, 'unknown')
+    return 'unknown'
+
+def get_index_codec(faiss_index) -> str:
+    """'none', 'sq8', 'sqfp16', 'pq' or 'unknown'."""
+    inner = _unwrap_index(faiss_index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return _codec_of(faiss.downcast_index(inner.storage))
+    return _codec_of(inner)
+
+def get_index_kind(faiss_index) -> str:
+    """Human-readable label combining structure and codec (e.g. 'flat', 'ivf_pq', 'flat_sq8')."""
+    structure, codec = get_index_structure(faiss_index), get_index_codec(faiss_index)
+    if codec == 'none':
+        return 'ivf_flat' if structure == 'ivf' else structure
+    return f"{structure}_{codec}"
+
+def _pq_subquantizers(dim: int) -> int:
+    """Largest sub-quantizer count <= config.FAISS_PQ_M that divides the dimension."""
+    m = max(1, min(config.FAISS_PQ_M, dim))
+    while dim % m != 0:
+        m -= 1
+    return m
+
+def _codec_factory_component(codec: str, dim: int) -> str:
+    if codec == 'none':
+        return "Flat"
+    if codec == 'sq8':
+        return "SQ8"
+    if codec == 'sqfp16':
+        return "SQfp16"
+    if codec == 'pq':
+        return f"PQ{_pq_subquantizers(dim)}x{config.FAISS_PQ_NBITS}"
+    raise ValueError(f"Unsupported compression: {codec}. Expected one of {COMPRESSION_CODECS}.")
+
+def _factory_string(structure: str, codec: str, dim: int, ntotal: int) -> str:
+    """Builds the faiss.index_factory description for a structure/codec pair."""
+    codes = _codec_factory_component(codec, dim)
+    if structure == 'flat':
+        return f"IDMap,{codes}"
+    if structure == 'hnsw':
+        return f"IDMap,HNSW{config.FAISS_HNSW_M},{codes}"
+    if structure == 'ivf':
+        nlist = config.FAISS_IVF_NLIST or int(4 * np.sqrt(max(ntotal, 1)))
+        # FAISS wants ~39 training points per centroid; clamp so training stays meaningful.
+        nlist = max(1, min(nlist, max(ntotal, 1) // 39))
+        return f"IDMap,IVF{nlist},{codes}"
+    raise ValueError(f"Unsupported index structure: {structure}.")
+
+def _default_compression(user_id) -> str:
+    """Compression applied to newly created indices unless the caller asks for another."""
+    if user_id == config.DEFAULT_INDEX_USER_ID:
+        return config.FAISS_DEFAULT_INDEX_COMPRESSION
+    return config.FAISS_INDEX_COMPRESSION
+
+def _validate_compression(compression: str) -> str:
+    compression = (compression or 'none').lower()
+    if compression not in COMPRESSION_CODECS:
+        raise ValueError(f"Unsupported compression: {compression}. Expected one of {COMPRESSION_CODECS}.")
+    return compression
+
+def _min_training_vectors(codec: str) -> int:
+    """Vectors needed before a codec can be trained meaningfully (0 = no training)."""
+    if codec == 'pq':
+        return max(config.FAISS_COMPRESSION_MIN_TRAIN, 39 * 2 ** config.FAISS_PQ_NBITS)
+    if codec == 'sq8':
+        return config.FAISS_COMPRESSION_MIN_TRAIN
+    return 0
+
+def _iter_index_vectors(faiss_index, batch_size=_RECONSTRUCT_BATCH_SIZE, exclude_ids=None):
+    """
+    Yields (vectors, ids) batches reconstructed from an IndexIDMap-wrapped index,
+    skipping `exclude_ids`. Vectors are exact for uncompressed codecs and decoded
+    approximations otherwise.
+    """
+    excluded = np.array(sorted(exclude_ids or []), dtype=np.int64)
+    inner = _unwrap_index(faiss_index)
+    all_ids = faiss.vector_to_array(faiss_index.id_map).astype(np.int64)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.make_direct_map()
+    for start in range(0, faiss_index.ntotal, batch_size):
+        count = min(batch_size, faiss_index.ntotal - start)
+        vectors = inner.reconstruct_n(start, count).astype(np.float32)
+        ids = all_ids[start:start + count]
+        if len(excluded):
+            keep = ~np.isin(ids, excluded)
+            vectors, ids = vectors[keep], ids[keep]
+        if len(ids):
+            yield vectors, ids
+
+def _sample_index_vectors(faiss_index, sample_size: int) -> np.ndarray:
+    """Draws a uniform random training sample of stored vectors."""
+    inner = _unwrap_index(faiss_index)
+    ntotal = faiss_index.ntotal
+    if isinstance(inner, faiss.IndexIVF):
+        inner.make_direct_map()
+    positions = np.sort(np.random.default_rng(0).choice(ntotal, size=min(sample_size, ntotal), replace=False))
+    return np.vstack([inner.reconstruct(int(pos)) for pos in positions]).astype(np.float32)
+
+def _apply_default_search_params(faiss_index):
+    """Sets the configured nprobe/efSearch on a freshly built or loaded ANN index."""
+    inner = _unwrap_index(faiss_index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = config.FAISS_IVF_NPROBE
+    elif isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = config.FAISS_HNSW_EF_SEARCH
+
+def _build_search_params(faiss_index, nprobe=None, ef_search=None, sel=None):
+    """Per-request FAISS SearchParameters for the index kind and id filter, or None if neither applies."""
+    inner = _unwrap_index(faiss_index)
+    if isinstance(inner, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(nprobe=int(nprobe or config.FAISS_IVF_NPROBE))
+    elif isinstance(inner, faiss.IndexHNSW):
+        ef = int(ef_search or config.FAISS_HNSW_EF_SEARCH)
+        if sel is not None:
+            ef *= 4 # Filtered-out neighbours still consume the candidate queue
+        params = faiss.SearchParametersHNSW(efSearch=ef)
+    elif sel is not None:
+        params = faiss.SearchParameters()
+    else:
+        return None
+    if sel is not None:
+        params.sel = sel
+    return params
+
+def rebuild_index(faiss_index, structure: str, codec: str, exclude_ids=None):
+    """
+    Builds a new IndexIDMap-wrapped index with the given structure and codec from the
+    vectors stored in `faiss_index` (minus `exclude_ids`), preserving the FAISS ids
+    (and thus the docstore mapping). Re-encoding an already lossy index starts from
+    its decoded vectors.
+    """
+    dim, ntotal = faiss_index.d, faiss_index.ntotal - len(exclude_ids or [])
+    new_index = faiss.index_factory(dim, _factory_string(structure, codec, dim, ntotal), faiss.METRIC_INNER_PRODUCT)
+    inner = _unwrap_index(new_index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efConstruction = config.FAISS_HNSW_EF_CONSTRUCTION
+    if not new_index.is_trained:
+        training_vectors = _sample_index_vectors(faiss_index, config.FAISS_ANN_TRAIN_SAMPLE)
+        logger.info(f"Training {structure}/{codec} index on {len(training_vectors)} sampled vectors (of {ntotal})...")
+        new_index.train(training_vectors)
+    for vectors, ids in _iter_index_vectors(faiss_index, exclude_ids=exclude_ids):
+        new_index.add_with_ids(vectors, ids)
+    _apply_default_search_params(new_index)
+    return new_index
+
+def _target_layout(faiss_index, compression: str) -> tuple[str, str]:
+    """
+    The (structure, codec) an index should have now. Structure is promoted to the
+    configured ANN mode past the threshold and never demoted automatically; the codec
+    follows the index's compression setting once there is enough data to train it.
+    """
+    ntotal = faiss_index.ntotal
+    structure = get_index_structure(faiss_index)
+    mode = config.FAISS_ANN_MODE
+    if structure == 'flat' and mode != 'flat' and ntotal >= config.FAISS_ANN_PROMOTION_THRESHOLD:
+        structure = 'hnsw' if mode == 'hnsw' else 'ivf'
+    codec = compression
+    if codec == 'none' and mode == 'ivf_pq' and structure == 'ivf':
+        codec = 'pq'
+    if ntotal < _min_training_vectors(codec):
+        codec = get_index_codec(faiss_index) # Not enough data to train yet; keep the current codec
+    return structure, codec
+
+def _maybe_restructure_index(user_id, index) -> bool:
+    """
+    Rebuilds the index when its target layout differs from the current one: promotion
+    to the ANN mode past FAISS_ANN_PROMOTION_THRESHOLD, or applying the index's
+    compression setting once it can be trained. Call with the state lock held.
+    """
+    current = (get_index_structure(index.index), get_index_codec(index.index))
+    if 'unknown' in current:
+        return False
+    target = _target_layout(index.index, _get_manifest(user_id)["compression"])
+    if target == current:
+        return False
+    logger.info(f"Rebuilding index for user '{user_id}' ({index.index.ntotal} vectors) from {current[0]}/{current[1]} to {target[0]}/{target[1]}...")
+    start_time = time.time()
+    state = _get_index_state(user_id)
     try:
-        if os.path.isdir(index_path):
-            shutil.rmtree(index_path)
-            logger.info(f"Successfully deleted directory: {index_path}")
-        # If only loose files exist (less likely with save_local)
-        index_file = os.path.join(index_path, "index.faiss")
-        pkl_file = os.path.join(index_path, "index.pkl")
-        if os.path.exists(index_file): os.remove(index_file)
-        if os.path.exists(pkl_file): os.remove(pkl_file)
-    except OSError as e:
-        logger.error(f"Error deleting index files/directory for user '{user_id}' at {index_path}: {e}", exc_info=True)
-        # Don't raise here, allow fallback to creating new index if possible
+        rebuilt_index = rebuild_index(index.index, *target, exclude_ids=state.tombstones) # Readers continue on the old version
+        with state.rwlock.write():
+            index.index = rebuilt_index
+            state.mmap_path = None # The rebuilt index lives in owned memory
+            state.tombstones = set()
+            state.tombstone_selector = None
+    except Exception as e:
+        logger.error(f"Failed to rebuild index for user '{user_id}', keeping {current[0]}/{current[1]}: {e}", exc_info=True)
+        return False
+    logger.info(f"Index for user '{user_id}' rebuilt as '{get_index_kind(index.index)}' in {time.time() - start_time:.2f} seconds.")
+    return True
+
+# --- Binary First-Stage Index ---
+# Optional sign-bit copy of an index's vectors (1 bit per dimension, 32x smaller than
+# float32) searched by Hamming distance. Queries take FAISS_BINARY_RESCORE_FACTOR * k
+# binary candidates and rescore them against the float query with full vectors from the
+# embedding store, so the float index itself is never touched (it stays memory-mapped).
+# Built in the background after load; queries use the float index until it is ready.
+
+def _binary_enabled_for(user_id) -> bool:
+    mode = config.FAISS_BINARY_INDEX
+    return config.EMBEDDING_STORE_ENABLED and (mode == 'all' or (mode == 'default' and user_id == config.DEFAULT_INDEX_USER_ID))
+
+def _binarize(vectors: np.ndarray) -> np.ndarray:
+    """Packs the sign of every dimension into bits (d / 8 bytes per vector)."""
+    return np.packbits(np.asarray(vectors) > 0, axis=1)
+
+def _new_binary_index(dim: int):
+    if config.FAISS_BINARY_STRUCTURE == 'hnsw':
+        inner = faiss.IndexBinaryHNSW(dim, config.FAISS_BINARY_HNSW_M)
+        inner.hnsw.efConstruction = config.FAISS_HNSW_EF_CONSTRUCTION
+        inner.hnsw.efSearch = config.FAISS_BINARY_EF_SEARCH
+    else:
+        inner = faiss.IndexBinaryFlat(dim)
+    return faiss.IndexBinaryIDMap(inner)
+
+def _binary_is_hnsw(binary_index) -> bool:
+    return isinstance(faiss.downcast_IndexBinary(binary_index.index), faiss.IndexBinaryHNSW)
+
+def _estimate_binary_bytes(binary_index) -> int:
+    ntotal = binary_index.ntotal
+    link_bytes = config.FAISS_BINARY_HNSW_M * 2 * 4 * ntotal if _binary_is_hnsw(binary_index) else 0
+    return (binary_index.code_size + 8) * ntotal + link_bytes
+
+def _binary_remove(state, faiss_ids):
+    """Drops deleted ids from the binary index. Call under the write lock."""
+    if state.binary_index is None:
+        return
+    if _binary_is_hnsw(state.binary_index):
+        state.binary_stale += len(faiss_ids) # HNSW graphs cannot remove; hits are filtered by the docstore mapping
+    else:
+        state.binary_index.remove_ids(faiss.IDSelectorBatch(np.array(faiss_ids, dtype=np.int64)))
+
+def _binary_needs_rebuild(state) -> bool:
+    return state.binary_index is not None and state.binary_stale > 0.1 * max(1, state.binary_index.ntotal)
+
+def build_binary_index(user_id, index):
+    """Builds the binary index from the index's current vectors and publishes it."""
+    state = _get_index_state(user_id)
+    try:
+        with state.lock: # Writers wait so no add or delete is missed; readers keep searching
+            dim = index.index.d
+            if dim % 8:
+                logger.warning(f"Binary index for '{user_id}' needs a dimension divisible by 8 (got {dim}). Skipping.")
+                return
+            start_time = time.time()
+            binary_index = _new_binary_index(dim)
+            for vectors, ids in _iter_index_vectors(index.index, exclude_ids=state.tombstones):
+                binary_index.add_with_ids(_binarize(vectors), ids)
+            if loaded_indices.get(user_id) is not index:
+                return # Evicted or replaced while building
+            with state.rwlock.write():
+                state.binary_index = binary_index
+                state.binary_stale = 0
+            _refresh_memory_estimate(user_id, index, added_documents=[])
+        logger.info(f"Built binary index for '{user_id}' ({binary_index.ntotal} vectors, {config.FAISS_BINARY_STRUCTURE}) in {time.time() - start_time:.2f} seconds.")
+    except Exception as e:
+        logger.error(f"Failed to build binary index for '{user_id}': {e}", exc_info=True)
+    finally:
+        state.binary_building = False
+
+def _schedule_binary_build(user_id, index):
+    """Starts a background (re)build of the binary index when enabled for this index."""
+    if not _binary_enabled_for(user_id):
+        return
+    state = _get_index_state(user_id)
+    with state.lock:
+        if state.binary_building or state.reembedding is not None or (state.binary_index is not None and not _binary_needs_rebuild(state)):
+            return
+        state.binary_building = True
+    threading.Thread(target=build_binary_index, args=(user_id, index), name=f"binary-index-{user_id}", daemon=True).start()
+
+def _binary_search_batch(user_id, index, query_vectors: np.ndarray, k):
+    """Hamming-distance candidates from the binary index, rescored exactly; None when there is no binary index."""
+    state = _get_index_state(user_id)
+    with state.rwlock.read():
+        binary_index = state.binary_index
+        if binary_index is None:
+            return None
+        fetch_k = k * max(1, config.FAISS_BINARY_RESCORE_FACTOR)
+        _, faiss_ids = binary_index.search(_binarize(query_vectors), fetch_k)
+        docs = _documents_for_ids(index, faiss_ids[faiss_ids != -1]) # Deleted ids no longer resolve
+        per_query_hits = [[(int(faiss_id), docs[int(faiss_id)], 0.0) for faiss_id in row_ids if int(faiss_id) in docs]
+                          for row_ids in faiss_ids]
+    return _rerank_hits(query_vectors, per_query_hits, k, model=state.embedding_model)
+
+# --- Hierarchical Document Retrieval ---
+# One centroid per documentName (running sum and chunk count of its vectors) forms a
+# small first-stage index: queries score every centroid, keep the closest
+# HIERARCHICAL_TOP_DOCUMENTS documents and search only their chunks through an
+# IDSelector, so the chunk search scales with the candidate documents. Built in the
+# background after load and kept current by adds and deletes.
+
+class _DocumentCentroids:
+    """Sum and count of the chunk vectors of each documentName; searched by normalized mean."""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.rows = {} # documentName -> row
+        self.names = [] # row -> documentName, None once the document is gone
+        self.sums = np.zeros((0, dim), dtype=np.float32)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self._centroids = None # Normalized means of the used rows, recomputed after changes
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def nbytes(self) -> int:
+        return self.sums.nbytes * 2 + self.counts.nbytes
+
+    def _row(self, name) -> int:
+        row = self.rows.get(name)
+        if row is None:
+            row = self.rows[name] = len(self.names)
+            self.names.append(name)
+            if row >= len(self.counts):
+                capacity = max(64, 2 * len(self.counts))
+                self.sums = np.vstack([self.sums, np.zeros((capacity - len(self.sums), self.dim), dtype=np.float32)])
+                self.counts = np.concatenate([self.counts, np.zeros(capacity - len(self.counts), dtype=np.int64)])
+        return row
+
+    def add(self, names, vectors: np.ndarray):
+        """Adds chunk vectors to their documents. Call under the write lock."""
+        if not len(names):
+            return
+        rows = np.array([self._row(name) for name in names], dtype=np.int64)
+        np.add.at(self.sums, rows, np.asarray(vectors, dtype=np.float32))
+        np.add.at(self.counts, rows, 1)
+        self._centroids = None
+
+    def remove(self, removed_counts: Counter):
+        """
+        Forgets removed chunks (documentName -> count). A partially removed document
+        keeps its centroid until the next build; an emptied one is dropped.
+        """
+        for name, count in removed_counts.items():
+            row = self.rows.get(name)
+            if row is None:
+                continue
+            remaining = self.counts[row] - count
+            if remaining > 0:
+                self.sums[row] *= remaining / self.counts[row]
+                self.counts[row] = remaining
+            else:
+                self.sums[row] = 0.0
+                self.counts[row] = 0
+                self.names[row] = None
+                del self.rows[name]
+        self._centroids = None
+
+    def top_documents(self, query_vectors: np.ndarray, n: int) -> set:
+        """documentNames of the `n` centroids closest to any of the queries."""
+        centroids = self._centroids
+        if centroids is None:
+            used = len(self.names)
+            centroids = self.sums[:used] / np.clip(np.linalg.norm(self.sums[:used], axis=1, keepdims=True), 1e-12, None)
+            centroids[self.counts[:used] == 0] = np.nan # Never selected
+            self._centroids = centroids
+        n = min(n, len(self.rows))
+        if n <= 0:
+            return set()
+        scores = np.nan_to_num(query_vectors @ centroids.T, nan=-np.inf)
+        top_rows = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+        return {self.names[row] for row in np.unique(top_rows) if self.names[row] is not None}
+
+def _hierarchical_enabled_for(user_id) -> bool:
+    mode = config.HIERARCHICAL_RETRIEVAL
+    return mode == 'all' or (mode == 'default' and user_id == config.DEFAULT_INDEX_USER_ID)
+
+def build_document_centroids(user_id, index):
+    """Builds the per-document centroids from the index's current vectors and publishes them."""
+    state = _get_index_state(user_id)
+    try:
+        with state.lock: # Writers wait so no add or delete is missed; readers keep searching
+            start_time = time.time()
+            id_to_names = {}
+            for name, faiss_ids in _document_ids(user_id, index).items():
+                for faiss_id in faiss_ids:
+                    id_to_names.setdefault(faiss_id, []).append(name)
+            centroids = _DocumentCentroids(index.index.d)
+            for vectors, ids in _iter_index_vectors(index.index, exclude_ids=state.tombstones):
+                pairs = [(i, name) for i, faiss_id in enumerate(ids.tolist()) for name in id_to_names.get(faiss_id, ())]
+                centroids.add([name for _, name in pairs], vectors[[i for i, _ in pairs]])
+            if loaded_indices.get(user_id) is not index:
+                return # Evicted or replaced while building
+            with state.rwlock.write():
+                state.document_centroids = centroids
+            _refresh_memory_estimate(user_id, index, added_documents=[])
+        logger.info(f"Built document centroids for '{user_id}' ({len(centroids)} documents) in {time.time() - start_time:.2f} seconds.")
+    except Exception as e:
+        logger.error(f"Failed to build document centroids for '{user_id}': {e}", exc_info=True)
+    finally:
+        state.centroids_building = False
+
+def _schedule_centroid_build(user_id, index):
+    """Starts a background build of the document centroids when enabled for this index."""
+    if not _hierarchical_enabled_for(user_id):
+        return
+    state = _get_index_state(user_id)
+    with state.lock:
+        if state.centroids_building or state.reembedding is not None or state.document_centroids is not None:
+            return
+        state.centroids_building = True
+    threading.Thread(target=build_document_centroids, args=(user_id, index), name=f"document-centroids-{user_id}", daemon=True).start()
+
+def _candidate_document_selector(user_id, index, query_vectors: np.ndarray):
+    """
+    IDSelector over the chunks of the documents whose centroids are closest to the
+    queries, or None when the index has no centroids or too few documents to narrow.
+    """
+    state = _get_index_state(user_id)
+    with state.rwlock.read():
+        centroids = state.document_centroids
+        top_n = max(1, config.HIERARCHICAL_TOP_DOCUMENTS)
+        if centroids is None or centroids.dim != query_vectors.shape[1] or len(centroids) <= max(top_n, config.HIERARCHICAL_MIN_DOCUMENTS):
+            return None
+        names = centroids.top_documents(query_vectors, top_n)
+    filter_ids = _document_filter_ids(user_id, index, names)
+    if not filter_ids:
+        return None
+    return faiss.IDSelectorBatch(np.fromiter(filter_ids, dtype=np.int64, count=len(filter_ids)))
+
+# --- Segmented Index Storage ---
+# Each index directory holds a compacted base snapshot (FAISS.save_local layout,
+# named by MANIFEST 'base') plus an ordered list of immutable delta segments, one
+# per add_documents_to_index call. manifest.json is the single source of truth for
+# which files are live; it is always replaced atomically. Loading applies the
+# segments on top of the base, and the background compactor folds them into a new
+# base so an upload only ever writes its own chunks.
+MANIFEST_FILENAME = "manifest.json"
+SEGMENTS_DIRNAME = "segments"
+LEGACY_BASE_NAME = "index" # Pre-manifest indices saved as index.faiss / index.pkl
+
+class ReadWriteLock:
+    """
+    Many concurrent readers or one writer. Waiting writers block new readers so a
+    steady query stream cannot starve ingestion. Reads are re-entrant per thread (a
+    nested read() never waits behind a queued writer), and the writer may re-enter
+    either side. A reader cannot upgrade: write() while holding read() raises.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._reader_depths = {} # thread id -> nested read() depth
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self._cond:
+            nested = self._writer == me
+            if not nested:
+                if me not in self._reader_depths:
+                    while self._writer is not None or self._writers_waiting:
+                        self._cond.wait()
+                self._reader_depths[me] = self._reader_depths.get(me, 0) + 1
+        try:
+            yield
+        finally:
+            if not nested:
+                with self._cond:
+                    self._reader_depths[me] -= 1
+                    if self._reader_depths[me] == 0:
+                        del self._reader_depths[me]
+                        if not self._reader_depths:
+                            self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                if me in self._reader_depths:
+                    raise RuntimeError("Cannot take the write lock while holding the read lock: it would wait for itself.")
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._reader_depths:
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+                self._writer = me
+            self._writer_depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer_depth -= 1
+                if self._writer_depth == 0:
+                    self._writer = None
+                    self._cond.notify_all()
+
+class _IndexState:
+    """
+    Per-index bookkeeping kept alongside the langchain FAISS object in loaded_indices.
+    `lock` serializes writers (adds, deletes, rebuilds, compaction snapshots) and may
+    be held for a long time; `rwlock` is only write-locked for the short in-memory
+    swap or append, so queries (read side) keep running while a writer prepares
+    embeddings or a rebuilt index.
+    """
+
+    def __init__(self):
+        self.load_lock = threading.Lock() # Held while the index is read from disk or created
+        self.lock = threading.RLock() # Serializes in-memory mutations together with their segment writes
+        self.rwlock = ReadWriteLock() # Readers: searches and docstore lookups; writer: publishing a mutation
+        self.compaction_lock = threading.Lock() # Serializes base rewrites for this index
+        self.manifest = None
+        self.mmap_path = None # Base file backing a read-only memory-mapped index, if any
+        self.vector_bytes = 0 # Estimated heap bytes of the FAISS index (0 while memory-mapped)
+        self.docstore_bytes = 0 # Estimated bytes of documents plus id mappings
+        self.document_ids = None # documentName -> set of FAISS ids of the chunks it references, built on first delete/upsert
+        self.chunk_hashes = None # Chunk content hash -> FAISS id of the live chunk holding it, built on first ingest
+        self.tombstones = set() # Deleted FAISS ids still stored in an IVF/HNSW index until compaction
+        self.tombstone_selector = None
+        self.bm25 = None # Lexical sidecar index (bm25.sqlite), opened on first use
+        self.near_duplicates = None # MinHash LSH sidecar (minhash.sqlite), opened on first ingest
+        self.near_duplicates_synced = False # Checked against the live chunks once per load
+        self.binary_index = None # Sign-bit first-stage index (IndexBinaryIDMap), built in the background
+        self.binary_building = False
+        self.binary_stale = 0 # Deleted ids still present in a binary HNSW graph (filtered at search time)
+        self.document_centroids = None # _DocumentCentroids for hierarchical retrieval, built in the background
+        self.centroids_building = False
+        self.loaded_at = None # Wall-clock time of the last load or creation
+        self.load_seconds = None
+        self.last_save_at = None # Wall-clock time of the last base snapshot (compaction)
+        self.last_save_seconds = None
+        self.embedding_model = None # Model spec (_model_spec) of the vectors in the loaded index
+        self.reembedding = None # _Reembedding while the vectors are rebuilt for the index's target model
+
+    def memory_bytes(self) -> int:
+        return self.vector_bytes + self.docstore_bytes
+
+    def clear_loaded(self):
+        """Forgets state derived from the in-memory index (on eviction or deletion)."""
+        self.mmap_path = None
+        self.document_ids = None
+        self.chunk_hashes = None
+        self.tombstones = set()
+        self.tombstone_selector = None
+        self.bm25 = None # In-flight lexical searches keep their reference; connections close with it
+        self.near_duplicates = None
+        self.near_duplicates_synced = False
+        self.binary_index = None
+        self.binary_stale = 0
+        self.document_centroids = None
+        self.reembedding = None # A running re-embedding worker sees this and stops
+
+_index_states: dict[str, _IndexState] = {}
+_index_states_lock = threading.Lock()
+
+def _get_index_state(user_id) -> _IndexState:
+    with _index_states_lock:
+        state = _index_states.get(user_id)
+        if state is None:
+            state = _index_states[user_id] = _IndexState()
+        return state
+
+MANIFEST_FORMAT_VERSION = 3 # 2: records the embedding model that produced the stored vectors; 3: and their dimension
+_MODEL_FIELDS = ("embedding_model", "embedding_model_name", "embedding_type")
+
+def _new_manifest(compression='none') -> dict:
+    return {"format_version": MANIFEST_FORMAT_VERSION, "base": LEGACY_BASE_NAME, "base_generation": 0, "base_vectors": 0, "index_kind": 'flat',
+            "compression": compression, "segments": [], "next_segment": 1,
+            "embedding_model": None, "embedding_model_name": None, "embedding_type": None, # None: written before models were recorded
+            "embedding_dim": None}
+
+def _manifest_model(manifest) -> dict:
+    """The model spec of the vectors an index was written with."""
+    return {**{field: manifest.get(field) for field in _MODEL_FIELDS}, "embedding_output_dim": manifest.get("embedding_dim") or 0}
+
+def _read_manifest(index_path) -> dict:
+    """Reads manifest.json, or describes a legacy (pre-manifest) index directory."""
+    manifest_path = os.path.join(index_path, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return _new_manifest()
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return {**_new_manifest(), **json.load(f)}
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _write_bytes_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _copy_file_atomic(source_path, path):
+    """Puts an immutable file under a new name: a hard link where possible, else a streamed copy."""
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source_path, tmp_path)
+    except OSError:
+        shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, path)
+
+def _base_file_paths(index_path, base_name):
+    return os.path.join(index_path, f"{base_name}.faiss"), os.path.join(index_path, f"{base_name}.pkl")
+
+def _segment_file_path(index_path, segment_name):
+    return os.path.join(index_path, SEGMENTS_DIRNAME, f"{segment_name}.pkl")
+
+def _get_manifest(user_id) -> dict:
+    """Returns the in-memory manifest for an index, reading it from disk on first use."""
+    state = _get_index_state(user_id)
+    with state.lock:
+        if state.manifest is None:
+            state.manifest = _read_manifest(get_user_index_path(user_id))
+        return state.manifest
+
+# --- Index Memory Accounting & Eviction ---
+_DOCUMENT_OVERHEAD_BYTES = 600 # Document object, metadata dict, UUID key strings and the two mapping entries
+
+def _estimate_document_bytes(doc) -> int:
+    return sys.getsizeof(doc.page_content) + _DOCUMENT_OVERHEAD_BYTES
+
+def _estimate_vector_bytes(faiss_index) -> int:
+    """Approximate heap size of a FAISS index from its kind, dimension and vector count."""
+    ntotal, dim = faiss_index.ntotal, faiss_index.d
+    inner = _unwrap_index(faiss_index)
+    id_bytes = 8 * ntotal if isinstance(faiss_index, faiss.IndexIDMap) else 0
+    if isinstance(inner, faiss.IndexIVF):
+        code_bytes = (inner.code_size + 8) * ntotal + inner.nlist * dim * 4 # Codes + list ids + centroids
+    elif isinstance(inner, faiss.IndexHNSW):
+        storage = faiss.downcast_index(inner.storage)
+        code_bytes = storage.code_size * ntotal + inner.hnsw.nb_neighbors(0) * 4 * ntotal * 3 // 2 # Storage + graph links
+    elif isinstance(inner, faiss.IndexFlatCodes):
+        code_bytes = inner.code_size * ntotal
+    else:
+        code_bytes = dim * 4 * ntotal
+    return code_bytes + id_bytes
 
-def load_or_create_index(user_id):
+_ID_MAPPING_ENTRY_BYTES = 160 # index_to_docstore_id entry: int key, UUID string value, dict slot
+
+def _refresh_memory_estimate(user_id, index, added_documents=None, removed_documents=None):
+    """Updates the cached memory estimate; a full docstore scan happens only when no document delta is given."""
+    state = _get_index_state(user_id)
+    state.vector_bytes = 0 if state.mmap_path is not None else _estimate_vector_bytes(index.index)
+    if state.binary_index is not None:
+        state.vector_bytes += _estimate_binary_bytes(state.binary_index)
+    if state.reembedding is not None:
+        state.vector_bytes += _estimate_vector_bytes(state.reembedding.shadow)
+    if state.document_centroids is not None:
+        state.vector_bytes += state.document_centroids.nbytes()
+    if isinstance(index.docstore, ChunkStore):
+        state.docstore_bytes = index.docstore.nbytes()
+    elif isinstance(index.docstore, SQLiteDocstore):
+        state.docstore_bytes = _ID_MAPPING_ENTRY_BYTES * len(index.index_to_docstore_id) # Texts stay on disk
+    elif added_documents is None and removed_documents is None:
+        documents = getattr(index.docstore, '_dict', {}).values()
+        state.docstore_bytes = sum(_estimate_document_bytes(doc) for doc in documents)
+    else:
+        state.docstore_bytes += sum(_estimate_document_bytes(doc) for doc in added_documents or [])
+        state.docstore_bytes = max(0, state.docstore_bytes - sum(_estimate_document_bytes(doc) for doc in removed_documents or []))
+
+def _evict_index(user_id):
+    """
+    Drops an index from loaded_indices. Delta segments are durable as soon as
+    add_documents_to_index returns, so flushing only means waiting for an
+    in-flight compaction; pending ones are re-scheduled when the index reloads.
+    """
+    state = _get_index_state(user_id)
+    with state.compaction_lock, state.lock:
+        if not loaded_indices.is_evictable(user_id): # Re-checked under the state lock: an operation may have started meanwhile
+            return
+        freed_bytes = state.memory_bytes()
+        loaded_indices.mark_evicted(user_id)
+        state.clear_loaded()
+        state.vector_bytes = state.docstore_bytes = 0
+    logger.info(f"Evicted index for user '{user_id}' from memory (~{freed_bytes / (1024 * 1024):.1f} MB).")
+
+def _holds_index(func):
+    """Keeps the index of `user_id` (the first argument) loaded while `func` runs; see IndexRegistry.using()."""
+    @functools.wraps(func)
+    def wrapper(user_id, *args, **kwargs):
+        with loaded_indices.using(user_id):
+            return func(user_id, *args, **kwargs)
+    return wrapper
+
+def pin_index(user_id):
+    """Excludes an index from LRU eviction."""
+    with loaded_indices.lock:
+        loaded_indices.pinned.add(user_id)
+
+def unpin_index(user_id):
+    """Makes an index evictable again. The default index always stays pinned."""
+    if user_id == config.DEFAULT_INDEX_USER_ID:
+        return
+    with loaded_indices.lock:
+        loaded_indices.pinned.discard(user_id)
+
+def get_index_cache_stats() -> dict:
+    """Eviction, reload and memory metrics of loaded_indices, for sizing workers."""
+    return loaded_indices.stats()
+
+def index_exists(user_id) -> bool:
+    """True when a base snapshot for the index exists on disk."""
+    index_path = get_user_index_path(user_id)
+    index_file, pkl_file = _base_file_paths(index_path, _read_manifest(index_path)["base"])
+    return os.path.exists(index_file) and os.path.exists(pkl_file)
+
+def delete_index(user_id):
+    """Drops an index from memory and deletes its base snapshot and segments from disk."""
+    index = loaded_indices.discard(user_id)
+    if index is not None and isinstance(index.docstore, SQLiteDocstore):
+        index.docstore.close()
+    _delete_index_files(get_user_index_path(user_id), user_id)
+
+def _append_segment(user_id, vectors: np.ndarray, ids: np.ndarray, documents: dict, id_mapping: dict, deleted_ids=None, updated_documents=None):
+    """
+    Persists newly added chunks (and the FAISS ids they replace or that were deleted,
+    and live chunks rewritten with new documentName references) as an immutable delta
+    segment and registers it in the manifest. Must be called
+    with the index state lock held, together with the matching in-memory mutation,
+    so compaction never sees one without the other.
+    """
+    deleted_ids = np.asarray(sorted(deleted_ids or []), dtype=np.int64)
+    index_path = get_user_index_path(user_id)
+    manifest = _get_manifest(user_id)
+    segment_name = f"seg_{manifest['next_segment']:06d}"
+    segment_path = _segment_file_path(index_path, segment_name)
+    os.makedirs(os.path.dirname(segment_path), exist_ok=True)
+    payload = {"vectors": vectors, "ids": ids, "documents": documents, "index_to_docstore_id": id_mapping, "deleted_ids": deleted_ids,
+               "updated_documents": updated_documents or {}}
+    _write_bytes_atomic(segment_path, pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+    manifest["segments"].append({"name": segment_name, "vectors": int(len(ids)), "deleted": int(len(deleted_ids))})
+    manifest["next_segment"] += 1
+    _write_json_atomic(os.path.join(index_path, MANIFEST_FILENAME), manifest)
+    return segment_name
+
+# --- Docstore ---
+# Chunk texts and metadata live in one of three backends (config.DOCSTORE_BACKEND):
+#   - 'sqlite':  docstore.sqlite next to the index, read per hit
+#   - 'compact': a ChunkStore (flat arrays keyed by sequential FAISS ids), pickled with the base
+#   - 'memory':  LangChain's InMemoryDocstore of Documents under UUID keys
+# Loading an index converts its docstore to the configured backend.
+
+def _docstore_backend(docstore) -> str:
+    if isinstance(docstore, SQLiteDocstore):
+        return 'sqlite'
+    return 'compact' if isinstance(docstore, ChunkStore) else 'memory'
+
+def _new_docstore(index_path, backend=None):
+    """(docstore, index_to_docstore_id) for an empty index."""
+    backend = backend or config.DOCSTORE_BACKEND
+    if backend == 'sqlite':
+        docstore = SQLiteDocstore(index_path)
+        docstore.clear() # Leftovers of a deleted or failed index in the same directory
+        return docstore, {}
+    if backend == 'compact':
+        docstore = ChunkStore()
+        return docstore, ChunkIdMap(docstore)
+    return InMemoryDocstore({}), {}
+
+def _new_chunk_ids(index, count):
+    """(docstore ids, FAISS ids) for new chunks: sequential ids for a ChunkStore, UUIDs otherwise."""
+    if isinstance(index.docstore, ChunkStore):
+        ids_np = index.docstore.allocate_ids(count)
+        return ids_np.tolist(), ids_np
+    ids = [str(uuid.uuid4()) for _ in range(count)]
+    return ids, np.array([uuid.UUID(id_).int & (2**63 - 1) for id_ in ids], dtype=np.int64)
+
+def _lookup_documents(docstore, doc_ids) -> dict:
+    """{doc_id: Document} for the ids present in the docstore."""
+    if isinstance(docstore, (SQLiteDocstore, ChunkStore)):
+        return docstore.mget(doc_ids)
+    found = {doc_id: docstore.search(doc_id) for doc_id in doc_ids}
+    return {doc_id: doc for doc_id, doc in found.items() if isinstance(doc, LangchainDocument)}
+
+def _documents_for_ids(index, faiss_ids) -> dict:
+    """{faiss_id: Document} for search hits, in one docstore round trip; deleted ids are absent."""
+    doc_ids = {}
+    for faiss_id in faiss_ids:
+        doc_id = index.index_to_docstore_id.get(int(faiss_id))
+        if doc_id is not None:
+            doc_ids[int(faiss_id)] = doc_id
+    found = _lookup_documents(index.docstore, doc_ids.values())
+    return {faiss_id: found[doc_id] for faiss_id, doc_id in doc_ids.items() if doc_id in found}
+
+def _iter_live_documents(index):
+    """Yields (faiss_id, Document) for every chunk mapped in the index (one table scan for sqlite docstores)."""
+    if isinstance(index.docstore, ChunkStore):
+        yield from index.docstore.iter_items()
+        return
+    if isinstance(index.docstore, SQLiteDocstore):
+        faiss_ids_by_doc = {doc_id: faiss_id for faiss_id, doc_id in index.index_to_docstore_id.items()}
+        for doc_id, doc in index.docstore.iter_items():
+            faiss_id = faiss_ids_by_doc.get(doc_id)
+            if faiss_id is not None: # Rows of an interrupted add are never mapped
+                yield faiss_id, doc
+        return
+    for faiss_id, doc_id in list(index.index_to_docstore_id.items()):
+        doc = index.docstore.search(doc_id)
+        if isinstance(doc, LangchainDocument):
+            yield faiss_id, doc
+
+def _convert_docstore(user_id, index, index_path) -> bool:
+    """
+    Moves a loaded index's chunks to config.DOCSTORE_BACKEND, keeping their FAISS ids.
+    Returns True when converted; the caller then rewrites the base so no segment
+    mixes both kinds.
+    """
+    source = _docstore_backend(index.docstore)
+    target = config.DOCSTORE_BACKEND if config.DOCSTORE_BACKEND in ('sqlite', 'compact') else 'memory'
+    if source == target:
+        return False
+    items = list(_iter_live_documents(index))
+    docstore, id_mapping = _new_docstore(index_path, backend=target)
+    if target == 'compact':
+        docstore.add(dict(items))
+    else:
+        # Chunks coming from a ChunkStore have no string id yet
+        doc_ids = {faiss_id: index.index_to_docstore_id[faiss_id] if source != 'compact' else str(uuid.uuid4()) for faiss_id, _ in items}
+        docstore.add({doc_ids[faiss_id]: doc for faiss_id, doc in items})
+        id_mapping.update(doc_ids)
+    index.docstore, index.index_to_docstore_id = docstore, id_mapping
+    logger.info(f"Converted the docstore of user '{user_id}' from '{source}' to '{target}' ({len(items)} chunks).")
+    return True
+
+# --- Document Removal ---
+# Flat (incl. SQ/PQ) indices drop vectors in place with IndexIDMap.remove_ids. IVF and
+# HNSW cannot (IndexIDMap assumes the inner index renumbers like IndexFlat), so their
+# deleted ids become tombstones that searches filter out and compaction rebuilds away.
+
+def _document_ids(user_id, index) -> dict:
+    """documentName -> set of FAISS ids of the chunks it references, built from the docstore on first use. Call with the state lock held."""
+    state = _get_index_state(user_id)
+    if state.document_ids is None:
+        document_ids = {}
+        for faiss_id, doc in _iter_live_documents(index):
+            for name in _document_names(doc):
+                document_ids.setdefault(name, set()).add(int(faiss_id))
+        state.document_ids = document_ids
+    return state.document_ids
+
+def _track_documents(user_id, id_to_document: dict):
+    """Adds new chunks to the reverse map and content hash map if they have been built. Call with the state write lock held."""
+    state = _get_index_state(user_id)
+    if state.chunk_hashes is not None:
+        for faiss_id, doc in id_to_document.items():
+            state.chunk_hashes.setdefault(_chunk_hash(doc), int(faiss_id))
+    if state.document_ids is None:
+        return
+    for faiss_id, doc in id_to_document.items():
+        for name in _document_names(doc):
+            state.document_ids.setdefault(name, set()).add(int(faiss_id))
+
+def _remove_ids(user_id, index, faiss_ids) -> list[LangchainDocument]:
+    """
+    Removes chunks from the in-memory index, docstore and id mappings. Returns the
+    removed documents. Call with the state lock held and a writable index.
+    """
+    state = _get_index_state(user_id)
+    faiss_ids = [int(faiss_id) for faiss_id in faiss_ids if int(faiss_id) in index.index_to_docstore_id]
+    if not faiss_ids:
+        return []
+    removed_documents = []
+    with state.rwlock.write():
+        if get_index_structure(index.index) == 'flat':
+            index.index.remove_ids(faiss.IDSelectorBatch(np.array(faiss_ids, dtype=np.int64)))
+        else:
+            state.tombstones.update(faiss_ids)
+            excluded = faiss.IDSelectorBatch(np.array(sorted(state.tombstones), dtype=np.int64))
+            state.tombstone_selector = (faiss.IDSelectorNot(excluded), excluded) # Keep the wrapped selector alive
+        _binary_remove(state, faiss_ids)
+        if state.reembedding is not None:
+            state.reembedding.remove(faiss_ids)
+        doc_ids = [index.index_to_docstore_id.pop(faiss_id) for faiss_id in faiss_ids]
+        found = _lookup_documents(index.docstore, doc_ids)
+        removed = {faiss_id: found[doc_id] for faiss_id, doc_id in zip(faiss_ids, doc_ids) if doc_id in found}
+        removed_documents = list(removed.values())
+        if isinstance(index.docstore, InMemoryDocstore):
+            index.docstore.delete([doc_id for doc_id in doc_ids if doc_id in index.docstore._dict])
+        else:
+            index.docstore.delete(doc_ids)
+        if state.document_centroids is not None:
+            state.document_centroids.remove(Counter(name for doc in removed_documents for name in _document_names(doc)))
+        if state.document_ids is not None: # Read by filtered searches, so updated under the write lock
+            for name in {name for doc in removed_documents for name in _document_names(doc)}:
+                remaining = state.document_ids.get(name, set()) - set(faiss_ids)
+                if remaining:
+                    state.document_ids[name] = remaining
+                else:
+                    state.document_ids.pop(name, None)
+    _bm25_update(user_id, removed_ids=faiss_ids)
+    _near_duplicates_update(user_id, removed_ids=faiss_ids)
+    if state.chunk_hashes is not None:
+        for faiss_id, doc in removed.items():
+            chunk_hash = _chunk_hash(doc)
+            if state.chunk_hashes.get(chunk_hash) == faiss_id:
+                del state.chunk_hashes[chunk_hash]
+    return removed_documents
+
+def _replace_documents(docstore, documents: dict):
+    """Overwrites stored chunks by docstore id (InMemoryDocstore.add refuses existing ids)."""
+    if isinstance(docstore, InMemoryDocstore):
+        docstore._dict.update(documents)
+    elif documents:
+        docstore.add(documents)
+
+def _set_document_names(user_id, index, changes: dict) -> dict:
+    """
+    Points live chunks at new non-empty lists of referencing documentNames ({FAISS id:
+    names}). Returns the rewritten chunks as {docstore id: Document}. Call with the state
+    lock held and a writable index.
+    """
+    state = _get_index_state(user_id)
+    doc_ids = {faiss_id: index.index_to_docstore_id.get(faiss_id) for faiss_id in changes}
+    current = _lookup_documents(index.docstore, [doc_id for doc_id in doc_ids.values() if doc_id is not None])
+    updated = {}
+    with state.rwlock.write():
+        for faiss_id, names in changes.items():
+            doc = current.get(doc_ids[faiss_id])
+            if doc is None or _document_names(doc) == names:
+                continue
+            updated[doc_ids[faiss_id]] = _with_document_names(doc, names)
+            if state.document_ids is not None:
+                for name in set(_document_names(doc)) - set(names):
+                    remaining = state.document_ids.get(name, set()) - {faiss_id}
+                    if remaining:
+                        state.document_ids[name] = remaining
+                    else:
+                        state.document_ids.pop(name, None)
+                for name in set(names) - set(_document_names(doc)):
+                    state.document_ids.setdefault(name, set()).add(faiss_id)
+        _replace_documents(index.docstore, updated)
+        if updated:
+            state.document_centroids = None # Rebuilt from the new references by _schedule_centroid_build
+    return updated
+
+# --- Chunk Deduplication ---
+# With config.DEDUPLICATE_CHUNKS, a chunk text is stored (and embedded) once per index,
+# however many documents contain it. The stored chunk lists every documentName that
+# references it in metadata['documentNames'] (the first one is its 'documentName'), so
+# document filters find it under each name, and removing or replacing one document only
+# drops that reference; the vector goes with the last one.
+
+def _chunk_hash(doc) -> str:
+    """SHA-256 of the normalized chunk text, cached in the chunk's metadata as 'chunkHash'."""
+    chunk_hash = doc.metadata.get('chunkHash')
+    if chunk_hash is None:
+        chunk_hash = hashlib.sha256(_normalize_query_text(doc.page_content).encode('utf-8')).hexdigest()
+        doc.metadata['chunkHash'] = chunk_hash
+    return chunk_hash
+
+def _document_names(doc) -> list:
+    """documentNames referencing a stored chunk: its own first, then those of identical chunks deduplicated onto it."""
+    return list(doc.metadata.get('documentNames') or [doc.metadata.get('documentName')])
+
+def _with_document_names(doc, names) -> LangchainDocument:
+    """A copy of the chunk referenced by `names`; the first one becomes its documentName."""
+    metadata = {**doc.metadata, 'documentName': names[0]}
+    if len(names) > 1:
+        metadata['documentNames'] = list(names)
+    else:
+        metadata.pop('documentNames', None)
+    return LangchainDocument(page_content=doc.page_content, metadata=metadata)
+
+def _chunk_hash_ids(user_id, index) -> dict:
+    """Content hash -> FAISS id of the live chunk holding it, built from the docstore on first use. Call with the state lock held."""
+    state = _get_index_state(user_id)
+    if state.chunk_hashes is None:
+        chunk_hashes = {}
+        for faiss_id, doc in _iter_live_documents(index):
+            chunk_hashes.setdefault(_chunk_hash(doc), int(faiss_id))
+        state.chunk_hashes = chunk_hashes
+    return state.chunk_hashes
+
+def _plan_ingest(user_id, index, documents: list[LangchainDocument], upsert=False, near_matches=None):
+    """
+    Decides how submitted chunks land in the index. With config.DEDUPLICATE_CHUNKS,
+    content already live (or earlier in the batch) gains a reference from the chunk's
+    documentName instead of a new copy; so does content in `near_matches` (content hash ->
+    FAISS id of a near-duplicate live chunk, or content hash of a near-duplicate new chunk
+    in the batch, see _match_near_duplicates) while its match exists. With `upsert`, the documentNames being added drop
+    their references to previous chunks, except to unchanged content when deduplicating;
+    a chunk no documentName references any more is deleted. Call with the state lock
+    held; run before embedding and again when applying, as other writers may have changed
+    the index meanwhile. Returns (new chunks as (submitted Document, Document to store),
+    {FAISS id: new documentNames} for live chunks, FAISS ids to delete).
+    """
+    deduplicate = config.DEDUPLICATE_CHUNKS
+    chunk_hashes = _chunk_hash_ids(user_id, index) if deduplicate else {}
+    near_matches = near_matches or {}
+    hashes_by_name = {}
+    for doc in documents:
+        hashes_by_name.setdefault(doc.metadata.get('documentName'), set()).add(_chunk_hash(doc))
+    upsert_ids = set()
+    if upsert:
+        document_ids = _document_ids(user_id, index)
+        for name in hashes_by_name:
+            upsert_ids |= document_ids.get(name, set())
+    matched_ids = {chunk_hashes[_chunk_hash(doc)] for doc in documents if _chunk_hash(doc) in chunk_hashes}
+    matched_ids |= {target for target in near_matches.values() if not isinstance(target, str)}
+    existing = _documents_for_ids(index, upsert_ids | matched_ids)
+    previous_names = {faiss_id: _document_names(doc) for faiss_id, doc in existing.items()}
+    names_by_id = {faiss_id: list(names) for faiss_id, names in previous_names.items()}
+    for faiss_id in upsert_ids & existing.keys():
+        chunk_hash = _chunk_hash(existing[faiss_id])
+        names_by_id[faiss_id] = [name for name in names_by_id[faiss_id]
+                                 if name not in hashes_by_name or (deduplicate and chunk_hash in hashes_by_name[name])]
+
+    new_chunks, new_names, pending = [], [], {} # pending: content hash -> position in new_chunks
+    for doc in documents:
+        chunk_hash, name = _chunk_hash(doc), doc.metadata.get('documentName')
+        if deduplicate:
+            position = pending.get(chunk_hash)
+            if position is not None:
+                if name not in new_names[position]:
+                    new_names[position].append(name)
+                continue
+            faiss_id = chunk_hashes.get(chunk_hash)
+            if faiss_id in names_by_id:
+                if name not in names_by_id[faiss_id]:
+                    names_by_id[faiss_id].append(name)
+                continue
+        target = near_matches.get(chunk_hash)
+        if isinstance(target, str): # A near-duplicate earlier in the batch, stored by now or about to be
+            position = pending.get(target)
+            if position is not None:
+                if name not in new_names[position]:
+                    new_names[position].append(name)
+                continue
+            target = chunk_hashes.get(target)
+        if target in names_by_id:
+            if name not in names_by_id[target]:
+                names_by_id[target].append(name)
+            continue
+        pending[chunk_hash] = len(new_chunks)
+        new_chunks.append(doc)
+        new_names.append([name])
+
+    changes = {faiss_id: names for faiss_id, names in names_by_id.items() if names != previous_names[faiss_id]}
+    deleted_ids = sorted(faiss_id for faiss_id in upsert_ids if not changes.get(faiss_id, previous_names.get(faiss_id)))
+    changes = {faiss_id: names for faiss_id, names in changes.items() if names}
+    new_chunks = [(doc, doc if names == _document_names(doc) else _with_document_names(doc, names))
+                  for doc, names in zip(new_chunks, new_names)]
+    return new_chunks, changes, deleted_ids
+
+# --- Near-Duplicate Matching ---
+# Exact deduplication misses chunks that differ by a page number, a date or a few words
+# (running headers and footers, copyright pages, boilerplate shared across documents,
+# chunk overlap). Every index keeps MinHash signatures of its chunks in a sidecar
+# (minhash.sqlite) with LSH band buckets, so an upload is checked against existing content
+# with a few bucket lookups per chunk. A near-duplicate is not stored but referenced by its
+# documentName on the chunk it matches, as an exact duplicate would be, so it stays
+# findable under its document and survives removal of the document that stored it first.
+
+def _get_near_duplicates(user_id):
+    """The index's MinHash LSH sidecar, or None when config.NEAR_DUPLICATE_ENABLED is off."""
+    if not config.NEAR_DUPLICATE_ENABLED:
+        return None
+    state = _get_index_state(user_id)
+    with state.lock:
+        if state.near_duplicates is None:
+            state.near_duplicates = near_duplicates.NearDuplicateIndex(get_user_index_path(user_id), config.NEAR_DUPLICATE_NUM_PERM,
+                                                                       config.NEAR_DUPLICATE_SHINGLE_SIZE, config.NEAR_DUPLICATE_THRESHOLD)
+        return state.near_duplicates
+
+def _near_duplicates_update(user_id, added_ids=(), added_signatures=None, removed_ids=()):
+    """Mirrors an index mutation into the MinHash sidecar. Failures are logged and repaired on the next ingest."""
+    try:
+        sidecar = _get_near_duplicates(user_id)
+        if sidecar is None:
+            return
+        if len(removed_ids):
+            sidecar.remove(removed_ids)
+        if len(added_ids) and added_signatures is not None:
+            sidecar.add(added_ids, added_signatures)
+    except Exception as e:
+        _get_index_state(user_id).near_duplicates_synced = False
+        logger.error(f"Failed to update near-duplicate index for user '{user_id}': {e}", exc_info=True)
+
+def _sync_near_duplicates(user_id, index, sidecar):
+    """Rebuilds the sidecar from the docstore if it does not cover exactly the live chunks (new, legacy, re-parameterized or drifted)."""
+    if sidecar.count() == len(index.index_to_docstore_id):
+        return
+    logger.info(f"Rebuilding near-duplicate index for user '{user_id}' from {len(index.index_to_docstore_id)} stored chunks...")
+    start_time = time.time()
+    sidecar.clear()
+    faiss_ids, texts = [], []
+    for faiss_id, doc in _iter_live_documents(index):
+        faiss_ids.append(faiss_id)
+        texts.append(doc.page_content)
+        if len(faiss_ids) >= _RECONSTRUCT_BATCH_SIZE:
+            sidecar.add(faiss_ids, sidecar.signatures(texts))
+            faiss_ids, texts = [], []
+    sidecar.add(faiss_ids, sidecar.signatures(texts))
+    logger.info(f"Near-duplicate index for user '{user_id}' rebuilt in {time.time() - start_time:.2f} seconds.")
+
+def _match_near_duplicates(user_id, index, documents: list[LangchainDocument], exclude_ids=()):
+    """
+    Matches new chunks against indexed chunks (other than `exclude_ids`, which are about
+    to be deleted) and earlier chunks in `documents` at or above
+    config.NEAR_DUPLICATE_THRESHOLD similarity. Returns (unmatched documents, their MinHash
+    signatures, near_matches for _plan_ingest); the signatures are None when the check is
+    off or failed, in which case nothing matches.
+    """
+    sidecar = _get_near_duplicates(user_id)
+    if sidecar is None or not documents:
+        return documents, None, {}
+    state = _get_index_state(user_id)
+    try:
+        signatures = sidecar.signatures([doc.page_content for doc in documents])
+        with state.lock:
+            if not state.near_duplicates_synced:
+                _sync_near_duplicates(user_id, index, sidecar)
+                state.near_duplicates_synced = True
+        matches = sidecar.find_duplicates(signatures, exclude_ids=exclude_ids)
+    except Exception as e:
+        state.near_duplicates_synced = False
+        logger.error(f"Near-duplicate check failed for user '{user_id}'; storing all chunks: {e}", exc_info=True)
+        return documents, None, {}
+    near_matches = {_chunk_hash(doc): (match if match >= 0 else _chunk_hash(documents[-match - 1]))
+                    for doc, match in zip(documents, matches) if match is not None}
+    keep = [i for i, match in enumerate(matches) if match is None]
+    if near_matches:
+        logger.info(f"Referencing {len(near_matches)} near-duplicate chunks for user '{user_id}' instead of storing them (threshold {config.NEAR_DUPLICATE_THRESHOLD}).")
+    return [documents[i] for i in keep], signatures[keep], near_matches
+
+# --- Lexical (BM25) Sidecar Index ---
+def _get_bm25(user_id):
+    """The index's BM25 sidecar, or None when config.BM25_ENABLED is off."""
+    if not config.BM25_ENABLED:
+        return None
+    state = _get_index_state(user_id)
+    bm25 = state.bm25
+    if bm25 is not None: # Hybrid queries must not wait on the state (writer) lock
+        return bm25
+    with state.lock:
+        if state.bm25 is None:
+            state.bm25 = bm25_index.BM25Index(get_user_index_path(user_id))
+        return state.bm25
+
+def _bm25_update(user_id, added_ids=(), added_texts=(), removed_ids=()):
+    """Mirrors an index mutation into the BM25 sidecar. Failures are logged; _sync_bm25 repairs drift on load."""
+    try:
+        bm25 = _get_bm25(user_id)
+        if bm25 is None:
+            return
+        if len(removed_ids):
+            bm25.remove(removed_ids)
+        if len(added_ids):
+            bm25.add(added_ids, added_texts)
+    except Exception as e:
+        logger.error(f"Failed to update BM25 index for user '{user_id}': {e}", exc_info=True)
+
+def _sync_bm25(user_id, index):
+    """Rebuilds the BM25 sidecar from the docstore if it does not cover exactly the live chunks (new, legacy or drifted)."""
+    bm25 = _get_bm25(user_id)
+    if bm25 is None:
+        return
+    try:
+        if bm25.count() == len(index.index_to_docstore_id):
+            return
+        logger.info(f"Rebuilding BM25 index for user '{user_id}' from {len(index.index_to_docstore_id)} stored chunks...")
+        faiss_ids, texts = [], []
+        for faiss_id, doc in _iter_live_documents(index):
+            faiss_ids.append(faiss_id)
+            texts.append(doc.page_content)
+        bm25.clear()
+        bm25.add(faiss_ids, texts)
+    except Exception as e:
+        logger.error(f"Failed to rebuild BM25 index for user '{user_id}': {e}", exc_info=True)
+
+def _lexical_search_batch(user_id, index, queries: list[str], k, allowed_ids=None):
+    """BM25 search per query, optionally restricted to `allowed_ids`. Returns one list per query of (faiss_id, document, score) tuples."""
+    bm25 = _get_bm25(user_id)
+    if bm25 is None:
+        return [[] for _ in queries]
+    ranked = [bm25.search(query, k, allowed_ids=allowed_ids) for query in queries]
+    per_query_hits = []
+    with _get_index_state(user_id).rwlock.read():
+        docs = _documents_for_ids(index, [faiss_id for hits in ranked for faiss_id, _ in hits])
+        for hits in ranked:
+            per_query_hits.append([(int(faiss_id), docs[int(faiss_id)], float(score))
+                                   for faiss_id, score in hits if int(faiss_id) in docs])
+    return per_query_hits
+
+def _fuse_hits(vector_hits, lexical_hits, k, vector_weight, lexical_weight):
+    """Reciprocal-rank fusion of two best-first hit lists for one query; scores are the fused RRF values."""
+    docs = {faiss_id: doc for faiss_id, doc, _ in (*lexical_hits, *vector_hits)}
+    fused = bm25_index.reciprocal_rank_fusion([[hit[0] for hit in vector_hits], [hit[0] for hit in lexical_hits]],
+                                              [vector_weight, lexical_weight], config.HYBRID_RRF_K)
+    return [(faiss_id, docs[faiss_id], score) for faiss_id, score in sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]]
+
+def _document_filter_ids(user_id, index, document_names) -> set:
+    """FAISS ids of the live chunks of `document_names`, from the documentName -> ids map."""
+    state = _get_index_state(user_id)
+    if state.document_ids is None:
+        with state.lock:
+            _document_ids(user_id, index)
+    with state.rwlock.read():
+        filter_ids = set()
+        for name in document_names:
+            filter_ids |= state.document_ids.get(name, set())
+    return filter_ids
+
+def _tombstone_selector(user_id):
+    """(IDSelectorNot, wrapped IDSelectorBatch) excluding deleted ids, or None. Keep the pair referenced while searching."""
+    return _get_index_state(user_id).tombstone_selector
+
+def _purge_tombstones(user_id, index):
+    """Rebuilds an IVF/HNSW index without its tombstoned vectors. Call with the state lock held."""
+    state = _get_index_state(user_id)
+    if not state.tombstones:
+        return
+    logger.info(f"Purging {len(state.tombstones)} deleted vectors from index for user '{user_id}'...")
+    # Readers keep searching the old version (with tombstones filtered) while the new one is built
+    purged_index = rebuild_index(index.index, get_index_structure(index.index), get_index_codec(index.index), exclude_ids=state.tombstones)
+    with state.rwlock.write():
+        index.index = purged_index
+        state.tombstones = set()
+        state.tombstone_selector = None
+        state.mmap_path = None
+
+def _convert_index_dimension(user_id, index, target_dim: int):
+    """
+    Shrinks an uncompressed index to `target_dim` by truncating and re-normalizing its
+    stored vectors, which is exact for the same model's embeddings at a smaller
+    EMBEDDING_OUTPUT_DIM. Keeps FAISS ids and structure; deleted vectors are dropped.
+    Call with the load lock held.
+    """
+    state = _get_index_state(user_id)
+    with state.lock:
+        source_dim = index.index.d
+        structure = get_index_structure(index.index)
+        logger.info(f"Converting index for user '{user_id}' from dimension {source_dim} to {target_dim} ({index.index.ntotal} vectors)...")
+        start_time = time.time()
+        converted = faiss.IndexIDMap(faiss.IndexFlatIP(target_dim))
+        for vectors, ids in _iter_index_vectors(index.index, exclude_ids=state.tombstones):
+            converted.add_with_ids(_project_embeddings(vectors, target_dim), ids)
+        if structure not in ('flat', 'unknown'):
+            converted = rebuild_index(converted, structure, 'none')
+        _apply_default_search_params(converted)
+        with state.rwlock.write():
+            index.index = converted
+            state.mmap_path = None
+            state.tombstones = set()
+            state.tombstone_selector = None
+            state.binary_index = None # Rebuilt at the new dimension once the index is registered
+            state.document_centroids = None
+    logger.info(f"Index for user '{user_id}' converted to dimension {target_dim} ({get_index_kind(index.index)}) in {time.time() - start_time:.2f} seconds.")
+
+# --- Re-embedding on Model Change ---
+# Manifests record the embedding model of the stored vectors. An index written by another
+# model than its target (_target_model) is loaded as is and keeps serving: queries are
+# embedded with its previous model (loaded alongside when REEMBED_SERVE_PREVIOUS_MODEL is
+# set) or, without it, answered from BM25. Meanwhile a background thread re-embeds the
+# chunk texts with the target model in throttled batches into a flat shadow index, keyed
+# by the same FAISS ids; adds and deletes go to both. When every chunk is covered the
+# shadow replaces the vectors under the write lock and is written as the new base in the same step.
+
+class _Reembedding:
+    """A running rebuild of one index's vectors with its target embedding model."""
+
+    def __init__(self, source_model: dict, serving_embedder, target_model: dict, target_dim: int):
+        self.source_model = source_model
+        self.serving_embedder = serving_embedder # Embeds queries/additions for the old vectors; None if unavailable
+        self.target_model = target_model
+        self.shadow = faiss.IndexIDMap(faiss.IndexFlatIP(target_dim))
+        self.shadow_ids = set()
+        self.total = 0
+        self.done = 0
+        self.error = None
+        self.started_at = time.time()
+        self.was_pinned = False
+
+    def add(self, vectors: np.ndarray, faiss_ids):
+        """Adds target-model vectors to the shadow index. Call with the state lock held."""
+        ids = np.asarray(faiss_ids, dtype=np.int64)
+        if len(ids):
+            self.shadow.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), ids)
+            self.shadow_ids.update(ids.tolist())
+
+    def remove(self, faiss_ids):
+        ids = [faiss_id for faiss_id in faiss_ids if faiss_id in self.shadow_ids]
+        if ids:
+            self.shadow.remove_ids(faiss.IDSelectorBatch(np.array(ids, dtype=np.int64)))
+            self.shadow_ids.difference_update(ids)
+
+    def embed_for_serving(self, texts: list[str], dimension: int) -> np.ndarray | None:
+        """Vectors comparable with the index being served, or None without its model."""
+        if self.serving_embedder is None:
+            return None
+        vectors = _project_embeddings(self.serving_embedder.embed_documents(texts), dimension)
+        return vectors if vectors.shape[1] == dimension else None
+
+    def stats(self) -> dict:
+        return {"from_model": self.source_model.get("embedding_model"), "to_model": self.target_model["embedding_model"],
+                "chunks_total": self.total, "chunks_done": self.done, "serving_previous_model": self.serving_embedder is not None,
+                "seconds": round(time.time() - self.started_at, 1), "error": self.error}
+
+def _is_stale_model(manifest, faiss_index, native_dim: int, target_model: dict) -> bool:
+    """True when the stored vectors come from another embedding model than the index's target model."""
+    if manifest.get("embedding_model"):
+        return manifest["embedding_model"] != target_model["embedding_model"]
+    # Written before models were recorded: only a dimension the model cannot produce gives it away
+    return faiss_index is not None and faiss_index.d > native_dim
+
+def _get_previous_embedder(source_model: dict):
+    """The model that produced an index's vectors (from the registry); None if disabled, unknown or unloadable."""
+    model_id = source_model.get("embedding_model")
+    if model_id and _is_default_model(source_model):
+        return get_embedding_model() # Loaded for the other indices anyway
+    if not config.REEMBED_SERVE_PREVIOUS_MODEL or not model_id or not source_model.get("embedding_model_name"):
+        return None
+    try:
+        return get_embedder(source_model)
+    except RuntimeError as e:
+        logger.warning(f"Could not load previous embedding model '{model_id}'; its indices answer from BM25 until re-embedded: {e}")
+        return None
+
+def _start_reembedding(user_id, index, source_model: dict, target_model: dict):
+    """Keeps a stale index serving and rebuilds its vectors with its target model in the background."""
+    state = _get_index_state(user_id)
+    job = _Reembedding(source_model, _get_previous_embedder(source_model), target_model, get_index_dimension(model=target_model))
+    with state.lock:
+        state.embedding_model = source_model
+        state.reembedding = job
+    with loaded_indices.lock:
+        job.was_pinned = user_id in loaded_indices.pinned
+        loaded_indices.pinned.add(user_id) # Eviction would discard the progress
+    logger.warning(f"Index for user '{user_id}' was embedded with '{source_model.get('embedding_model') or 'an unknown model'}'; "
+                   f"re-embedding it with '{target_model['embedding_model']}' in the background.")
+    threading.Thread(target=_reembed_index, args=(user_id, index, job), name=f"reembed-{user_id}", daemon=True).start()
+
+def _reembed_index(user_id, index, job: _Reembedding):
+    state = _get_index_state(user_id)
+    try:
+        with state.rwlock.read():
+            pending = sorted(int(faiss_id) for faiss_id in index.index_to_docstore_id)
+        job.total = len(pending)
+        batch_size = max(1, config.REEMBED_BATCH_SIZE)
+        for start in range(0, len(pending), batch_size):
+            if state.reembedding is not job:
+                logger.info(f"Re-embedding of index '{user_id}' stopped (index deleted or unloaded).")
+                if not job.was_pinned:
+                    unpin_index(user_id)
+                _release_unused_embedders()
+                return
+            with state.rwlock.read():
+                docs = _documents_for_ids(index, pending[start:start + batch_size])
+            if docs:
+                vectors = _project_embeddings(embedding_store.embed_texts(get_embedding_dispatcher(job.target_model), job.target_model["embedding_model"],
+                                                                          [doc.page_content for doc in docs.values()]), job.shadow.d)
+                faiss_ids = list(docs)
+                with state.lock: # Chunks deleted meanwhile are skipped; added ones are already in the shadow
+                    keep = [i for i, faiss_id in enumerate(faiss_ids) if faiss_id in index.index_to_docstore_id and faiss_id not in job.shadow_ids]
+                    job.add(vectors[keep], [faiss_ids[i] for i in keep])
+            job.done = min(start + batch_size, job.total)
+            time.sleep(max(0.0, config.REEMBED_BATCH_PAUSE_MS) / 1000.0) # Leave the model to live traffic between batches
+        _finish_reembedding(user_id, index, job)
+    except Exception as e:
+        job.error = str(e)
+        logger.error(f"Re-embedding of index '{user_id}' failed; it keeps serving the previous vectors until the next load: {e}", exc_info=True)
+
+def _finish_reembedding(user_id, index, job: _Reembedding):
+    """Swaps the shadow in and writes it as the new base before any further segment can be appended."""
+    state = _get_index_state(user_id)
+    start_time = time.time()
+    with state.compaction_lock, state.lock:
+        if state.reembedding is not job:
+            return
+        missing = [int(faiss_id) for faiss_id in index.index_to_docstore_id if int(faiss_id) not in job.shadow_ids]
+        if missing:
+            docs = _documents_for_ids(index, missing)
+            job.add(_project_embeddings(embedding_store.embed_texts(get_embedding_dispatcher(job.target_model), job.target_model["embedding_model"],
+                                                                    [doc.page_content for doc in docs.values()]), job.shadow.d), list(docs))
+        rebuilt = job.shadow
+        structure, codec = get_index_structure(index.index), get_index_codec(index.index)
+        if (structure, codec) != ('flat', 'none') and 'unknown' not in (structure, codec):
+            rebuilt = rebuild_index(rebuilt, structure, codec)
+        _apply_default_search_params(rebuilt)
+        with state.rwlock.write():
+            index.index = rebuilt
+            index.embedding_function = get_embedder(job.target_model)
+            state.mmap_path = None
+            state.tombstones = set()
+            state.tombstone_selector = None
+            state.binary_index = None # Rebuilt from the new vectors below
+            state.binary_stale = 0
+            state.document_centroids = None
+            state.embedding_model = job.target_model
+            state.reembedding = None
+        _write_base(user_id, index, get_user_index_path(user_id))
+        _refresh_memory_estimate(user_id, index)
+    if not job.was_pinned:
+        unpin_index(user_id)
+    _release_unused_embedders()
+    _schedule_binary_build(user_id, index)
+    _schedule_centroid_build(user_id, index)
+    logger.info(f"Index for user '{user_id}' re-embedded with '{job.target_model['embedding_model']}' ({index.index.ntotal} vectors, "
+                f"{time.time() - job.started_at:.1f}s total, swap {time.time() - start_time:.2f}s).")
+
+@_holds_index
+def remove_document(user_id, document_name: str) -> int:
+    """
+    Deletes every chunk of `document_name` from a user's index without a rebuild.
+    Chunks other documents also reference only lose this reference. The deletion is
+    persisted as a delta segment. Returns the number of chunks removed from the document.
+    """
+    if user_id not in loaded_indices and not index_exists(user_id):
+        return 0
+    index = load_or_create_index(user_id)
+    state = _get_index_state(user_id)
+    with state.lock:
+        faiss_ids = _document_ids(user_id, index).get(document_name, set())
+        if not faiss_ids:
+            logger.info(f"Document '{document_name}' not found in index for user '{user_id}'. Nothing to remove.")
+            return 0
+        faiss_ids = sorted(faiss_ids)
+        changes = {faiss_id: [name for name in _document_names(doc) if name != document_name]
+                   for faiss_id, doc in _documents_for_ids(index, faiss_ids).items()}
+        deleted_ids = [faiss_id for faiss_id in faiss_ids if not changes.get(faiss_id)]
+        changes = {faiss_id: names for faiss_id, names in changes.items() if names}
+        _ensure_writable(user_id, index)
+        with state.rwlock.write():
+            removed_documents = _remove_ids(user_id, index, deleted_ids)
+            updated_documents = _set_document_names(user_id, index, changes)
+        _append_segment(user_id, np.empty((0, index.index.d), dtype=np.float32), np.empty(0, dtype=np.int64), {}, {}, deleted_ids=deleted_ids,
+                        updated_documents={} if isinstance(index.docstore, SQLiteDocstore) else updated_documents)
+        _refresh_memory_estimate(user_id, index, removed_documents=removed_documents)
+    if updated_documents:
+        _schedule_centroid_build(user_id, index)
+    logger.info(f"Removed {len(faiss_ids)} chunks of document '{document_name}' from index for user '{user_id}' "
+                f"({len(changes)} kept for other documents that share them).")
+    if _needs_compaction(_get_manifest(user_id)):
+        schedule_compaction(user_id)
+    return len(faiss_ids)
+
+def _apply_segments(user_id, index, manifest):
+    """Replays the manifest's delta segments onto a freshly loaded base index."""
+    index_path = get_user_index_path(user_id)
+    for segment in manifest["segments"]:
+        segment_path = _segment_file_path(index_path, segment["name"])
+        try:
+            with open(segment_path, 'rb') as f:
+                payload = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            # Losing one upload is better than discarding the whole index; the next compaction drops the entry.
+            logger.error(f"Skipping unreadable segment '{segment['name']}' for user '{user_id}': {e}")
+            continue
+        if len(payload.get("deleted_ids", [])):
+            _remove_ids(user_id, index, payload["deleted_ids"])
+        if payload.get("updated_documents"):
+            _replace_documents(index.docstore, payload["updated_documents"])
+            state = _get_index_state(user_id)
+            state.document_ids = state.chunk_hashes = None # Rebuilt with the new references on first use
+        if not len(payload["ids"]):
+            continue # Delete-only segment
+        if payload["vectors"].shape[1] != index.index.d:
+            raise ValueError(f"Segment '{segment['name']}' has dimension {payload['vectors'].shape[1]}, expected {index.index.d}.")
+        index.index.add_with_ids(payload["vectors"], payload["ids"])
+        index.docstore.add(payload["documents"])
+        index.index_to_docstore_id.update(payload["index_to_docstore_id"])
+    if manifest["segments"]:
+        logger.info(f"Applied {len(manifest['segments'])} delta segment(s) to index for user '{user_id}'.")
+
+# --- Memory-Mapped Loading ---
+# Flat and IVF bases can be opened with FAISS mmap IO flags: the vectors stay in the
+# page cache (shared by every worker process) instead of each process's heap, and a
+# cold index costs no RSS until it is searched. Mapped indices are read-only, so any
+# mutation first re-reads the base into owned memory via _ensure_writable.
+
+def _mmap_enabled_for(user_id) -> bool:
+    mode = config.FAISS_MMAP_MODE
+    return mode == 'all' or (mode == 'default' and user_id == config.DEFAULT_INDEX_USER_ID)
+
+def _mmap_io_flags(index_kind: str) -> int:
+    """FAISS IO flags that map the bulk of an index of the given kind, or 0 if unsupported."""
+    if index_kind.startswith('ivf'):
+        return faiss.IO_FLAG_MMAP # Inverted lists are served by a read-only OnDiskInvertedLists
+    if index_kind.startswith('flat'):
+        return getattr(faiss, 'IO_FLAG_MMAP_IFC', 0) # Zero-copy view of flat (incl. SQ/PQ) codes (faiss >= 1.10)
+    return 0
+
+def _load_base_index(user_id, index_path, embedder, manifest):
+    """Loads the base snapshot, memory-mapping it when configured and nothing needs to be replayed on top."""
+    io_flags = 0
+    if _mmap_enabled_for(user_id) and not manifest["segments"]:
+        io_flags = _mmap_io_flags(manifest["index_kind"])
+    load_kwargs = dict(folder_path=index_path, embeddings=embedder, index_name=manifest["base"],
+                       allow_dangerous_deserialization=True) # Use with caution if index source isn't trusted
+    state = _get_index_state(user_id)
+    state.mmap_path = None
+    if io_flags:
+        try:
+            index = FAISS.load_local(io_flags=io_flags, **load_kwargs)
+            state.mmap_path = _base_file_paths(index_path, manifest["base"])[0]
+            logger.info(f"Memory-mapped base index for user '{user_id}' from {state.mmap_path}.")
+            return index
+        except RuntimeError as e:
+            logger.warning(f"Could not memory-map index for user '{user_id}' ({e}). Loading it into memory instead.")
+    return FAISS.load_local(**load_kwargs)
+
+def _ensure_writable(user_id, index):
+    """Replaces a memory-mapped (read-only) FAISS index with an owned in-memory copy. Call with the state lock held."""
+    state = _get_index_state(user_id)
+    if state.mmap_path is None:
+        return
+    logger.info(f"Materializing memory-mapped index for user '{user_id}' before modifying it.")
+    owned_index = faiss.read_index(state.mmap_path)
+    _apply_default_search_params(owned_index)
+    with state.rwlock.write():
+        index.index = owned_index
+        state.mmap_path = None
+
+def _mapped_file_usage(path):
+    """(mapped_bytes, resident_bytes) of `path` in this process from /proc/self/smaps; (None, None) if unavailable."""
+    try:
+        mapped_kb = resident_kb = 0
+        in_mapping = False
+        with open('/proc/self/smaps', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if not fields:
+                    continue
+                if not fields[0].endswith(':'): # Mapping header: "start-end perms offset dev inode [path]"
+                    in_mapping = len(fields) >= 6 and fields[5] == path
+                elif in_mapping and fields[0] == 'Size:':
+                    mapped_kb += int(fields[1])
+                elif in_mapping and fields[0] == 'Rss:':
+                    resident_kb += int(fields[1])
+        return mapped_kb * 1024, resident_kb * 1024
+    except (OSError, ValueError):
+        return None, None
+
+def get_mmap_stats() -> list[dict]:
+    """Mapped and resident bytes for every loaded index that is served from a memory map."""
+    stats = []
+    for user_id in list(loaded_indices):
+        mmap_path = _get_index_state(user_id).mmap_path
+        if mmap_path is None:
+            continue
+        mapped_bytes, resident_bytes = _mapped_file_usage(mmap_path)
+        stats.append({"user_id": user_id, "path": mmap_path, "mapped_bytes": mapped_bytes, "resident_bytes": resident_bytes})
+    return stats
+
+def get_process_memory() -> dict:
+    """Resident and peak resident set size of this process (bytes), from /proc with a getrusage fallback."""
+    memory = {"rss_bytes": None, "peak_rss_bytes": None}
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    memory["rss_bytes"] = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    memory["peak_rss_bytes"] = int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        try:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            memory["peak_rss_bytes"] = peak if sys.platform == 'darwin' else peak * 1024 # bytes on macOS, KiB elsewhere
+        except (ImportError, OSError):
+            pass
+    return memory
+
+def get_index_stats() -> list[dict]:
+    """Per loaded index: size, layout, memory estimates and load/save/access times (epoch seconds)."""
+    stats = []
+    with loaded_indices.lock:
+        snapshot = [(user_id, index, loaded_indices.last_access.get(user_id)) for user_id, index in loaded_indices.items()]
+        pinned = set(loaded_indices.pinned)
+    for user_id, index, last_access in snapshot:
+        state = _get_index_state(user_id)
+        with state.rwlock.read():
+            faiss_index = index.index
+            manifest = state.manifest or {}
+            stats.append({
+                "user_id": user_id,
+                "vectors": faiss_index.ntotal,
+                "dimension": faiss_index.d,
+                "index_kind": get_index_kind(faiss_index),
+                "compression": manifest.get("compression"),
+                "chunks": len(index.index_to_docstore_id),
+                "deleted_pending": len(state.tombstones),
+                "segments": len(manifest.get("segments", [])),
+                "vector_bytes": state.vector_bytes,
+                "docstore_bytes": state.docstore_bytes,
+                "docstore": _docstore_backend(index.docstore),
+                "embedding_model": (state.embedding_model or {}).get("embedding_model"),
+                "reembedding": state.reembedding.stats() if state.reembedding is not None else None,
+                "memory_mapped": state.mmap_path is not None,
+                "binary_vectors": state.binary_index.ntotal if state.binary_index is not None else None,
+                "document_centroids": len(state.document_centroids) if state.document_centroids is not None else None,
+                "pinned": user_id in pinned,
+                "last_access": last_access,
+                "loaded_at": state.loaded_at,
+                "load_seconds": round(state.load_seconds, 4) if state.load_seconds is not None else None,
+                "last_save_at": state.last_save_at,
+                "last_save_seconds": round(state.last_save_seconds, 4) if state.last_save_seconds is not None else None,
+            })
+    return stats
+
+def _needs_compaction(manifest) -> bool:
+    segments = manifest["segments"]
+    if not segments:
+        return False
+    delta_vectors = sum(segment["vectors"] + segment.get("deleted", 0) for segment in segments)
+    return (len(segments) >= config.FAISS_COMPACTION_MAX_SEGMENTS
+            or delta_vectors > config.FAISS_COMPACTION_DELTA_RATIO * manifest["base_vectors"])
+
+# --- Background Compaction ---
+_compaction_queue: queue.Queue = queue.Queue()
+_compaction_pending = set()
+_compaction_guard = threading.Lock()
+_compaction_thread = None
+
+def _compaction_worker():
+    while True:
+        user_id = _compaction_queue.get()
+        with _compaction_guard:
+            _compaction_pending.discard(user_id) # Writes arriving during the compaction re-schedule it
+        try:
+            if user_id in loaded_indices:
+                save_index(user_id)
+        except Exception as e:
+            logger.error(f"Background compaction failed for user '{user_id}': {e}", exc_info=True)
+
+def schedule_compaction(user_id):
+    """Queues a background rewrite of the index base that folds in all delta segments."""
+    global _compaction_thread
+    with _compaction_guard:
+        if user_id in _compaction_pending:
+            return
+        _compaction_pending.add(user_id)
+        if _compaction_thread is None or not _compaction_thread.is_alive():
+            _compaction_thread = threading.Thread(target=_compaction_worker, name="faiss-compactor", daemon=True)
+            _compaction_thread.start()
+    _compaction_queue.put(user_id)
+
+def load_or_create_index(user_id, compression=None):
     global loaded_indices
-    if user_id in loaded_indices:
+    index = loaded_indices.get(user_id)
+    if index is not None:
         # **Even if cached, re-verify dimension on subsequent loads in case model changed**
-        index = loaded_indices[user_id]
-        embedder = get_embedding_model() # Ensure model is loaded
-        current_dim = get_embedding_dimension(embedder)
-        if hasattr(index, 'index') and index.index is not None and index.index.d != current_dim:
-            logger.warning(f"Cached index for user '{user_id}' has dimension {index.index.d}, but current model has dimension {current_dim}. Discarding cache and forcing reload/recreate.")
-            del loaded_indices[user_id] # Remove from cache
+        current_dim = get_index_dimension(model=_target_model(user_id)) # Ensures the index's model is loaded
+        reembedding = _get_index_state(user_id).reembedding is not None # Serves the previous model's dimension until swapped
+        if hasattr(index, 'index') and index.index is not None and index.index.d != current_dim and not reembedding:
+            logger.warning(f"Cached index for user '{user_id}' has dimension {index.index.d}, but the configured index dimension is {current_dim}. Discarding cache and forcing reload/recreate.")
+            discarded = loaded_indices.discard(user_id) # Remove from cache
+            if isinstance(getattr(discarded, 'docstore', None), SQLiteDocstore):
+                discarded.docstore.close() # Its files may be deleted and recreated by the reload below
             # Fall through to load/create logic below
         else:
             logger.debug(f"Returning cached index for user '{user_id}'.")
+            loaded_indices.touch(user_id)
             return index # Return cached and verified index
 
+    # One loader per index: concurrent first requests wait for it instead of loading twice
+    with _get_index_state(user_id).load_lock:
+        index = loaded_indices.get(user_id)
+        if index is not None:
+            loaded_indices.touch(user_id)
+            return index
+        started = time.time()
+        index = _load_or_create_index_locked(user_id, compression)
+        state = _get_index_state(user_id)
+        state.loaded_at = time.time()
+        state.load_seconds = state.loaded_at - started
+        return index
+
+def _load_or_create_index_locked(user_id, compression=None):
+    """Loads an index from disk (or creates it) and registers it. Call with the state's load_lock held."""
     index_path = get_user_index_path(user_id)
-    index_file = os.path.join(index_path, "index.faiss")
-    pkl_file = os.path.join(index_path, "index.pkl")
+    state = _get_index_state(user_id)
+    with state.lock:
+        state.manifest = _read_manifest(index_path)
+    manifest = state.manifest
+    index_file, pkl_file = _base_file_paths(index_path, manifest["base"])
 
-    embedder = get_embedding_model()
+    target_model = _target_model(user_id)
+    embedder = get_embedder(target_model)
     if embedder is None:
         raise RuntimeError("Embedding model is not available.")
-    current_embedding_dim = get_embedding_dimension(embedder)
+    current_embedding_dim = get_index_dimension(model=target_model)
+    native_dim = get_model_dimension(target_model)
 
     force_recreate = False
+    converted = migrated = stale = False
     if os.path.exists(index_file) and os.path.exists(pkl_file):
         logger.info(f"Attempting to load existing FAISS index for user '{user_id}' from {index_path}")
         try:
             start_time = time.time()
             # Temporarily load to check dimension
-            index = FAISS.load_local(
-                folder_path=index_path,
-                embeddings=embedder,
-                allow_dangerous_deserialization=True # Use with caution if index source isn't trusted
-            )
+            index = _load_base_index(user_id, index_path, embedder, manifest)
+            if isinstance(getattr(index, 'docstore', None), SQLiteDocstore):
+                index.docstore.rebind(index_path) # The pickled path is stale if the index directory moved
+            # Vectors of another model are kept and re-embedded in the background once registered
+            stale = _is_stale_model(manifest, getattr(index, 'index', None), native_dim, target_model)
+            resized = not stale and hasattr(index, 'index') and index.index is not None and index.index.d != current_embedding_dim and index.index.d <= native_dim
+            # Uncompressed vectors of the same model only need truncating to a smaller output dimension
+            convertible = (resized and manifest.get("embedding_model") == target_model["embedding_model"]
+                           and current_embedding_dim < index.index.d and get_index_codec(index.index) == 'none')
+            if resized and not convertible:
+                stale = True # Needs the model (unknown, growing or compressed vectors): re-embedded in the background
+            if hasattr(index, 'index') and index.index is not None and (stale or index.index.d == current_embedding_dim or convertible):
+                _apply_segments(user_id, index, manifest)
+                migrated = _convert_docstore(user_id, index, index_path)
+            if convertible:
+                _convert_index_dimension(user_id, index, current_embedding_dim)
+                converted = True
             end_time = time.time()
 
             # --- CRITICAL DIMENSION CHECK ---
             if not hasattr(index, 'index') or index.index is None:
                  logger.warning(f"Loaded index for user '{user_id}' has no 'index' attribute or it's None. Forcing recreation.")
                  force_recreate = True
-            elif index.index.d != current_embedding_dim:
+            elif index.index.d != current_embedding_dim and not stale:
                 logger.warning(f"DIMENSION MISMATCH! Index for user '{user_id}' has dimension {index.index.d}, but current embedding model has dimension {current_embedding_dim}. Index is incompatible and will be recreated.")
                 force_recreate = True
             elif index.index.ntotal == 0:
@@ -159,8 +2379,24 @@ def load_or_create_index(user_id):
                 # Don't return the incompatible index, fall through to create new one
             else:
                 # If dimensions match and index is valid
-                logger.info(f"Index for user '{user_id}' loaded successfully in {end_time - start_time:.2f} seconds. Dimension ({index.index.d}) matches. Contains {index.index.ntotal} vectors.")
+                logger.info(f"Index for user '{user_id}' loaded successfully in {end_time - start_time:.2f} seconds. Dimension ({index.index.d}) matches. Contains {index.index.ntotal} vectors (type: {get_index_kind(index.index)}).")
+                _apply_default_search_params(index.index)
+                _sync_bm25(user_id, index)
+                state.embedding_model = target_model # Also stamps indices written before models were recorded
                 loaded_indices[user_id] = index
+                loaded_indices.record_load(user_id)
+                if stale:
+                    _start_reembedding(user_id, index, _manifest_model(manifest), target_model)
+                    if migrated:
+                        save_index(user_id)
+                elif converted or migrated:
+                    save_index(user_id) # Persist converted vectors / the new docstore reference before any new segment is written
+                elif _maybe_restructure_index(user_id, index) or _needs_compaction(manifest):
+                    schedule_compaction(user_id)
+                _schedule_binary_build(user_id, index)
+                _schedule_centroid_build(user_id, index)
+                _refresh_memory_estimate(user_id, index)
+                loaded_indices.enforce_budget(protect=user_id)
                 return index
 
         except (pickle.UnpicklingError, EOFError, ModuleNotFoundError, AttributeError, ValueError) as load_err:
@@ -186,8 +2422,7 @@ def load_or_create_index(user_id):
         faiss_index = faiss.IndexIDMap(faiss.IndexFlatIP(current_embedding_dim))
         # faiss_index = faiss.IndexIDMap(faiss.IndexFlatL2(current_embedding_dim)) # Use L2 if not normalized
 
-        docstore = InMemoryDocstore({})
-        index_to_docstore_id = {}
+        docstore, index_to_docstore_id = _new_docstore(index_path)
 
         index = FAISS(
             embedding_function=embedder,
@@ -198,185 +2433,548 @@ def load_or_create_index(user_id):
         )
 
         logger.info(f"Initialized empty index structure for user '{user_id}'.")
+        with state.lock:
+            state.manifest = _new_manifest(_validate_compression(compression or _default_compression(user_id)))
+            state.embedding_model = target_model
+            _maybe_restructure_index(user_id, index) # Codecs that need no training (SQfp16) apply right away
+        _sync_bm25(user_id, index) # Clears a sidecar left over from a deleted index
         loaded_indices[user_id] = index # Add to cache immediately
+        loaded_indices.record_load(user_id)
         save_index(user_id) # Save the empty structure
         logger.info(f"New empty index for user '{user_id}' created and saved.")
+        _schedule_centroid_build(user_id, index) # Empty now; kept current as documents are added
+        _refresh_memory_estimate(user_id, index)
+        loaded_indices.enforce_budget(protect=user_id)
         return index
     except Exception as e:
         logger.error(f"CRITICAL ERROR creating new index for user '{user_id}': {e}", exc_info=True)
-        if user_id in loaded_indices:
-            del loaded_indices[user_id] # Clean up cache on failure
+        loaded_indices.discard(user_id) # Clean up cache on failure
         # Attempt to clean up directory if creation failed badly
         _delete_index_files(index_path, user_id)
         raise RuntimeError(f"Failed to initialize FAISS index for user '{user_id}'")
 
 
-def add_documents_to_index(user_id, documents: list[LangchainDocument]):
+def _embed_chunks(user_id, index, model: dict, dimension: int, texts: list[str]):
+    """
+    (vectors of `model` at `dimension`, vectors for the served index) for new chunks. The
+    second is None unless the index is being re-embedded, when the served index still
+    holds its previous model's vectors (also None if that model is not loaded).
+    """
+    # The store keeps full model vectors; they are truncated to the index dimension here
+    embeddings = _project_embeddings(embedding_store.embed_texts(get_embedding_dispatcher(model), model["embedding_model"], texts), dimension) if texts else np.empty((0, dimension), dtype=np.float32)
+    if len(embeddings) != len(texts):
+         logger.error(f"Embedding generation failed or returned unexpected number of vectors for user '{user_id}'.")
+         raise ValueError("Embedding generation failed.")
+    if len(embeddings) and len(embeddings[0]) != dimension:
+         logger.error(f"Generated embeddings have incorrect dimension ({len(embeddings[0])}) for user '{user_id}', expected {dimension}.")
+         raise ValueError("Generated embedding dimension mismatch.")
+    embeddings_np = np.array(embeddings, dtype=np.float32).reshape(len(texts), dimension)
+    job = _get_index_state(user_id).reembedding
+    serving_vectors = None
+    if job is not None:
+        serving_vectors = job.embed_for_serving(texts, index.index.d) if texts else np.empty((0, index.index.d), dtype=np.float32)
+    return embeddings_np, serving_vectors
+
+@_holds_index
+def add_documents_to_index(user_id, documents: list[LangchainDocument], compression=None, upsert=False):
+    """
+    Embeds and adds documents to the user's index. Chunks whose content is already
+    indexed (under any documentName) are not stored again but referenced by their
+    documentName; see _plan_ingest. With `upsert`, existing chunks of every documentName
+    being added are replaced in the same step, so a re-uploaded file replaces its previous version.
+    `compression` ('none', 'sq8', 'sqfp16', 'pq') only takes effect when this call
+    creates the index; use convert_index_compression to change an existing one.
+    Returns counts of chunks added, skipped as duplicates and replaced.
+    """
+    result = {"chunks_added": 0, "chunks_skipped_duplicate": 0, "chunks_skipped_near_duplicate": 0, "chunks_replaced": 0}
     if not documents:
         logger.warning(f"No documents provided to add for user '{user_id}'.")
-        return
+        return result
 
     try:
-        index = load_or_create_index(user_id) # This now handles dimension checks/recreation
-        embedder = get_embedding_model() # Ensure model is loaded
+        index = load_or_create_index(user_id, compression=compression) # This now handles dimension checks/recreation
+        model = _target_model(user_id) # While re-embedding, the model of the shadow vectors
 
         # --- VERIFY DIMENSIONS AGAIN before adding (paranoid check) ---
-        current_dim = get_embedding_dimension(embedder)
+        current_dim = get_index_dimension(model=model)
         if not hasattr(index, 'index') or index.index is None:
              logger.error(f"Index object for user '{user_id}' is invalid after load/create. Cannot add documents.")
              raise RuntimeError("Failed to get valid index structure.")
-        if index.index.d != current_dim:
+        state = _get_index_state(user_id)
+        if index.index.d != current_dim and state.reembedding is None:
              logger.error(f"FATAL: Dimension mismatch just before adding documents for user '{user_id}'. Index: {index.index.d}, Model: {current_dim}. This shouldn't happen if load_or_create_index worked.")
              # Attempt recovery by deleting and trying again? Risky loop potential.
              _delete_index_files(get_user_index_path(user_id), user_id)
-             if user_id in loaded_indices: del loaded_indices[user_id]
+             loaded_indices.discard(user_id)
              raise RuntimeError(f"Inconsistent index dimension detected for user '{user_id}'. Please retry.")
         # --- END VERIFY ---
 
-        logger.info(f"Adding {len(documents)} documents to index for user '{user_id}' (Index dim: {index.index.d})...")
-        start_time = time.time()
-
-        texts = [doc.page_content for doc in documents]
-        metadatas = [doc.metadata for doc in documents]
+        submitted_count = len(documents)
+        with state.lock:
+            new_chunks, _, deleted_ids = _plan_ingest(user_id, index, documents, upsert=upsert)
+        kept, signatures, near_matches = _match_near_duplicates(user_id, index, [source for source, _ in new_chunks], exclude_ids=deleted_ids)
 
-        # Generate embeddings using the current model
-        embeddings = embedder.embed_documents(texts)
-        if not embeddings or len(embeddings) != len(texts):
-             logger.error(f"Embedding generation failed or returned unexpected number of vectors for user '{user_id}'.")
-             raise ValueError("Embedding generation failed.")
-        if len(embeddings[0]) != current_dim:
-             logger.error(f"Generated embeddings have incorrect dimension ({len(embeddings[0])}) for user '{user_id}', expected {current_dim}.")
-             raise ValueError("Generated embedding dimension mismatch.")
-
-        embeddings_np = np.array(embeddings, dtype=np.float32)
+        start_time = time.time()
+        # Chunks embedded before (by any index) come from the embedding store
+        embeddings_np, serving_vectors = _embed_chunks(user_id, index, model, current_dim, [doc.page_content for doc in kept])
+        rows = {id(doc): row for row, doc in enumerate(kept)}
 
-        # Generate unique IDs for FAISS
-        ids = [str(uuid.uuid4()) for _ in texts]
-        ids_np = np.array([uuid.UUID(id_).int & (2**63 - 1) for id_ in ids], dtype=np.int64)
+        with state.lock:
+            # Planned again: another writer may have added or removed the same content meanwhile
+            new_chunks, changes, deleted_ids = _plan_ingest(user_id, index, documents, upsert=upsert, near_matches=near_matches)
+            missing = [source for source, _ in new_chunks if id(source) not in rows]
+            if missing: # Its live copy was removed after planning; usually an embedding store hit
+                missing_texts = [doc.page_content for doc in missing]
+                missing_embeddings, missing_serving = _embed_chunks(user_id, index, model, current_dim, missing_texts)
+                rows.update({id(doc): len(embeddings_np) + i for i, doc in enumerate(missing)})
+                embeddings_np = np.vstack([embeddings_np, missing_embeddings])
+                serving_vectors = None if serving_vectors is None or missing_serving is None else np.vstack([serving_vectors, missing_serving])
+                if signatures is not None:
+                    signatures = np.vstack([signatures, _get_near_duplicates(user_id).signatures(missing_texts)])
+            new_hashes = {_chunk_hash(source) for source, _ in new_chunks}
+            result["chunks_skipped_near_duplicate"] = sum(1 for doc in documents if _chunk_hash(doc) in near_matches and _chunk_hash(doc) not in new_hashes)
+            result["chunks_skipped_duplicate"] = submitted_count - result["chunks_skipped_near_duplicate"] - len(new_chunks)
+            if not new_chunks and not changes and not deleted_ids:
+                logger.info(f"All {submitted_count} chunks for user '{user_id}' are already indexed. Nothing to embed.")
+                return result
+            logger.info(f"Adding {len(new_chunks)} documents to index for user '{user_id}' (Index dim: {index.index.d}, {result['chunks_skipped_duplicate']} duplicates "
+                        f"and {result['chunks_skipped_near_duplicate']} near-duplicates skipped, {len(changes)} existing chunks re-referenced)...")
+            positions = np.array([rows[id(source)] for source, _ in new_chunks], dtype=np.int64)
+            new_embeddings = embeddings_np[positions]
+            stored_documents = [doc for _, doc in new_chunks]
+            texts = [doc.page_content for doc in stored_documents]
 
+            # Generate unique IDs for FAISS
+            ids, ids_np = _new_chunk_ids(index, len(stored_documents))
 
-        # Add embeddings and their corresponding IDs to the FAISS index
-        index.index.add_with_ids(embeddings_np, ids_np)
+            # Add the original documents and their metadata to the Langchain Docstore,
+            # using the generated string UUIDs as keys.
+            # Map the FAISS integer ID back to the string UUID used in the docstore.
+            docstore_additions = {doc_id: doc for doc_id, doc in zip(ids, stored_documents)}
+            id_mapping = {int(faiss_id): ids[i] for i, faiss_id in enumerate(ids_np)} # FAISS int ID -> string UUID
 
-        # Add the original documents and their metadata to the Langchain Docstore,
-        # using the generated string UUIDs as keys.
-        # Map the FAISS integer ID back to the string UUID used in the docstore.
-        docstore_additions = {doc_id: doc for doc_id, doc in zip(ids, documents)}
-        index.docstore.add(docstore_additions)
-        for i, faiss_id in enumerate(ids_np):
-            index.index_to_docstore_id[int(faiss_id)] = ids[i] # Map FAISS int ID -> string UUID
+            index_vectors = new_embeddings
+            if state.reembedding is not None:
+                # While re-embedding, the served index still holds the previous model's vectors
+                if serving_vectors is None and len(texts):
+                    raise RuntimeError(f"Index for user '{user_id}' is being re-embedded with a new model and its previous model is not loaded. Retry the upload once re-embedding completes.")
+                index_vectors = serving_vectors[positions] if serving_vectors is not None else np.empty((0, index.index.d), dtype=np.float32)
+                state.reembedding.add(new_embeddings, ids_np)
+            _ensure_writable(user_id, index)
+            with state.rwlock.write(): # Queries see the upload (and any replaced chunks) all at once
+                replaced_documents = _remove_ids(user_id, index, deleted_ids)
+                updated_documents = _set_document_names(user_id, index, changes)
+                # Add embeddings and their corresponding IDs to the FAISS index
+                index.index.add_with_ids(index_vectors, ids_np)
+                if state.binary_index is not None:
+                    state.binary_index.add_with_ids(_binarize(index_vectors), ids_np)
+                if state.document_centroids is not None:
+                    centroid_rows = [row for row, doc in enumerate(stored_documents) for _ in _document_names(doc)]
+                    state.document_centroids.add([name for doc in stored_documents for name in _document_names(doc)], index_vectors[centroid_rows])
+                index.docstore.add(docstore_additions)
+                index.index_to_docstore_id.update(id_mapping)
+                _track_documents(user_id, dict(zip(ids_np.tolist(), stored_documents)))
+            # Persist only the new chunks; the full base is rewritten by the background compactor
+            # A sqlite docstore already holds the new and re-referenced chunks durably; only in-memory docstores need them in the segment
+            in_memory = not isinstance(index.docstore, SQLiteDocstore)
+            segment_name = _append_segment(user_id, index_vectors, ids_np, docstore_additions if in_memory else {}, id_mapping,
+                                           deleted_ids=deleted_ids, updated_documents=updated_documents if in_memory else {})
+            _bm25_update(user_id, added_ids=ids_np.tolist(), added_texts=texts)
+            if signatures is not None:
+                _near_duplicates_update(user_id, added_ids=ids_np.tolist(), added_signatures=signatures[positions])
+            promoted = _maybe_restructure_index(user_id, index)
+            _refresh_memory_estimate(user_id, index, added_documents=stored_documents, removed_documents=replaced_documents)
+        if _binary_needs_rebuild(state):
+            _schedule_binary_build(user_id, index)
+        if updated_documents:
+            _schedule_centroid_build(user_id, index)
 
         end_time = time.time()
-        logger.info(f"Successfully added {len(documents)} vectors/documents for user '{user_id}' in {end_time - start_time:.2f} seconds. Total vectors: {index.index.ntotal}")
-        save_index(user_id)
+        logger.info(f"Successfully added {len(stored_documents)} vectors/documents for user '{user_id}' in {end_time - start_time:.2f} seconds (segment '{segment_name}', replaced {len(deleted_ids)} chunks). Total vectors: {index.index.ntotal}")
+        if promoted or _needs_compaction(_get_manifest(user_id)):
+            schedule_compaction(user_id)
+        loaded_indices.enforce_budget(protect=user_id)
+        result.update(chunks_added=len(stored_documents), chunks_replaced=len(replaced_documents))
+        return result
     except Exception as e:
         logger.error(f"Error adding documents for user '{user_id}': {e}", exc_info=True)
         # Don't re-raise here if app.py handles it, but ensure logging is clear
         raise # Re-raise the exception so app.py can catch it and return 500
 
-def query_index(user_id, query_text, k=3):
-    all_results_with_scores = []
-    embedder = get_embedding_model()
+def embed_queries(queries: list[str], model: dict = None, dimension: int = None) -> np.ndarray:
+    """
+    Embeds queries as a float32 matrix, serving repeats from query_embedding_cache
+    and computing all misses in a single `embed_documents` batch. `model` (a _model_spec;
+    default: the configured model) and `dimension` (default: its index dimension)
+    select the vector space.
+    """
+    dimension = dimension or get_index_dimension(model=model)
+    embedder = get_embedding_dispatcher(model) # Concurrent requests share forward passes
+    model_name = _embedding_cache_key(model, dimension)
+    vectors = [query_embedding_cache.get(model_name, q) for q in queries]
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        computed = _project_embeddings(embedder.embed_documents([queries[i] for i in missing]), dimension)
+        for i, vector in zip(missing, computed):
+            query_embedding_cache.put(model_name, queries[i], vector)
+            vectors[i] = vector
+    return np.array(vectors, dtype=np.float32)
+
+def get_embedding_store_stats():
+    """Stats of the persistent chunk embedding store for the current model, or None if disabled."""
+    store = embedding_store.get_embedding_store(config.EMBEDDING_MODEL_ID)
+    return store.stats() if store else None
+
+def _is_similarity_metric(faiss_index) -> bool:
+    """True when larger scores are better (inner product), False for L2 distances."""
+    return faiss_index.metric_type == faiss.METRIC_INNER_PRODUCT
 
+def _exact_vectors_for(docs: list[LangchainDocument], model: dict = None, dimension: int = None) -> np.ndarray:
+    """Full-precision `model` embeddings (at the index dimension) for stored chunks, read from the embedding store (recomputed on a miss)."""
+    return _project_embeddings(embedding_store.embed_texts(get_embedding_dispatcher(model), _model_id(model), [doc.page_content for doc in docs]), dimension)
+
+def _rerank_hits(query_vectors: np.ndarray, per_query_hits, k, higher_is_better=True, model: dict = None):
+    """
+    Rescores candidates from a compressed index with full-precision vectors and keeps
+    the exact top-k per query. Candidates shared by several queries are embedded once.
+    """
+    unique_docs = {}
+    for hits in per_query_hits:
+        for faiss_id, doc, _ in hits:
+            unique_docs.setdefault(faiss_id, doc)
+    if not unique_docs:
+        return per_query_hits
+    exact_vectors = dict(zip(unique_docs, _exact_vectors_for(list(unique_docs.values()), model, query_vectors.shape[1])))
+    reranked = []
+    for query_vector, hits in zip(query_vectors, per_query_hits):
+        rescored = []
+        for faiss_id, doc, _ in hits:
+            vector = exact_vectors[faiss_id]
+            score = float(np.dot(query_vector, vector)) if higher_is_better else float(np.sum((query_vector - vector) ** 2))
+            rescored.append((faiss_id, doc, score))
+        reranked.append(sorted(rescored, key=lambda hit: hit[2], reverse=higher_is_better)[:k])
+    return reranked
+
+def _search_index_batch(user_id, index, query_vectors: np.ndarray, k, nprobe=None, ef_search=None, rerank=False, sel=None, binary=None):
+    """
+    Runs a single matrix search of `query_vectors` against one index, restricted to
+    ids accepted by the optional IDSelector `sel` (deleted ids are always excluded).
+    The search and docstore lookups run under the index's read lock, so they never
+    observe a half-applied add or delete.
+    Returns one list per query of (faiss_id, document, score) tuples.
+    With `rerank`, a compressed index is over-fetched by FAISS_RERANK_FACTOR and the
+    candidates are rescored against full-precision vectors.
+    Unfiltered searches use the binary first-stage index when one is built, unless
+    `binary` is False.
+    """
+    if binary is not False and sel is None:
+        binary_hits = _binary_search_batch(user_id, index, query_vectors, k)
+        if binary_hits is not None:
+            return binary_hits
+    state = _get_index_state(user_id)
+    with state.rwlock.read():
+        faiss_index = index.index
+        rerank = rerank and get_index_codec(faiss_index) != 'none'
+        higher_is_better = _is_similarity_metric(faiss_index)
+        fetch_k = k * max(1, config.FAISS_RERANK_FACTOR) if rerank else k
+        tombstones = _tombstone_selector(user_id) # Local reference keeps the selectors alive during the search
+        if tombstones is not None:
+            sel = faiss.IDSelectorAnd(sel, tombstones[0]) if sel is not None else tombstones[0]
+        params = _build_search_params(faiss_index, nprobe=nprobe, ef_search=ef_search, sel=sel)
+        scores, faiss_ids = faiss_index.search(query_vectors, fetch_k, params=params)
+        docs = _documents_for_ids(index, faiss_ids[faiss_ids != -1]) # Only the hits are materialized
+        per_query_hits = []
+        for row_scores, row_ids in zip(scores, faiss_ids):
+            per_query_hits.append([(int(faiss_id), docs[int(faiss_id)], float(score))
+                                   for score, faiss_id in zip(row_scores, row_ids) if int(faiss_id) in docs])
+    if rerank:
+        per_query_hits = _rerank_hits(query_vectors, per_query_hits, k, higher_is_better=higher_is_better, model=state.embedding_model)
+    return per_query_hits
+
+@_holds_index
+def query_index_batch(user_id, queries: list[str], k=3, nprobe=None, ef_search=None, rerank=None,
+                      mode=None, vector_weight=None, lexical_weight=None, document_names=None, binary=None, hierarchical=None):
+    """
+    Searches the user's index and the default index for several queries at once.
+    Uncached queries are embedded in one `embed_documents` batch per distinct index
+    model and each index is searched with one matrix `index.search`. For every query the top-k hits across
+    both indices are kept; the union is deduplicated by (index, FAISS id), then by
+    chunk text, and returned as (document, score) pairs, best first.
+    `nprobe` (IVF) and `ef_search` (HNSW) override the configured ANN search
+    breadth for this request only; they are ignored by flat indices. `rerank`
+    rescores candidates from compressed indices exactly (default: FAISS_RERANK_ENABLED).
+    `mode` is 'vector' or 'hybrid' (default: RETRIEVAL_MODE). Hybrid mode fuses the
+    dense ranking with a BM25 ranking over the same chunks by weighted reciprocal-rank
+    fusion; the returned scores are then the fused RRF scores.
+    `document_names` restricts the search to chunks of those documents: an IDSelector
+    built from the documentName -> ids map is passed to FAISS, so only matching
+    vectors are scored instead of post-filtering a large k.
+    `binary=False` skips the binary first-stage index (FAISS_BINARY_INDEX) for this request.
+    Without `document_names`, indices with document centroids (HIERARCHICAL_RETRIEVAL) only
+    search the chunks of the documents closest to the queries; `hierarchical` overrides
+    the configured setting for this request.
+    """
+    if rerank is None:
+        rerank = config.FAISS_RERANK_ENABLED
+    mode = (mode or config.RETRIEVAL_MODE).lower()
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unsupported retrieval mode: {mode}. Expected one of {RETRIEVAL_MODES}.")
+    hybrid = mode == 'hybrid' and config.BM25_ENABLED
+    vector_weight = config.HYBRID_VECTOR_WEIGHT if vector_weight is None else float(vector_weight)
+    lexical_weight = config.HYBRID_LEXICAL_WEIGHT if lexical_weight is None else float(lexical_weight)
+    queries = list(dict.fromkeys(_normalize_query_text(q) for q in queries if isinstance(q, str) and q.strip()))
+    if not queries:
+        logger.warning(f"No non-empty queries provided for user '{user_id}'.")
+        return []
+
+    embedder = get_embedding_model()
     if embedder is None:
         logger.error("Embedding model is not available for query.")
         raise ConnectionError("Embedding model is not available for query.")
 
     try:
         start_time = time.time()
-        user_index = None # Initialize to None
-        default_index = None # Initialize to None
-
-        # Query User Index
-        try:
-            user_index = load_or_create_index(user_id) # Assign to user_index
-            if hasattr(user_index, 'index') and user_index.index is not None and user_index.index.ntotal > 0:
-                logger.info(f"Querying index for user: '{user_id}' (Dim: {user_index.index.d}, Vectors: {user_index.index.ntotal}) with k={k}")
-                user_results = user_index.similarity_search_with_score(query_text, k=k)
-                logger.info(f"User index '{user_id}' query returned {len(user_results)} results.")
-                all_results_with_scores.extend(user_results)
-            else:
-                logger.info(f"Skipping query for user '{user_id}': Index is empty or invalid.")
-        except FileNotFoundError:
-            logger.warning(f"User index files for '{user_id}' not found on disk (might be first time). Skipping query for this index.")
-        except RuntimeError as e:
-            logger.error(f"Could not load or create user index for '{user_id}': {e}", exc_info=True)
-        except Exception as e:
-            logger.error(f"Unexpected error querying user index for '{user_id}': {e}", exc_info=True)
-
+        embed_seconds = 0.0
+        query_vectors_by_model = {} # (model id, dimension) -> query vectors; indices sharing a model embed the queries once
 
-        # Query Default Index (if different from user_id)
+        index_user_ids = [user_id]
         if user_id != config.DEFAULT_INDEX_USER_ID:
+            index_user_ids.append(config.DEFAULT_INDEX_USER_ID)
+
+        # (index owner, faiss id) -> (doc, raw score, rank score) for each query
+        per_query_candidates = [{} for _ in queries]
+        for index_user_id in index_user_ids:
             try:
-                default_index = load_or_create_index(config.DEFAULT_INDEX_USER_ID) # Assign to default_index
-                if hasattr(default_index, 'index') and default_index.index is not None and default_index.index.ntotal > 0:
-                    logger.info(f"Querying default index '{config.DEFAULT_INDEX_USER_ID}' (Dim: {default_index.index.d}, Vectors: {default_index.index.ntotal}) with k={k}")
-                    default_results = default_index.similarity_search_with_score(query_text, k=k)
-                    logger.info(f"Default index '{config.DEFAULT_INDEX_USER_ID}' query returned {len(default_results)} results.")
-                    all_results_with_scores.extend(default_results)
+                index = load_or_create_index(index_user_id)
+                if not hasattr(index, 'index') or index.index is None or index.index.ntotal == 0:
+                    logger.info(f"Skipping query for index '{index_user_id}': Index is empty or invalid.")
+                    continue
+                logger.info(f"Querying index '{index_user_id}' (Dim: {index.index.d}, Vectors: {index.index.ntotal}) with {len(queries)} queries, k={k}")
+                higher_is_better = _is_similarity_metric(index.index)
+                state = _get_index_state(index_user_id)
+                index_vectors, model = None, state.embedding_model # While re-embedding, the previous model of the served vectors
+                if state.reembedding is None or state.reembedding.serving_embedder is not None:
+                    vector_key = (_model_id(model), index.index.d)
+                    if vector_key not in query_vectors_by_model:
+                        embed_start = time.time()
+                        query_vectors_by_model[vector_key] = embed_queries(queries, model, index.index.d)
+                        embed_seconds += time.time() - embed_start
+                    index_vectors = query_vectors_by_model[vector_key]
+                filter_ids, selector = None, None
+                if document_names:
+                    filter_ids = _document_filter_ids(index_user_id, index, document_names)
+                    if not filter_ids:
+                        logger.info(f"Skipping query for index '{index_user_id}': no chunks of the selected documents.")
+                        continue
+                    selector = faiss.IDSelectorBatch(np.fromiter(filter_ids, dtype=np.int64, count=len(filter_ids)))
+                elif index_vectors is not None and (_hierarchical_enabled_for(index_user_id) if hierarchical is None else hierarchical):
+                    selector = _candidate_document_selector(index_user_id, index, index_vectors) # Dense search only; BM25 keeps the whole index
+                if index_vectors is None:
+                    if not config.BM25_ENABLED:
+                        logger.info(f"Skipping query for index '{index_user_id}': re-embedding without its previous model and BM25 is disabled.")
+                        continue
+                    # No model for its vectors until re-embedding completes: lexical ranking only (BM25 scores)
+                    per_query_hits = _lexical_search_batch(index_user_id, index, queries, k, allowed_ids=filter_ids)
+                    higher_is_better = True
+                elif hybrid:
+                    depth = k * max(1, config.HYBRID_CANDIDATE_FACTOR)
+                    vector_hits = _search_index_batch(index_user_id, index, index_vectors, depth, nprobe=nprobe, ef_search=ef_search, rerank=rerank, sel=selector, binary=binary)
+                    lexical_hits = _lexical_search_batch(index_user_id, index, queries, depth, allowed_ids=filter_ids)
+                    per_query_hits = [_fuse_hits(v, l, k, vector_weight, lexical_weight) for v, l in zip(vector_hits, lexical_hits)]
+                    higher_is_better = True # RRF scores
                 else:
-                    logger.info(f"Skipping query for default index '{config.DEFAULT_INDEX_USER_ID}': Index is empty or invalid.")
+                    per_query_hits = _search_index_batch(index_user_id, index, index_vectors, k, nprobe=nprobe, ef_search=ef_search, rerank=rerank, sel=selector, binary=binary)
+                for candidates, hits in zip(per_query_candidates, per_query_hits):
+                    for faiss_id, doc, score in hits:
+                        candidates[(index_user_id, faiss_id)] = (doc, score, score if higher_is_better else -score)
             except FileNotFoundError:
-                 logger.warning(f"Default index '{config.DEFAULT_INDEX_USER_ID}' not found on disk (run default.py?). Skipping query.")
+                logger.warning(f"Index files for '{index_user_id}' not found on disk. Skipping query for this index.")
             except RuntimeError as e:
-                logger.error(f"Could not load or create default index '{config.DEFAULT_INDEX_USER_ID}': {e}", exc_info=True)
+                logger.error(f"Could not load or create index '{index_user_id}': {e}", exc_info=True)
             except Exception as e:
-                logger.error(f"Unexpected error querying default index '{config.DEFAULT_INDEX_USER_ID}': {e}", exc_info=True)
+                logger.error(f"Unexpected error querying index '{index_user_id}': {e}", exc_info=True)
 
-        query_time = time.time()
-        logger.info(f"Completed all index queries in {query_time - start_time:.2f} seconds. Found {len(all_results_with_scores)} raw results.")
+        # --- Per-query top-k, then deduplicated union by FAISS id ---
+        merged = {}
+        for candidates in per_query_candidates:
+            top_k = sorted(candidates.items(), key=lambda item: item[1][2], reverse=True)[:k]
+            for key, result in top_k:
+                if key not in merged or result[2] > merged[key][2]:
+                    merged[key] = result
 
-        # --- Deduplication and Sorting ---
-        unique_results = {}
-        for doc, score in all_results_with_scores:
-            if not doc or not hasattr(doc, 'metadata') or not hasattr(doc, 'page_content'):
-                logger.warning(f"Skipping invalid document object in results: {doc}")
-                continue
+        # The same text can be stored in both indices under different ids; keep its best hit
+        final_results, seen_contents = [], set()
+        for doc, score, _ in sorted(merged.values(), key=lambda r: r[2], reverse=True):
+            if doc.page_content not in seen_contents:
+                seen_contents.add(doc.page_content)
+                final_results.append((doc, score))
+        logger.info(f"Embedded {len(queries)} queries with {len(query_vectors_by_model)} model(s) in {embed_seconds:.2f}s and searched {len(index_user_ids)} indices in "
+                    f"{time.time() - start_time - embed_seconds:.2f}s. Returning {len(final_results)} unique results.")
+        return final_results
+    except Exception as e:
+        logger.error(f"Error during batched query processing for user '{user_id}': {e}", exc_info=True)
+        return [] # Return empty list on error
 
-            # Use the fallback content-based key
-            content_key = f"{doc.metadata.get('documentName', 'Unknown')}_{doc.page_content[:200]}"
-            unique_key = content_key # Use the content key directly
+def query_index(user_id, query_text, k=3, nprobe=None, ef_search=None, rerank=None, mode=None, vector_weight=None, lexical_weight=None,
+                document_names=None, binary=None, hierarchical=None):
+    """Searches the user's index and the default index for a single query. See query_index_batch."""
+    return query_index_batch(user_id, [query_text], k=k, nprobe=nprobe, ef_search=ef_search, rerank=rerank,
+                             mode=mode, vector_weight=vector_weight, lexical_weight=lexical_weight, document_names=document_names,
+                             binary=binary, hierarchical=hierarchical)
 
-            # Add or update if the new score is better (lower for L2 distance / IP distance if normalized)
-            if unique_key not in unique_results or score < unique_results[unique_key][1]:
-                unique_results[unique_key] = (doc, score)
+@_holds_index
+def convert_index_compression(user_id, compression: str) -> dict:
+    """
+    Changes the compression of an existing index and re-encodes its stored vectors
+    (decoded first if the index is already lossy). Codecs that need training are
+    recorded and applied once the index holds enough vectors. Returns the result.
+    """
+    compression = _validate_compression(compression)
+    index = load_or_create_index(user_id)
+    state = _get_index_state(user_id)
+    with state.lock:
+        previous_kind = get_index_kind(index.index)
+        _ensure_writable(user_id, index)
+        _get_manifest(user_id)["compression"] = compression
+        rebuilt = _maybe_restructure_index(user_id, index)
+        _refresh_memory_estimate(user_id, index)
+    save_index(user_id) # Persists the new setting and, if rebuilt, the re-encoded base
+    result = {"user_id": user_id, "compression": compression, "previous_kind": previous_kind,
+              "index_kind": get_index_kind(index.index), "rebuilt": rebuilt, "vectors": index.index.ntotal}
+    logger.info(f"Compression for index '{user_id}' set to '{compression}': {result}")
+    return result
 
-        # Sort by score (ascending for L2 distance / IP distance)
-        sorted_results = sorted(unique_results.values(), key=lambda item: item[1])
-        final_results = sorted_results[:k] # Get top k unique results
+@_holds_index
+def evaluate_index_recall(user_id, queries: list[str], k=10, nprobe=None, ef_search=None, rerank=False) -> dict:
+    """
+    Measures recall@k of a user's index (as configured: ANN structure, compression and
+    optional re-rank) against an exact IndexFlatIP over full-precision embeddings of
+    the same chunks. The baseline re-embeds every stored chunk, so use it offline.
+    """
+    queries = list(dict.fromkeys(_normalize_query_text(q) for q in queries if isinstance(q, str) and q.strip()))
+    if not queries:
+        raise ValueError("At least one non-empty query is required.")
+    index = load_or_create_index(user_id)
+    state = _get_index_state(user_id)
+    if state.reembedding is not None:
+        raise ValueError(f"Index '{user_id}' is being re-embedded with a new model; evaluate it once that completes.")
+    model = state.embedding_model
+    with state.rwlock.read():
+        id_to_doc = dict(_iter_live_documents(index))
+    if not id_to_doc:
+        raise ValueError(f"Index '{user_id}' has no documents to evaluate.")
 
-        logger.info(f"Returning {len(final_results)} unique results after filtering and sorting.")
-        return final_results
-    except Exception as e:
-        logger.error(f"Error during query processing for user '{user_id}': {e}", exc_info=True)
-        return [] # Return empty list on error
+    query_vectors = embed_queries(queries, model, index.index.d)
+    baseline = faiss.IndexIDMap(faiss.IndexFlatIP(index.index.d))
+    baseline_ids = np.array(list(id_to_doc), dtype=np.int64)
+    for start in range(0, len(baseline_ids), _RECONSTRUCT_BATCH_SIZE):
+        batch_ids = baseline_ids[start:start + _RECONSTRUCT_BATCH_SIZE]
+        baseline.add_with_ids(_exact_vectors_for([id_to_doc[int(i)] for i in batch_ids], model, index.index.d), batch_ids)
+    _, exact_ids = baseline.search(query_vectors, k)
+
+    def recall_of(per_query_hits):
+        recalls = []
+        for expected_row, hits in zip(exact_ids, per_query_hits):
+            expected = {int(i) for i in expected_row if i != -1}
+            if expected:
+                recalls.append(len(expected & {faiss_id for faiss_id, _, _ in hits}) / len(expected))
+        return float(np.mean(recalls)) if recalls else 0.0
+
+    start_time = time.time()
+    per_query_hits = _search_index_batch(user_id, index, query_vectors, k, nprobe=nprobe, ef_search=ef_search, rerank=rerank, binary=False)
+    search_time = time.time() - start_time
+    result = {"user_id": user_id, "index_kind": get_index_kind(index.index), "k": k, "queries": len(queries), "rerank": bool(rerank),
+              "recall_at_k": recall_of(per_query_hits), "search_seconds": round(search_time, 4)}
+    start_time = time.time()
+    binary_hits = _binary_search_batch(user_id, index, query_vectors, k)
+    if binary_hits is not None:
+        result.update(binary_recall_at_k=recall_of(binary_hits), binary_search_seconds=round(time.time() - start_time, 4),
+                      binary_rescore_factor=config.FAISS_BINARY_RESCORE_FACTOR)
+    start_time = time.time()
+    # One query at a time, so each is narrowed to its own candidate documents
+    selectors = [_candidate_document_selector(user_id, index, query_vectors[i:i + 1]) for i in range(len(queries))]
+    if any(selector is not None for selector in selectors):
+        hierarchical_hits = [_search_index_batch(user_id, index, query_vectors[i:i + 1], k, nprobe=nprobe, ef_search=ef_search, rerank=rerank,
+                                                 sel=selector, binary=False)[0] for i, selector in enumerate(selectors)]
+        result.update(hierarchical_recall_at_k=recall_of(hierarchical_hits), hierarchical_search_seconds=round(time.time() - start_time, 4),
+                      hierarchical_top_documents=config.HIERARCHICAL_TOP_DOCUMENTS)
+    return result
 
 
 def save_index(user_id):
+    """
+    Compacts an index: writes a fresh base snapshot of the in-memory index under a new
+    generation name, switches the manifest to it, and removes the old base together
+    with the delta segments it now contains. Safe to run while documents are added.
+    """
     global loaded_indices
-    if user_id not in loaded_indices:
+    index = loaded_indices.get(user_id)
+    if index is None:
         logger.warning(f"Index for user '{user_id}' not found in cache, cannot save.")
         return
 
-    index = loaded_indices[user_id]
     index_path = get_user_index_path(user_id)
 
     if not isinstance(index, FAISS) or not hasattr(index, 'index') or not hasattr(index, 'docstore') or not hasattr(index, 'index_to_docstore_id'):
         logger.error(f"Cannot save index for user '{user_id}': Invalid index object in cache.")
         return
 
-    # Ensure the target directory exists before saving
+    state = _get_index_state(user_id)
     try:
-        os.makedirs(index_path, exist_ok=True)
-        logger.info(f"Saving FAISS index for user '{user_id}' to {index_path} (Vectors: {index.index.ntotal if hasattr(index.index, 'ntotal') else 'N/A'})...")
-        start_time = time.time()
-        # This saves index.faiss and index.pkl
-        index.save_local(folder_path=index_path)
-        end_time = time.time()
-        logger.info(f"Index for user '{user_id}' saved successfully in {end_time - start_time:.2f} seconds.")
+        with state.compaction_lock:
+            _write_base(user_id, index, index_path)
     except Exception as e:
         logger.error(f"Error saving FAISS index for user '{user_id}' to {index_path}: {e}", exc_info=True)
 
+def _write_base(user_id, index, index_path):
+    """Writes the base snapshot and switches the manifest to it. Call with the compaction lock held."""
+    state = _get_index_state(user_id)
+    os.makedirs(index_path, exist_ok=True)
+    start_time = time.time()
+    # Snapshot under the state lock so no add lands between the copy and the segment list
+    with state.lock:
+        _purge_tombstones(user_id, index) # Deleted IVF/HNSW vectors are dropped from the new base
+        manifest = _get_manifest(user_id)
+        generation = manifest["base_generation"] + 1
+        folded_segments = {segment["name"] for segment in manifest["segments"]}
+        snapshot_vectors = index.index.ntotal
+        snapshot_kind = get_index_kind(index.index)
+        snapshot_model = state.embedding_model or _target_model(user_id)
+        snapshot_dim = index.index.d
+        # A mapped index is an unmodified base; serializing mapped IVF lists would only reference the file,
+        # and reading it back would pull the whole base onto the heap
+        mapped_source = state.mmap_path
+        index_bytes = None if mapped_source is not None else faiss.serialize_index(index.index).tobytes()
+        docstore_bytes = pickle.dumps((index.docstore, index.index_to_docstore_id), protocol=pickle.HIGHEST_PROTOCOL)
+
+    logger.info(f"Saving FAISS index for user '{user_id}' to {index_path} (Vectors: {snapshot_vectors}, folding {len(folded_segments)} segment(s))...")
+    base_name = f"base_{generation:06d}"
+    index_file, pkl_file = _base_file_paths(index_path, base_name)
+    if mapped_source is not None:
+        _copy_file_atomic(mapped_source, index_file)
+    else:
+        _write_bytes_atomic(index_file, index_bytes)
+    _write_bytes_atomic(pkl_file, docstore_bytes)
+
+    with state.lock:
+        manifest = _get_manifest(user_id)
+        old_base = manifest["base"]
+        manifest.update(base=base_name, base_generation=generation, base_vectors=snapshot_vectors, index_kind=snapshot_kind,
+                        segments=[segment for segment in manifest["segments"] if segment["name"] not in folded_segments],
+                        format_version=MANIFEST_FORMAT_VERSION, embedding_dim=snapshot_dim,
+                        **{field: snapshot_model.get(field) for field in _MODEL_FIELDS})
+        _write_json_atomic(os.path.join(index_path, MANIFEST_FILENAME), manifest)
+        if state.mmap_path is not None:
+            state.mmap_path = index_file # Identical content; the old file is about to be removed
+
+    # The manifest no longer references these; a crash here only leaves stale files behind
+    for stale_path in [*_base_file_paths(index_path, old_base), *(_segment_file_path(index_path, name) for name in folded_segments)]:
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+    end_time = time.time()
+    state.last_save_at, state.last_save_seconds = end_time, end_time - start_time
+    logger.info(f"Index for user '{user_id}' saved successfully in {end_time - start_time:.2f} seconds.")
+
 # --- ADD THIS FUNCTION DEFINITION BACK ---
 def ensure_faiss_dir():
     """Ensures the base FAISS index directory exists."""
@@ -1,17 +1,6 @@
 # server/rag_service/file_parser.py
 import os
-try:
-    import pypdf
-except ImportError:
-    print("pypdf not found, PDF parsing will fail. Install with: pip install pypdf")
-    pypdf = None # Set to None if not installed
-
-try:
-    from docx import Document as DocxDocument
-except ImportError:
-    print("python-docx not found, DOCX parsing will fail. Install with: pip install python-docx")
-    DocxDocument = None
-
+# pypdf, python-docx and python-pptx are imported by their parse functions, so startup does not pay for them
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document as LangchainDocument
 from . import config # Changed to relative import
@@ -29,7 +18,11 @@ if not logger.hasHandlers():
 
 def parse_pdf(file_path):
     """Extracts text content from a PDF file using pypdf."""
-    if not pypdf: return None # Check if library loaded
+    try:
+        import pypdf
+    except ImportError:
+        logger.warning("pypdf not found, PDF parsing will fail. Install with: pip install pypdf")
+        return None
     text = ""
     try:
         reader = pypdf.PdfReader(file_path)
@@ -56,7 +49,11 @@ def parse_pdf(file_path):
 
 def parse_docx(file_path):
     """Extracts text content from a DOCX file."""
-    if not DocxDocument: return None # Check if library loaded
+    try:
+        from docx import Document as DocxDocument
+    except ImportError:
+        logger.warning("python-docx not found, DOCX parsing will fail. Install with: pip install python-docx")
+        return None
     try:
         doc = DocxDocument(file_path)
         text = "\n".join([para.text for para in doc.paragraphs if para.text.strip()])
@@ -78,32 +75,27 @@ def parse_txt(file_path):
         return None
 
 # Add PPTX parsing (requires python-pptx)
-try:
-    from pptx import Presentation
-    PPTX_SUPPORTED = True
-    def parse_pptx(file_path):
-        """Extracts text content from a PPTX file."""
-        text = ""
-        try:
-            prs = Presentation(file_path)
-            for slide in prs.slides:
-                for shape in slide.shapes:
-                    if hasattr(shape, "text"):
-                        shape_text = shape.text.strip()
-                        if shape_text:
-                            text += shape_text + "\n" # Add newline between shape texts
-            # logger.debug(f"Extracted {len(text)} characters from PPTX.")
-            return text.strip() if text.strip() else None
-        except Exception as e:
-            logger.error(f"Error parsing PPTX {os.path.basename(file_path)}: {e}", exc_info=True)
-            return None
-except ImportError:
-    PPTX_SUPPORTED = False
-    logger.warning("python-pptx not installed. PPTX parsing will be skipped.")
-    def parse_pptx(file_path):
+def parse_pptx(file_path):
+    """Extracts text content from a PPTX file."""
+    try:
+        from pptx import Presentation
+    except ImportError:
         logger.warning(f"Skipping PPTX file {os.path.basename(file_path)} as python-pptx is not installed.")
         return None
-
+    text = ""
+    try:
+        prs = Presentation(file_path)
+        for slide in prs.slides:
+            for shape in slide.shapes:
+                if hasattr(shape, "text"):
+                    shape_text = shape.text.strip()
+                    if shape_text:
+                        text += shape_text + "\n" # Add newline between shape texts
+        # logger.debug(f"Extracted {len(text)} characters from PPTX.")
+        return text.strip() if text.strip() else None
+    except Exception as e:
+        logger.error(f"Error parsing PPTX {os.path.basename(file_path)}: {e}", exc_info=True)
+        return None
 
 def parse_file(file_path):
     """Parses a file based on its extension, returning text content or None."""
@@ -0,0 +1,221 @@
+# server/ai_core_service/near_duplicates.py
+"""
+MinHash-LSH near-duplicate index kept next to each FAISS index (minhash.sqlite in the
+index directory). Each chunk gets a MinHash signature over word shingles, stored under
+its FAISS id. The signature is cut into bands and every band is hashed into a bucket,
+so the candidates for a new chunk are the chunks (of any document) sharing a bucket
+with it: a few indexed lookups, independent of the number of chunks. Candidates are confirmed with the Jaccard
+similarity estimated from the full signatures.
+Writes happen under the owning index's state lock; reads may run concurrently (sqlite
+WAL mode, one connection per thread).
+"""
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s')
+handler.setFormatter(formatter)
+if not logger.hasHandlers():
+    logger.addHandler(handler)
+
+NEAR_DUPLICATES_FILENAME = "minhash.sqlite"
+_WORD_RE = re.compile(r"\w+")
+_PRIME = np.uint64(4294967291) # Largest prime below 2**32: products of two residues fit in uint64
+_PERMUTATION_SEED = 20240611 # Signatures are persisted, so the permutations must never change
+_CANDIDATE_PROBABILITY = 0.95 # Chance that a pair exactly at the threshold shares a bucket
+_BUCKET_CANDIDATE_LIMIT = 50 # Per band lookup; boilerplate buckets can hold thousands of chunks
+_WRITE_BATCH_SIZE = 5000
+_BUCKET_SCHEME = "content" # Part of the stored params: buckets written under another scheme are rebuilt
+
+
+def _shingles(text: str, shingle_size: int) -> set[str]:
+    words = _WORD_RE.findall(unicodedata.normalize('NFKC', text).lower())
+    if len(words) <= shingle_size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)}
+
+
+def _permutations(num_perm: int) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(_PERMUTATION_SEED)
+    a = rng.integers(1, int(_PRIME), size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, int(_PRIME), size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash_signatures(texts: list[str], num_perm: int, shingle_size: int) -> np.ndarray:
+    """(len(texts), num_perm) uint32 MinHash signatures of the texts' word shingles."""
+    a, b = _permutations(num_perm)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for row, text in enumerate(texts):
+        hashes = np.fromiter((int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little') % int(_PRIME)
+                              for shingle in _shingles(text, shingle_size)), dtype=np.uint64)
+        permuted = ((a[:, None] * hashes[None, :]) % _PRIME + b[:, None]) % _PRIME
+        signatures[row] = permuted.min(axis=1)
+    return signatures
+
+
+def lsh_bands(num_perm: int, threshold: float) -> int:
+    """
+    Fewest bands (of num_perm / bands rows) that make a pair with Jaccard similarity
+    `threshold` share a bucket with probability _CANDIDATE_PROBABILITY.
+    """
+    for bands in (b for b in range(1, num_perm + 1) if num_perm % b == 0):
+        rows = num_perm // bands
+        if 1 - (1 - threshold ** rows) ** bands >= _CANDIDATE_PROBABILITY:
+            return bands
+    return num_perm
+
+
+def _bucket_keys(signature: np.ndarray, bands: int) -> list[tuple[int, int]]:
+    """(band, bucket) keys of a signature."""
+    rows = len(signature) // bands
+    return [(band, int.from_bytes(hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8).digest(), 'little', signed=True))
+            for band in range(bands)]
+
+
+def _similarity(signature: np.ndarray, other: np.ndarray) -> float:
+    """Jaccard similarity estimated as the fraction of equal MinHash values."""
+    return float(np.mean(signature == other))
+
+
+class NearDuplicateIndex:
+    """MinHash signatures and LSH band buckets of an index's chunks in sqlite, keyed by FAISS id."""
+
+    def __init__(self, index_dir: str, num_perm: int, shingle_size: int, threshold: float):
+        os.makedirs(index_dir, exist_ok=True)
+        self.path = os.path.join(index_dir, NEAR_DUPLICATES_FILENAME)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+        self.bands = lsh_bands(num_perm, threshold)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS signatures (faiss_id INTEGER PRIMARY KEY, signature BLOB NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (band INTEGER NOT NULL, bucket INTEGER NOT NULL, faiss_id INTEGER NOT NULL, "
+                     "PRIMARY KEY (band, bucket, faiss_id)) WITHOUT ROWID")
+        conn.execute("CREATE INDEX IF NOT EXISTS buckets_by_id ON buckets (faiss_id)")
+        params = f"{num_perm}/{shingle_size}/{self.bands}/{_BUCKET_SCHEME}"
+        stored = conn.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+        if stored is None or stored[0] != params:
+            if stored is not None:
+                logger.info(f"MinHash parameters changed ({stored[0]} -> {params}); clearing {self.path} for a rebuild.")
+            self.clear()
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('params', ?)", (params,))
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._connections = []
+        self._local = threading.local()
+
+    def signatures(self, texts: list[str]) -> np.ndarray:
+        return minhash_signatures(texts, self.num_perm, self.shingle_size)
+
+    def find_duplicates(self, signatures: np.ndarray, exclude_ids=()) -> list[int | None]:
+        """
+        For each signature: the FAISS id of a stored chunk at or above the threshold,
+        -(row + 1) for a near-duplicate of the unmatched signature at `row` earlier in this
+        call, or None. Ids in `exclude_ids` (chunks about to be replaced) never match.
+        """
+        conn = self._connect()
+        exclude_ids = set(exclude_ids)
+        batch_buckets = {} # (band, bucket) -> rows of earlier unique signatures in this call
+        matches = []
+        for row, signature in enumerate(signatures):
+            keys = _bucket_keys(signature, self.bands)
+            match = None
+            checked = set()
+            for key in keys:
+                earlier = next((other for other in batch_buckets.get(key, ()) if _similarity(signature, signatures[other]) >= self.threshold), None)
+                if earlier is not None:
+                    match = -(earlier + 1)
+                    break
+                candidates = [faiss_id for (faiss_id,) in conn.execute("SELECT faiss_id FROM buckets WHERE band = ? AND bucket = ? LIMIT ?",
+                                                                       (*key, _BUCKET_CANDIDATE_LIMIT))
+                              if faiss_id not in checked and faiss_id not in exclude_ids]
+                checked.update(candidates)
+                if candidates:
+                    placeholders = ",".join("?" * len(candidates))
+                    for faiss_id, blob in conn.execute(f"SELECT faiss_id, signature FROM signatures WHERE faiss_id IN ({placeholders})", candidates):
+                        if _similarity(signature, np.frombuffer(blob, dtype=np.uint32)) >= self.threshold:
+                            match = faiss_id
+                            break
+                if match is not None:
+                    break
+            if match is None:
+                for key in keys:
+                    batch_buckets.setdefault(key, []).append(row)
+            matches.append(match)
+        return matches
+
+    def add(self, faiss_ids, signatures: np.ndarray):
+        """Stores signatures under their FAISS ids (re-adding an id replaces it)."""
+        rows_signatures, rows_buckets = [], []
+        for faiss_id, signature in zip(faiss_ids, signatures):
+            signature = np.ascontiguousarray(signature, dtype=np.uint32)
+            rows_signatures.append((int(faiss_id), signature.tobytes()))
+            rows_buckets.extend((band, bucket, int(faiss_id)) for band, bucket in _bucket_keys(signature, self.bands))
+        if not rows_signatures:
+            return
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("DELETE FROM buckets WHERE faiss_id = ?", [(row[0],) for row in rows_signatures])
+            conn.executemany("INSERT OR REPLACE INTO signatures (faiss_id, signature) VALUES (?, ?)", rows_signatures)
+            for start in range(0, len(rows_buckets), _WRITE_BATCH_SIZE):
+                conn.executemany("INSERT OR REPLACE INTO buckets (band, bucket, faiss_id) VALUES (?, ?, ?)",
+                                 rows_buckets[start:start + _WRITE_BATCH_SIZE])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def remove(self, faiss_ids):
+        rows = [(int(faiss_id),) for faiss_id in faiss_ids]
+        if not rows:
+            return
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("DELETE FROM buckets WHERE faiss_id = ?", rows)
+            conn.executemany("DELETE FROM signatures WHERE faiss_id = ?", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM buckets")
+        conn.execute("DELETE FROM signatures")
+        conn.execute("COMMIT")
+
+    def count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM signatures").fetchone()[0]
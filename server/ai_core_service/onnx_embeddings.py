@@ -0,0 +1,274 @@
+# server/ai_core_service/onnx_embeddings.py
+"""
+ONNX Runtime CPU backend for sentence-transformer embedding models
+(config.EMBEDDING_TYPE = 'onnx').
+
+On first use the configured Hugging Face model is exported to ONNX with optimum and,
+unless ONNX_QUANTIZE is off, quantized to int8 weights (dynamic quantization). The
+result is kept under config.ONNX_MODEL_DIR/<model name>/:
+  - model.onnx / model_int8.onnx:  fp32 export and its int8 quantization
+  - tokenizer and config files:    saved next to the export
+  - pooling.json:                  'cls' or 'mean', copied from the model's 1_Pooling config
+Later starts only load the files. Run `python -m ai_core_service.onnx_embeddings [texts_file]`
+to compare the vectors against the PyTorch fp32 model (exit code 1 below ONNX_PARITY_MIN_COSINE).
+"""
+import os
+import sys
+import json
+import time
+import glob
+import uuid
+import shutil
+import tempfile
+import threading
+import logging
+import numpy as np
+from langchain_core.embeddings import Embeddings as LangchainEmbeddings
+from ai_core_service import config
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s')
+handler.setFormatter(formatter)
+if not logger.hasHandlers():
+    logger.addHandler(handler)
+
+FP32_FILENAME = "model.onnx"
+INT8_FILENAME = "model_int8.onnx"
+POOLING_FILENAME = "pooling.json"
+POOLING_MODES = ('cls', 'mean')
+_RETIRED_MARKER = ".retired-" # <model dir>.retired-<id>: a previous export moved aside while a new one is published
+
+PARITY_SAMPLE_TEXTS = [
+    "What is the time complexity of binary search?",
+    "Explain the difference between TCP and UDP.",
+    "Ohm's law relates voltage, current and resistance: V = I * R.",
+    "The mitochondria is the powerhouse of the cell.",
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "Course CS-101 covers variables, loops, functions and recursion.",
+    "A transformer uses self-attention to weigh the relevance of each token.",
+    "Sulfuric acid (H2SO4) is a strong diprotic acid.",
+    "def fibonacci(n): return n if n < 2 else fibonacci(n - 1) + fibonacci(n - 2)",
+    "The French Revolution began in 1789 with the storming of the Bastille.",
+    "Gradient descent updates parameters in the direction of the negative gradient.",
+    "Stress is force per unit area; strain is the relative deformation.",
+]
+
+
+def _model_dir(model_name: str) -> str:
+    safe_name = "".join(c if c.isalnum() or c in '-_.' else '_' for c in model_name)
+    return os.path.join(config.ONNX_MODEL_DIR, safe_name)
+
+
+def _read_pooling_mode(model_name: str) -> str:
+    """Pooling used by the sentence-transformer model ('cls' or 'mean'); mean when it declares none."""
+    try:
+        local_config = os.path.join(model_name, '1_Pooling', 'config.json')
+        if os.path.exists(local_config):
+            path = local_config
+        else:
+            from huggingface_hub import hf_hub_download
+            path = hf_hub_download(model_name, '1_Pooling/config.json')
+        with open(path, 'r', encoding='utf-8') as f:
+            pooling = json.load(f)
+        return 'cls' if pooling.get('pooling_mode_cls_token') else 'mean'
+    except Exception as e:
+        logger.warning(f"Could not read pooling config for '{model_name}', using mean pooling: {e}")
+        return 'mean'
+
+
+def _restore_retired_export(target_dir: str):
+    """Puts back an export that a crashed publish had moved aside; removes retired copies once the target exists."""
+    retired = sorted(glob.glob(glob.escape(target_dir) + _RETIRED_MARKER + "*"), key=os.path.getmtime)
+    if retired and not os.path.isdir(target_dir):
+        try:
+            os.replace(retired.pop(), target_dir)
+            logger.warning(f"Restored the previous ONNX export at {target_dir} after an interrupted publish.")
+        except OSError:
+            pass # A concurrent exporter published first
+    if os.path.isdir(target_dir):
+        for path in retired:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _publish_export(build_dir: str, target_dir: str):
+    """
+    Moves a finished export into place. An existing directory is renamed to a sibling
+    first and deleted only after the new one is in place, so a crash at any point
+    leaves a complete export on disk (restored by _restore_retired_export).
+    """
+    retired_dir = None
+    if os.path.isdir(target_dir):
+        retired_dir = target_dir + _RETIRED_MARKER + uuid.uuid4().hex
+        os.replace(target_dir, retired_dir)
+    try:
+        os.replace(build_dir, target_dir)
+    except OSError:
+        if retired_dir and not os.path.isdir(target_dir):
+            os.replace(retired_dir, target_dir)
+        raise
+    if retired_dir:
+        shutil.rmtree(retired_dir, ignore_errors=True)
+
+
+def export_model(model_name: str, quantize: bool) -> str:
+    """Exports (and quantizes) the model unless already done; returns the model directory."""
+    target_dir = _model_dir(model_name)
+    _restore_retired_export(target_dir)
+    model_file = INT8_FILENAME if quantize else FP32_FILENAME
+    if os.path.exists(os.path.join(target_dir, model_file)):
+        return target_dir
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    from transformers import AutoTokenizer
+
+    os.makedirs(config.ONNX_MODEL_DIR, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix="export_", dir=config.ONNX_MODEL_DIR)
+    try:
+        if os.path.exists(os.path.join(target_dir, FP32_FILENAME)):
+            # Only the quantized variant is missing: reuse the earlier export
+            shutil.rmtree(build_dir)
+            shutil.copytree(target_dir, build_dir)
+        else:
+            start = time.perf_counter()
+            logger.info(f"Exporting '{model_name}' to ONNX (one-time)...")
+            ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(build_dir)
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(build_dir)
+            with open(os.path.join(build_dir, POOLING_FILENAME), 'w', encoding='utf-8') as f:
+                json.dump({"mode": _read_pooling_mode(model_name)}, f)
+            logger.info(f"Exported '{model_name}' in {time.perf_counter() - start:.1f}s.")
+        if quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            start = time.perf_counter()
+            quantize_dynamic(os.path.join(build_dir, FP32_FILENAME), os.path.join(build_dir, INT8_FILENAME),
+                             weight_type=QuantType.QInt8)
+            logger.info(f"Quantized '{model_name}' to int8 in {time.perf_counter() - start:.1f}s.")
+        # A concurrent exporter that finished first wins
+        if os.path.exists(os.path.join(target_dir, model_file)):
+            shutil.rmtree(build_dir)
+        else:
+            _publish_export(build_dir, target_dir)
+    except Exception:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    return target_dir
+
+
+class OnnxEmbeddings(LangchainEmbeddings):
+    """LangChain embeddings served by an ONNX Runtime CPU session (int8 by default)."""
+
+    def __init__(self, model_name: str, quantize: bool = None, normalize: bool = True):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.model_name = model_name
+        self.quantize = config.ONNX_QUANTIZE if quantize is None else quantize
+        self.normalize = normalize
+        self.batch_size = max(1, config.ONNX_BATCH_SIZE)
+        self.max_length = config.ONNX_MAX_SEQ_LENGTH
+        model_dir = export_model(model_name, self.quantize)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if config.ONNX_NUM_THREADS > 0:
+            options.intra_op_num_threads = config.ONNX_NUM_THREADS
+        model_path = os.path.join(model_dir, INT8_FILENAME if self.quantize else FP32_FILENAME)
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self._input_names = [i.name for i in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self._tokenizer_lock = threading.Lock() # Fast tokenizers are not safe to call from several threads
+
+        pooling = config.ONNX_POOLING
+        if pooling not in POOLING_MODES:
+            pooling_path = os.path.join(model_dir, POOLING_FILENAME)
+            pooling = 'mean'
+            if os.path.exists(pooling_path):
+                with open(pooling_path, 'r', encoding='utf-8') as f:
+                    pooling = json.load(f).get("mode", 'mean')
+        self.pooling = pooling
+        with open(os.path.join(model_dir, 'config.json'), 'r', encoding='utf-8') as f:
+            self.dimension = int(json.load(f)['hidden_size'])
+        logger.info(f"Loaded ONNX embeddings for '{model_name}' ({'int8' if self.quantize else 'fp32'}, "
+                    f"{self.pooling} pooling, dim {self.dimension}) from {model_path}")
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def _encode(self, texts: list[str]) -> np.ndarray:
+        output = np.empty((len(texts), self.dimension), dtype=np.float32)
+        # Batches of similar length waste less compute on padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            with self._tokenizer_lock:
+                encoded = self.tokenizer([texts[i] for i in batch], padding=True, truncation=True,
+                                         max_length=self.max_length, return_tensors='np')
+            feeds = {name: encoded[name].astype(np.int64) for name in self._input_names if name in encoded}
+            if 'token_type_ids' in self._input_names and 'token_type_ids' not in feeds:
+                feeds['token_type_ids'] = np.zeros_like(feeds['input_ids'])
+            hidden = self.session.run(None, feeds)[0] # last_hidden_state: (batch, tokens, dim)
+            if self.pooling == 'cls':
+                pooled = hidden[:, 0]
+            else:
+                mask = encoded['attention_mask'][..., None].astype(np.float32)
+                pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            output[batch] = pooled
+        if self.normalize:
+            output /= np.clip(np.linalg.norm(output, axis=1, keepdims=True), 1e-12, None)
+        return output
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return self._encode(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._encode([text])[0].tolist()
+
+
+def parity_check(model_name: str = None, texts: list[str] = None) -> dict:
+    """Compares ONNX vectors with the PyTorch fp32 sentence-transformer on the same texts."""
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    model_name = model_name or config.EMBEDDING_MODEL_NAME
+    texts = texts or PARITY_SAMPLE_TEXTS
+    reference = HuggingFaceEmbeddings(model_name=model_name, model_kwargs={'device': 'cpu'},
+                                      encode_kwargs={'normalize_embeddings': True})
+    candidate = OnnxEmbeddings(model_name)
+    start = time.perf_counter()
+    expected = np.array(reference.embed_documents(texts), dtype=np.float32)
+    reference_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = np.array(candidate.embed_documents(texts), dtype=np.float32)
+    onnx_seconds = time.perf_counter() - start
+
+    cosines = (expected * actual).sum(axis=1) / np.clip(
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1), 1e-12, None)
+    # Nearest-neighbour agreement: does each text keep the same closest other text?
+    expected_sim, actual_sim = expected @ expected.T, actual @ actual.T
+    np.fill_diagonal(expected_sim, -np.inf)
+    np.fill_diagonal(actual_sim, -np.inf)
+    neighbour_agreement = float(np.mean(expected_sim.argmax(axis=1) == actual_sim.argmax(axis=1)))
+    result = {
+        "model": model_name,
+        "quantized": candidate.quantize,
+        "texts": len(texts),
+        "min_cosine": round(float(cosines.min()), 5),
+        "mean_cosine": round(float(cosines.mean()), 5),
+        "neighbour_agreement": round(neighbour_agreement, 4),
+        "fp32_seconds": round(reference_seconds, 3),
+        "onnx_seconds": round(onnx_seconds, 3),
+        "threshold": config.ONNX_PARITY_MIN_COSINE,
+    }
+    result["passed"] = result["min_cosine"] >= config.ONNX_PARITY_MIN_COSINE
+    return result
+
+
+if __name__ == "__main__":
+    sample = None
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r', encoding='utf-8') as f:
+            sample = [line.strip() for line in f if line.strip()]
+    report = parity_check(texts=sample)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["passed"] else 1)
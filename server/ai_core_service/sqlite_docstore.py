@@ -0,0 +1,151 @@
+# server/ai_core_service/sqlite_docstore.py
+"""
+SQLite-backed LangChain docstore kept next to each FAISS index (docstore.sqlite in the
+index directory). Chunks are written as they are added and read back one hit at a time,
+so loading an index no longer unpickles every chunk text and RSS does not grow with the
+corpus. Pickling the docstore (as FAISS.save_local does) only stores its path.
+Writes happen under the owning index's state lock; reads may run concurrently (sqlite
+WAL mode, one connection per thread).
+"""
+import os
+import json
+import sqlite3
+import threading
+import logging
+from langchain_core.documents import Document as LangchainDocument
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s')
+handler.setFormatter(formatter)
+if not logger.hasHandlers():
+    logger.addHandler(handler)
+
+DOCSTORE_FILENAME = "docstore.sqlite"
+_SQLITE_MAX_VARIABLES = 900 # Stay below SQLITE_MAX_VARIABLE_NUMBER on older builds
+_SCAN_BATCH_SIZE = 5000
+
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    """Docstore with the InMemoryDocstore interface (search/add/delete) over a sqlite table."""
+
+    def __init__(self, index_dir: str):
+        self._open(index_dir)
+
+    def _open(self, index_dir: str):
+        os.makedirs(index_dir, exist_ok=True)
+        self.path = os.path.join(index_dir, DOCSTORE_FILENAME)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._connect().execute("CREATE TABLE IF NOT EXISTS docs (doc_id TEXT PRIMARY KEY, content TEXT NOT NULL, "
+                                "metadata TEXT NOT NULL) WITHOUT ROWID")
+
+    def __getstate__(self):
+        return {"index_dir": os.path.dirname(self.path)}
+
+    def __setstate__(self, state):
+        self._open(state["index_dir"])
+
+    def rebind(self, index_dir: str):
+        """Points the store at `index_dir` (the pickled path may be stale if the index directory moved)."""
+        if os.path.dirname(self.path) != index_dir:
+            self.close()
+            self._open(index_dir)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._connections = []
+        self._local = threading.local()
+
+    @staticmethod
+    def _to_document(content: str, metadata: str) -> LangchainDocument:
+        return LangchainDocument(page_content=content, metadata=json.loads(metadata))
+
+    def search(self, search: str):
+        """The Document stored under `search`, or a not-found message (like InMemoryDocstore)."""
+        if search is None:
+            return f"ID {search} not found."
+        row = self._connect().execute("SELECT content, metadata FROM docs WHERE doc_id = ?", (search,)).fetchone()
+        return self._to_document(*row) if row else f"ID {search} not found."
+
+    def mget(self, doc_ids) -> dict:
+        """{doc_id: Document} for the ids present, fetched in a few IN queries."""
+        conn = self._connect()
+        found = {}
+        doc_ids = [doc_id for doc_id in dict.fromkeys(doc_ids) if doc_id is not None]
+        for start in range(0, len(doc_ids), _SQLITE_MAX_VARIABLES):
+            batch = doc_ids[start:start + _SQLITE_MAX_VARIABLES]
+            placeholders = ",".join("?" * len(batch))
+            for doc_id, content, metadata in conn.execute(f"SELECT doc_id, content, metadata FROM docs WHERE doc_id IN ({placeholders})", batch):
+                found[doc_id] = self._to_document(content, metadata)
+        return found
+
+    def add(self, texts: dict) -> None:
+        """Stores documents by id. Re-adding an id replaces it, so replaying a segment is harmless."""
+        rows = [(doc_id, doc.page_content, json.dumps(doc.metadata, default=str)) for doc_id, doc in texts.items()]
+        if not rows:
+            return
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO docs (doc_id, content, metadata) VALUES (?, ?, ?)", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, ids) -> None:
+        """Removes documents by id; unknown ids are ignored."""
+        rows = [(doc_id,) for doc_id in ids]
+        if not rows:
+            return
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("DELETE FROM docs WHERE doc_id = ?", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("DELETE FROM docs")
+
+    def __len__(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def iter_items(self):
+        """Yields (doc_id, Document) for every stored chunk, reading the table in batches."""
+        conn = self._connect()
+        last_id = ""
+        while True:
+            rows = conn.execute("SELECT doc_id, content, metadata FROM docs WHERE doc_id > ? ORDER BY doc_id LIMIT ?",
+                                (last_id, _SCAN_BATCH_SIZE)).fetchall()
+            if not rows:
+                return
+            for doc_id, content, metadata in rows:
+                yield doc_id, self._to_document(content, metadata)
+            last_id = rows[-1][0]
+
+    def file_bytes(self) -> int:
+        return sum(os.path.getsize(self.path + suffix) for suffix in ("", "-wal") if os.path.exists(self.path + suffix))
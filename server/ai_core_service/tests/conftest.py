@@ -0,0 +1,73 @@
+# server/ai_core_service/tests/conftest.py
+import os
+import sys
+import hashlib
+import logging
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+
+os.environ.setdefault('DEBUG_CONFIG', 'false')
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))) # server/, for `ai_core_service` imports
+
+from ai_core_service import config
+from ai_core_service import embedding_store
+from ai_core_service import faiss_handler
+
+EMBEDDING_DIM = 32
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic bag-of-words embedder: every word maps to a fixed random unit vector."""
+
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split() or ['']:
+            seed = int.from_bytes(hashlib.md5(word.encode('utf-8')).digest()[:4], 'little')
+            vector += np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return (vector / (np.linalg.norm(vector) + 1e-9)).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class _ErrorCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def isolated_service(tmp_path, monkeypatch):
+    """faiss_handler with a fake embedder, fresh module state and index/embedding store directories under tmp_path."""
+    monkeypatch.setattr(config, 'FAISS_INDEX_DIR', str(tmp_path / 'faiss_indices'))
+    monkeypatch.setattr(config, 'EMBEDDING_STORE_DIR', str(tmp_path / 'embedding_store'))
+    monkeypatch.setattr(config, 'DEFAULT_INDEX_EMBEDDING_MODEL', '')
+    monkeypatch.setattr(faiss_handler, 'embedding_model', FakeEmbeddings())
+    monkeypatch.setattr(faiss_handler, '_embedding_dimension', None)
+    monkeypatch.setattr(faiss_handler, '_embedding_dispatcher', None)
+    monkeypatch.setattr(faiss_handler, 'loaded_indices', faiss_handler.IndexRegistry())
+    monkeypatch.setattr(faiss_handler, '_index_states', {})
+    monkeypatch.setattr(embedding_store, '_stores', {})
+    faiss_handler.query_embedding_cache.clear()
+    yield faiss_handler
+    faiss_handler.query_embedding_cache.clear()
+
+
+@pytest.fixture
+def logged_errors():
+    """ERROR records logged by any ai_core_service module during the test (many failures are logged, not raised)."""
+    collector = _ErrorCollector()
+    service_logger = logging.getLogger('ai_core_service')
+    service_logger.addHandler(collector)
+    yield collector.records
+    service_logger.removeHandler(collector)
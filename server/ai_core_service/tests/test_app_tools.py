@@ -0,0 +1,41 @@
+# server/ai_core_service/tests/test_app_tools.py
+import importlib
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('langchain.text_splitter') # file_parser's splitter; app.py exits when its imports fail
+
+from ai_core_service import config
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    from ai_core_service import app as app_module
+    monkeypatch.setattr(config, 'DEFAULT_ASSETS_DIR', str(tmp_path))
+    return app_module
+
+
+def _fail_importing(monkeypatch, module_name, missing_dependency):
+    """Makes importlib fail for `module_name` as if its dependency were not installed."""
+    real_import_module = importlib.import_module
+
+    def import_module(name, *args, **kwargs):
+        if name == module_name:
+            raise ModuleNotFoundError(f"No module named '{missing_dependency}'", name=missing_dependency)
+        return real_import_module(name, *args, **kwargs)
+    monkeypatch.setattr(importlib, 'import_module', import_module)
+
+
+@pytest.mark.parametrize('attribute, route, request_kwargs', [
+    ('youtube_dl_core', '/tools/download/youtube', {'json': {'user_id': 'u1', 'url': 'https://example.com/watch?v=1'}}),
+    ('md_to_office', '/tools/create/ppt?user_id=u1', {'data': '# Slide\n- point'}),
+])
+def test_missing_tool_dependency_returns_501(app_module, monkeypatch, attribute, route, request_kwargs):
+    module_name = getattr(app_module, attribute)._module_name
+    monkeypatch.setattr(app_module, attribute, app_module._LazyModule(module_name)) # Not imported yet
+    _fail_importing(monkeypatch, module_name, 'missing_tool_dependency')
+
+    response = app_module.app.test_client().post(route, **request_kwargs)
+
+    assert response.status_code == 501
+    assert 'missing_tool_dependency' in response.get_json()['error']
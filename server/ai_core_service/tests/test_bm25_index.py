@@ -0,0 +1,41 @@
+# server/ai_core_service/tests/test_bm25_index.py
+import sqlite3
+
+from ai_core_service import bm25_index
+
+
+def _scanned_totals(index):
+    with sqlite3.connect(index.path) as conn:
+        return conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+
+
+def _stored_totals(index):
+    return tuple(index._connect().execute("SELECT doc_count, total_length FROM stats WHERE id = 0").fetchone())
+
+
+def test_corpus_totals_follow_add_replace_remove_and_clear(tmp_path):
+    index = bm25_index.BM25Index(str(tmp_path))
+    index.add([1, 2, 3], ["alpha beta", "beta gamma delta", "CS-101 syllabus"])
+    assert _stored_totals(index) == _scanned_totals(index) == (3, 2 + 3 + 4)
+    index.add([2], ["beta"]) # Re-adding an id replaces its length
+    assert _stored_totals(index) == _scanned_totals(index) == (3, 2 + 1 + 4)
+    index.remove([1, 99])
+    assert _stored_totals(index) == _scanned_totals(index) == (2, 1 + 4)
+    assert index.count() == 2
+    assert {faiss_id for faiss_id, _ in index.search("syllabus beta", 5)} == {2, 3}
+    index.clear()
+    assert _stored_totals(index) == (0, 0)
+    assert index.search("beta", 5) == []
+    index.close()
+
+
+def test_totals_are_backfilled_for_an_existing_file(tmp_path):
+    index = bm25_index.BM25Index(str(tmp_path))
+    index.add([1, 2], ["one two three", "four"])
+    index.close()
+    with sqlite3.connect(index.path) as conn: # A sidecar written before the stats table existed
+        conn.execute("DROP TABLE stats")
+    reopened = bm25_index.BM25Index(str(tmp_path))
+    assert _stored_totals(reopened) == (2, 4)
+    assert reopened.search("four", 1)[0][0] == 2
+    reopened.close()
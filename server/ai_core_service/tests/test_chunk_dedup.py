@@ -0,0 +1,96 @@
+# server/ai_core_service/tests/test_chunk_dedup.py
+import pytest
+from langchain_core.documents import Document
+
+from ai_core_service import config
+
+SYLLABUS = ["CS-101 covers variables, loops and functions.", "Grading: two exams and weekly labs.", "Office hours are on Tuesdays."]
+
+
+def _documents(name, texts):
+    return [Document(page_content=text, metadata={'documentName': name}) for text in texts]
+
+
+def _names_by_text(fh, user_id, document_name):
+    """Chunk text -> referencing documentNames for the chunks a document filter finds."""
+    index = fh.load_or_create_index(user_id)
+    filter_ids = fh._document_filter_ids(user_id, index, [document_name])
+    with fh._get_index_state(user_id).rwlock.read():
+        docs = fh._documents_for_ids(index, filter_ids)
+    return {doc.page_content: fh._document_names(doc) for doc in docs.values()}
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'compact'])
+def fh(isolated_service, monkeypatch, request):
+    monkeypatch.setattr(config, 'DOCSTORE_BACKEND', request.param)
+    return isolated_service
+
+
+@pytest.mark.parametrize('reload', [False, True])
+def test_identical_text_under_two_names_is_stored_once(fh, logged_errors, reload):
+    fh.add_documents_to_index('dedup-user', _documents('syllabus.pdf', SYLLABUS))
+    result = fh.add_documents_to_index('dedup-user', _documents('syllabus-copy.pdf', SYLLABUS))
+    assert result['chunks_added'] == 0 and result['chunks_skipped_duplicate'] == 3
+    if reload:
+        fh._evict_index('dedup-user') # The references are replayed from the delta segments
+    assert fh.load_or_create_index('dedup-user').index.ntotal == 3
+    for name in ('syllabus.pdf', 'syllabus-copy.pdf'):
+        assert _names_by_text(fh, 'dedup-user', name) == {text: ['syllabus.pdf', 'syllabus-copy.pdf'] for text in SYLLABUS}
+    results = fh.query_index_batch('dedup-user', [SYLLABUS[1]], k=3, document_names=['syllabus-copy.pdf'])
+    assert SYLLABUS[1] in {doc.page_content for doc, _ in results}
+
+    assert fh.remove_document('dedup-user', 'syllabus.pdf') == 3
+    if reload:
+        fh._evict_index('dedup-user')
+    index = fh.load_or_create_index('dedup-user')
+    assert index.index.ntotal == 3 # Still referenced by the copy
+    assert _names_by_text(fh, 'dedup-user', 'syllabus.pdf') == {}
+    assert _names_by_text(fh, 'dedup-user', 'syllabus-copy.pdf') == {text: ['syllabus-copy.pdf'] for text in SYLLABUS}
+    with fh._get_index_state('dedup-user').rwlock.read():
+        assert {doc.metadata['documentName'] for doc in fh._documents_for_ids(index, index.index_to_docstore_id).values()} == {'syllabus-copy.pdf'}
+
+    assert fh.remove_document('dedup-user', 'syllabus-copy.pdf') == 3
+    assert fh.load_or_create_index('dedup-user').index.ntotal == 0
+    assert [record.getMessage() for record in logged_errors] == []
+
+
+def test_upsert_drops_only_its_own_references(fh):
+    fh.add_documents_to_index('dedup-user', _documents('a.pdf', SYLLABUS))
+    fh.add_documents_to_index('dedup-user', _documents('b.pdf', SYLLABUS[:2] + ["Only in b."]))
+    result = fh.add_documents_to_index('dedup-user', _documents('a.pdf', ["Rewritten first chapter.", SYLLABUS[1]]), upsert=True)
+    assert result['chunks_added'] == 1 and result['chunks_replaced'] == 1 # SYLLABUS[2] had no other reference
+
+    fh._evict_index('dedup-user')
+    index = fh.load_or_create_index('dedup-user')
+    assert index.index.ntotal == 4
+    assert _names_by_text(fh, 'dedup-user', 'a.pdf') == {"Rewritten first chapter.": ['a.pdf'], SYLLABUS[1]: ['a.pdf', 'b.pdf']}
+    assert _names_by_text(fh, 'dedup-user', 'b.pdf') == {SYLLABUS[0]: ['b.pdf'], SYLLABUS[1]: ['a.pdf', 'b.pdf'], "Only in b.": ['b.pdf']}
+
+
+def test_a_batch_repeating_content_across_names_stores_it_once(fh):
+    fh.add_documents_to_index('dedup-user', _documents('a.pdf', SYLLABUS[:1]) + _documents('b.pdf', SYLLABUS[:1]))
+    assert fh.load_or_create_index('dedup-user').index.ntotal == 1
+    assert _names_by_text(fh, 'dedup-user', 'b.pdf') == {SYLLABUS[0]: ['a.pdf', 'b.pdf']}
+
+
+def _boilerplate(page):
+    return ("This handout is published by the Department of Computer Science for enrolled students only. "
+            "It may not be copied, shared or uploaded to any website without the written permission of the "
+            f"course coordinator. Questions about the material go to the course forum. Page {page}")
+
+
+def test_boilerplate_shared_across_documents_survives_removing_the_first(fh, logged_errors, monkeypatch):
+    monkeypatch.setattr(config, 'NEAR_DUPLICATE_ENABLED', True)
+    fh.add_documents_to_index('dedup-user', _documents('week1.pdf', ["Week 1 introduces recursion.", _boilerplate(1)]))
+    result = fh.add_documents_to_index('dedup-user', _documents('week2.pdf', ["Week 2 covers sorting algorithms.", _boilerplate(7)]))
+    assert result['chunks_added'] == 1 and result['chunks_skipped_near_duplicate'] == 1
+    assert fh.load_or_create_index('dedup-user').index.ntotal == 3
+    assert _names_by_text(fh, 'dedup-user', 'week2.pdf')[_boilerplate(1)] == ['week1.pdf', 'week2.pdf']
+
+    assert fh.remove_document('dedup-user', 'week1.pdf') == 2
+    fh._evict_index('dedup-user')
+    assert fh.load_or_create_index('dedup-user').index.ntotal == 2 # The paragraph is kept for week2.pdf
+    assert _names_by_text(fh, 'dedup-user', 'week2.pdf') == {"Week 2 covers sorting algorithms.": ['week2.pdf'], _boilerplate(1): ['week2.pdf']}
+    results = fh.query_index_batch('dedup-user', ["written permission of the course coordinator"], k=2, document_names=['week2.pdf'])
+    assert _boilerplate(1) in {doc.page_content for doc, _ in results}
+    assert [record.getMessage() for record in logged_errors] == []
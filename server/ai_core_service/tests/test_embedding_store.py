@@ -0,0 +1,40 @@
+# server/ai_core_service/tests/test_embedding_store.py
+import threading
+import numpy as np
+
+from ai_core_service import embedding_store
+
+
+def test_concurrent_lookups_count_every_hit_and_miss(tmp_path):
+    store = embedding_store.EmbeddingStore('fake-model', str(tmp_path))
+    hashes = [embedding_store.text_hash(f"chunk {i}") for i in range(8)]
+    store.put_many(hashes[:4], np.eye(8, dtype=np.float32)[:4])
+    start = threading.Barrier(8)
+
+    def lookup():
+        start.wait()
+        for _ in range(200):
+            store.get_many(hashes)
+
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = store.stats()
+    assert (stats['hits'], stats['misses']) == (8 * 200 * 4, 8 * 200 * 4)
+    assert stats['vectors'] == 4 and stats['file_bytes'] == 4 * 8 * 4
+
+
+def test_vectors_are_read_back_after_reopening_the_store(tmp_path):
+    hashes = [embedding_store.text_hash(f"chunk {i}") for i in range(3)]
+    vectors = np.arange(2 * 4, dtype=np.float32).reshape(2, 4)
+    embedding_store.EmbeddingStore('fake-model', str(tmp_path)).put_many(hashes[:2], vectors)
+
+    reopened = embedding_store.EmbeddingStore('fake-model', str(tmp_path)) # A new process on the same directory
+    found = reopened.get_many(hashes)
+
+    assert reopened.dimension == 4 and found.keys() == set(hashes[:2])
+    np.testing.assert_array_equal(np.vstack([found[h] for h in hashes[:2]]), vectors)
+    stats = reopened.stats()
+    assert (stats['hits'], stats['misses'], stats['vectors']) == (2, 1, 2)
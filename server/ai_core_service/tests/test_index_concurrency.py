@@ -0,0 +1,172 @@
+# server/ai_core_service/tests/test_index_concurrency.py
+"""
+Stress test for per-index locking: concurrent ingests, upserts, document removals and
+batched queries across several user indices, with a small index cache so indices are
+evicted and reloaded while in use. Afterwards every index must hold exactly the chunks
+its writers left behind, in memory and after an eviction and reload from disk.
+"""
+import time
+import random
+import threading
+import pytest
+from langchain_core.documents import Document
+
+from ai_core_service import config
+
+USERS = ['stress-u0', 'stress-u1', 'stress-u2', 'stress-u3']
+WRITERS_PER_USER = 2
+ITERATIONS = 12
+READERS = 4
+
+
+def _chunks(user_id, document_name, version, count):
+    return [f"{user_id} {document_name} v{version} chunk{c} topic{c % 5} w{(c * 7) % 11}" for c in range(count)]
+
+
+def _documents(document_name, texts):
+    return [Document(page_content=text, metadata={'documentName': document_name}) for text in texts]
+
+
+def _writer(fh, user_id, tag, expected, errors, start):
+    """Adds, upserts and removes documents named '<tag>-<i>.pdf'; `expected` tracks documentName -> chunk texts."""
+    start.wait()
+    try:
+        for i in range(ITERATIONS):
+            name = f"{tag}-{i}.pdf"
+            texts = _chunks(user_id, name, 0, 3)
+            fh.add_documents_to_index(user_id, _documents(name, texts))
+            expected[name] = set(texts)
+            if i % 3 == 2: # Keep one chunk, replace the rest
+                name = f"{tag}-{i - 1}.pdf"
+                texts = _chunks(user_id, name, 0, 1) + _chunks(user_id, name, 1, 2)[1:]
+                fh.add_documents_to_index(user_id, _documents(name, texts), upsert=True)
+                expected[name] = set(texts)
+            if i % 4 == 3:
+                name = f"{tag}-{i - 2}.pdf"
+                assert fh.remove_document(user_id, name) == len(expected.pop(name))
+    except Exception as e:
+        errors.append(e)
+
+
+def _reader(fh, errors, stop, start, seed):
+    rng = random.Random(seed)
+    start.wait()
+    try:
+        while not stop.is_set():
+            user_id = rng.choice(USERS)
+            queries = [f"topic{rng.randrange(5)} w{rng.randrange(11)}", f"{user_id} chunk{rng.randrange(3)}"]
+            document_names = [f"w{rng.randrange(WRITERS_PER_USER)}-{rng.randrange(ITERATIONS)}.pdf"] if rng.random() < 0.3 else None
+            mode = 'hybrid' if rng.random() < 0.3 else 'vector'
+            results = fh.query_index_batch(user_id, queries, k=4, document_names=document_names, mode=mode)
+            if document_names:
+                assert all(doc.metadata['documentName'] in document_names for doc, _ in results)
+    except Exception as e:
+        errors.append(e)
+
+
+def _evictor(fh, errors, stop, start):
+    """Memory pressure from elsewhere: keeps evicting random user indices (in-use ones must be skipped)."""
+    rng = random.Random(0)
+    start.wait()
+    try:
+        while not stop.is_set():
+            fh._evict_index(rng.choice(USERS))
+            stop.wait(0.005)
+    except Exception as e:
+        errors.append(e)
+
+
+def _assert_consistent(fh, user_id, expected):
+    index = fh.load_or_create_index(user_id)
+    state = fh._get_index_state(user_id)
+    stored = {}
+    for _, doc in fh._iter_live_documents(index):
+        stored.setdefault(doc.metadata['documentName'], set()).add(doc.page_content)
+    assert stored == expected
+    assert index.index.ntotal == len(index.index_to_docstore_id) + len(state.tombstones)
+    document_ids = fh._document_ids(user_id, index)
+    assert {name: len(ids) for name, ids in document_ids.items()} == {name: len(texts) for name, texts in expected.items()}
+
+
+@pytest.mark.parametrize('ann_mode', ['flat', 'hnsw'])
+def test_concurrent_ingest_remove_and_query(isolated_service, logged_errors, monkeypatch, ann_mode):
+    fh = isolated_service
+    monkeypatch.setattr(config, 'FAISS_ANN_MODE', ann_mode)
+    monkeypatch.setattr(config, 'FAISS_ANN_PROMOTION_THRESHOLD', 40) # HNSW promotion happens mid-run
+    monkeypatch.setattr(config, 'FAISS_COMPACTION_MAX_SEGMENTS', 4) # Frequent background compactions
+    monkeypatch.setattr(config, 'FAISS_MAX_LOADED_INDICES', 3) # Default index plus two of the four users
+    monkeypatch.setattr(config, 'NEAR_DUPLICATE_ENABLED', True)
+
+    expected = {(user_id, w): {} for user_id in USERS for w in range(WRITERS_PER_USER)}
+    errors, stop = [], threading.Event()
+    start = threading.Barrier(len(expected) + READERS + 1)
+    writers = [threading.Thread(target=_writer, args=(fh, user_id, f"w{w}", expected[(user_id, w)], errors, start))
+               for user_id, w in expected]
+    background = [threading.Thread(target=_reader, args=(fh, errors, stop, start, seed)) for seed in range(READERS)]
+    background.append(threading.Thread(target=_evictor, args=(fh, errors, stop, start)))
+    for thread in writers + background:
+        thread.start()
+    for thread in writers:
+        thread.join(timeout=300)
+    stop.set()
+    for thread in background:
+        thread.join(timeout=60)
+
+    assert not any(thread.is_alive() for thread in writers + background)
+    assert errors == []
+    assert [record.getMessage() for record in logged_errors] == []
+
+    for user_id in USERS:
+        user_expected = {name: texts for (owner, _), docs in expected.items() if owner == user_id for name, texts in docs.items()}
+        _assert_consistent(fh, user_id, user_expected)
+        fh._evict_index(user_id) # Waits for an in-flight compaction, then drops the in-memory state
+        _assert_consistent(fh, user_id, user_expected)
+        fh._evict_index(user_id)
+
+
+def test_hybrid_query_does_not_wait_for_the_writer_lock(isolated_service):
+    fh = isolated_service
+    fh.add_documents_to_index('lock-user', _documents('a.pdf', _chunks('lock-user', 'a.pdf', 0, 5)))
+    fh.query_index('lock-user', "topic1", k=2, mode='hybrid') # Sidecars and derived maps exist from here on
+    state = fh._get_index_state('lock-user')
+    results = []
+    with state.lock: # Held by a writer, e.g. across a base snapshot or ANN promotion
+        query = threading.Thread(target=lambda: results.append(fh.query_index('lock-user', "topic1 w7", k=2, mode='hybrid')))
+        query.start()
+        query.join(timeout=10)
+        finished = not query.is_alive()
+    query.join()
+    assert finished
+    assert len(results[0]) == 2
+
+
+def test_nested_read_does_not_wait_behind_a_queued_writer(isolated_service):
+    lock = isolated_service.ReadWriteLock()
+    events = []
+
+    def writer():
+        with lock.write():
+            events.append('write')
+
+    def reader():
+        with lock.read():
+            writer_thread.start()
+            for _ in range(500): # Until the writer is queued on the lock
+                if lock._writers_waiting:
+                    break
+                time.sleep(0.01)
+            with lock.read(): # Would deadlock if re-entry queued behind the writer
+                events.append('nested read')
+
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    reader_thread.start()
+    reader_thread.join(timeout=10)
+    assert not reader_thread.is_alive()
+    writer_thread.join(timeout=10)
+    assert events == ['nested read', 'write']
+    with pytest.raises(RuntimeError):
+        with lock.read(), lock.write():
+            pass
+    with lock.write(), lock.read(), lock.write(): # The writer may re-enter either side
+        pass
@@ -0,0 +1,76 @@
+# server/ai_core_service/tests/test_index_dimension.py
+import os
+import json
+import time
+import numpy as np
+from langchain_core.documents import Document
+
+from ai_core_service import config
+from conftest import FakeEmbeddings
+
+TEXTS = [f"chunk {i} topic{i % 3} w{(i * 7) % 11}" for i in range(12)]
+
+
+class _CountingEmbeddings(FakeEmbeddings):
+    def __init__(self):
+        super().__init__()
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return super().embed_documents(texts)
+
+
+def _build_index(fh, user_id):
+    fh.add_documents_to_index(user_id, [Document(page_content=text, metadata={'documentName': 'a.pdf'}) for text in TEXTS])
+    index = fh.load_or_create_index(user_id)
+    vectors = {int(i): v for v, ids in fh._iter_index_vectors(index.index) for i, v in zip(ids, v)}
+    fh._evict_index(user_id)
+    return vectors
+
+
+def test_shrinking_an_uncompressed_index_truncates_its_stored_vectors(isolated_service, monkeypatch):
+    fh = isolated_service
+    monkeypatch.setattr(config, 'EMBEDDING_STORE_ENABLED', False) # Every chunk would be a store miss
+    full_vectors = _build_index(fh, 'shrink-user')
+    monkeypatch.setattr(config, 'EMBEDDING_OUTPUT_DIM', 16)
+    counting = _CountingEmbeddings()
+    monkeypatch.setattr(fh, 'embedding_model', counting)
+
+    index = fh.load_or_create_index('shrink-user')
+
+    assert counting.embedded == 0 # Converted from the stored vectors, not by calling the model
+    assert index.index.d == 16 and fh._get_index_state('shrink-user').reembedding is None
+    converted = {int(i): v for v, ids in fh._iter_index_vectors(index.index) for i, v in zip(ids, v)}
+    assert converted.keys() == full_vectors.keys()
+    ids = sorted(full_vectors)
+    expected = fh._project_embeddings(np.vstack([full_vectors[i] for i in ids]), 16)
+    np.testing.assert_allclose(np.vstack([converted[i] for i in ids]), expected, atol=1e-6)
+    assert fh.query_index('shrink-user', TEXTS[4], k=1)[0][0].page_content == TEXTS[4]
+
+
+def test_an_index_of_unrecorded_model_is_re_embedded_in_the_background(isolated_service, monkeypatch):
+    fh = isolated_service
+    _build_index(fh, 'legacy-user')
+    manifest_path = os.path.join(fh.get_user_index_path('legacy-user'), fh.MANIFEST_FILENAME)
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    manifest.update(format_version=1, embedding_model=None, embedding_model_name=None, embedding_type=None, embedding_dim=None)
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f) # Written before models were recorded
+    monkeypatch.setattr(config, 'EMBEDDING_OUTPUT_DIM', 16)
+    monkeypatch.setattr(config, 'REEMBED_BATCH_SIZE', 2)
+    monkeypatch.setattr(config, 'REEMBED_BATCH_PAUSE_MS', 50)
+
+    index = fh.load_or_create_index('legacy-user')
+    state = fh._get_index_state('legacy-user')
+    assert state.reembedding is not None and index.index.d == 32 # Loading returned before any chunk was re-embedded
+    for _ in range(500):
+        if state.reembedding is None:
+            break
+        time.sleep(0.01)
+
+    assert state.reembedding is None and index.index.d == 16
+    assert index.index.ntotal == len(TEXTS)
+    assert state.embedding_model['embedding_model'] == fh._target_model('legacy-user')['embedding_model']
+    assert fh.query_index('legacy-user', TEXTS[4], k=1)[0][0].page_content == TEXTS[4]
@@ -0,0 +1,155 @@
+# server/ai_core_service/tests/test_index_persistence.py
+"""
+Restart tests for the on-disk index layout: a base snapshot plus the delta segments
+listed in manifest.json, with chunks in one of the docstore backends. A restart drops
+every in-memory structure, so whatever is asserted afterwards was read back from disk.
+"""
+import os
+import pickle
+import pytest
+from langchain_core.documents import Document
+
+from ai_core_service import config
+from ai_core_service import embedding_store
+from ai_core_service.chunk_store import ChunkStore, ChunkIdMap
+from ai_core_service.sqlite_docstore import SQLiteDocstore
+
+USER = 'persist-user'
+
+
+def _texts(document_name, count, version=0):
+    return [f"{document_name} v{version} section{c} topic{c % 3}" for c in range(count)]
+
+
+def _documents(document_name, texts):
+    return [Document(page_content=text, metadata={'documentName': document_name}) for text in texts]
+
+
+def _stored(fh, user_id):
+    """documentName -> chunk texts it references, read from the live docstore."""
+    stored = {}
+    for _, doc in fh._iter_live_documents(fh.load_or_create_index(user_id)):
+        for name in fh._document_names(doc):
+            stored.setdefault(name, set()).add(doc.page_content)
+    return stored
+
+
+def _restart(fh, monkeypatch):
+    """Drops the loaded indices, their states and the open embedding stores, as a process restart would."""
+    fh._evict_index(USER)
+    monkeypatch.setattr(fh, 'loaded_indices', fh.IndexRegistry())
+    monkeypatch.setattr(fh, '_index_states', {})
+    monkeypatch.setattr(fh, '_embedding_dispatcher', None)
+    monkeypatch.setattr(embedding_store, '_stores', {})
+    fh.query_embedding_cache.clear()
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'compact'])
+def fh(isolated_service, monkeypatch, request):
+    monkeypatch.setattr(config, 'DOCSTORE_BACKEND', request.param)
+    monkeypatch.setattr(isolated_service, 'schedule_compaction', lambda user_id: None) # Compacted only where a test says so
+    return isolated_service
+
+
+def test_restart_replays_the_base_and_its_delta_segments(fh, monkeypatch):
+    fh.add_documents_to_index(USER, _documents('a.pdf', _texts('a.pdf', 3)))
+    fh.save_index(USER)
+    fh.add_documents_to_index(USER, _documents('b.pdf', _texts('b.pdf', 2)))
+    fh.add_documents_to_index(USER, _documents('c.pdf', _texts('c.pdf', 2)))
+    expected = _stored(fh, USER)
+    assert len(fh._get_manifest(USER)["segments"]) == 2
+
+    _restart(fh, monkeypatch)
+
+    index = fh.load_or_create_index(USER)
+    manifest = fh._get_manifest(USER)
+    assert manifest["base_vectors"] == 3 and len(manifest["segments"]) == 2
+    assert index.index.ntotal == 7
+    assert _stored(fh, USER) == expected
+    assert fh.query_index(USER, _texts('c.pdf', 2)[1], k=1)[0][0].page_content == _texts('c.pdf', 2)[1]
+
+
+def test_compaction_folds_the_segments_into_a_new_base(fh, monkeypatch):
+    fh.add_documents_to_index(USER, _documents('a.pdf', _texts('a.pdf', 3)))
+    fh.add_documents_to_index(USER, _documents('b.pdf', _texts('b.pdf', 2)))
+    index_path = fh.get_user_index_path(USER)
+    generation = fh._get_manifest(USER)["base_generation"]
+    expected = _stored(fh, USER)
+
+    fh.save_index(USER)
+
+    manifest = fh._get_manifest(USER)
+    assert manifest["segments"] == [] and manifest["base_generation"] == generation + 1 and manifest["base_vectors"] == 5
+    assert os.listdir(os.path.join(index_path, fh.SEGMENTS_DIRNAME)) == []
+    assert sorted(name for name in os.listdir(index_path) if name.endswith('.faiss')) == [f"{manifest['base']}.faiss"]
+    _restart(fh, monkeypatch)
+    assert fh.load_or_create_index(USER).index.ntotal == 5
+    assert _stored(fh, USER) == expected
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_upserts_and_removals_survive_a_restart(fh, monkeypatch, compact):
+    fh.add_documents_to_index(USER, _documents('a.pdf', _texts('a.pdf', 3)))
+    fh.add_documents_to_index(USER, _documents('b.pdf', _texts('b.pdf', 3)))
+    upserted = _texts('a.pdf', 1) + _texts('a.pdf', 2, version=1)[1:] # Keeps section0, replaces the rest
+    fh.add_documents_to_index(USER, _documents('a.pdf', upserted), upsert=True)
+    assert fh.remove_document(USER, 'b.pdf') == 3
+    if compact:
+        fh.save_index(USER)
+
+    _restart(fh, monkeypatch)
+
+    index = fh.load_or_create_index(USER)
+    assert _stored(fh, USER) == {'a.pdf': set(upserted)}
+    assert len(index.index_to_docstore_id) == 2
+    assert fh._document_ids(USER, index).keys() == {'a.pdf'}
+    assert fh.query_index_batch(USER, [_texts('b.pdf', 3)[0]], k=3, document_names=['b.pdf']) == []
+
+
+def test_embedding_store_serves_a_re_upload_after_a_restart(fh, monkeypatch):
+    texts = _texts('a.pdf', 3)
+    fh.add_documents_to_index(USER, _documents('a.pdf', texts))
+
+    _restart(fh, monkeypatch)
+
+    fh.add_documents_to_index('other-user', _documents('copy.pdf', texts))
+    stats = fh.get_embedding_store_stats()
+    assert (stats['hits'], stats['misses'], stats['vectors']) == (3, 0, 3)
+
+
+def test_sqlite_docstore_round_trip(tmp_path):
+    store = SQLiteDocstore(str(tmp_path))
+    shared = Document(page_content="Shared intro.", metadata={'documentName': 'x.pdf', 'documentNames': ['x.pdf', 'y.pdf'], 'page': 3})
+    store.add({'a': Document(page_content="Old text.", metadata={'documentName': 'x.pdf'}), 'b': shared})
+    store.add({'a': Document(page_content="New text.", metadata={'documentName': 'x.pdf'})}) # Replaces
+    store.delete(['b', 'missing'])
+    store.add({'c': shared})
+
+    restored = pickle.loads(pickle.dumps(store)) # Reopens the same file
+    store.close()
+
+    assert len(restored) == 2
+    assert restored.mget(['a', 'b', 'c']) == {'a': Document(page_content="New text.", metadata={'documentName': 'x.pdf'}), 'c': shared}
+    assert restored.search('b') == "ID b not found."
+    restored.close()
+
+
+def test_chunk_store_round_trip():
+    store = ChunkStore()
+    chunk_hash = "ab" * 32
+    documents = {
+        0: Document(page_content="Première section.", metadata={'userId': 'u1', 'documentName': 'x.pdf', 'chunkIndex': 0, 'chunkHash': chunk_hash}),
+        1: Document(page_content="Shared intro.", metadata={'documentName': 'x.pdf', 'documentNames': ['x.pdf', 'y.pdf'], 'page': 3}),
+        2: Document(page_content="Deleted.", metadata={'documentName': 'y.pdf', 'chunkHash': chunk_hash.upper()}),
+    }
+    store.add(dict(zip(store.allocate_ids(3).tolist(), documents.values())))
+    store.delete([2])
+    documents[0] = Document(page_content="Rewritten.", metadata={**documents[0].metadata, 'documentNames': ['x.pdf', 'z.pdf']})
+    store.add({0: documents[0]})
+
+    restored, id_map = pickle.loads(pickle.dumps((store, ChunkIdMap(store)))) # As pickled with a base snapshot
+
+    assert id_map.store is restored
+    assert sorted(id_map) == [0, 1] and 2 not in id_map
+    assert restored.mget([0, 1, 2]) == {0: documents[0], 1: documents[1]}
+    assert restored.allocate_ids(1).tolist() == [3] # Deleted ids are never reused
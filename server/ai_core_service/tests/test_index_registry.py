@@ -0,0 +1,32 @@
+# server/ai_core_service/tests/test_index_registry.py
+from langchain_core.documents import Document
+
+from conftest import FakeEmbeddings
+
+
+def _add(fh, user_id, text):
+    fh.add_documents_to_index(user_id, [Document(page_content=text, metadata={'documentName': 'a.pdf'})])
+
+
+def test_a_dimension_change_reloads_without_a_stale_access_entry(isolated_service, logged_errors, monkeypatch):
+    fh = isolated_service
+    _add(fh, 'dim-user', "alpha beta gamma")
+    monkeypatch.setattr(fh, 'embedding_model', FakeEmbeddings(dim=16)) # The configured model changed under a cached index
+    monkeypatch.setattr(fh, '_embedding_dimension', None)
+
+    index = fh.load_or_create_index('dim-user')
+
+    assert index.index.d == 16
+    assert fh.loaded_indices.last_access.keys() == fh.loaded_indices.keys() == {'dim-user'}
+    _add(fh, 'dim-user', "delta epsilon")
+    assert index.index.ntotal == 1
+    assert [record.getMessage() for record in logged_errors] == []
+
+
+def test_deleting_an_index_forgets_its_last_access(isolated_service):
+    fh = isolated_service
+    _add(fh, 'gone-user', "alpha beta gamma")
+    fh.delete_index('gone-user')
+    assert 'gone-user' not in fh.loaded_indices
+    assert 'gone-user' not in fh.loaded_indices.last_access
+    assert fh.get_index_cache_stats()['evictions'] == 0 # Deleted, not evicted
@@ -0,0 +1,53 @@
+# server/ai_core_service/tests/test_onnx_export.py
+import os
+import pytest
+
+from ai_core_service import config
+from ai_core_service import onnx_embeddings
+
+
+def _export_dir(path, marker):
+    os.makedirs(path)
+    with open(os.path.join(path, onnx_embeddings.FP32_FILENAME), 'w') as f:
+        f.write(marker)
+
+
+def _marker(path):
+    with open(os.path.join(path, onnx_embeddings.FP32_FILENAME)) as f:
+        return f.read()
+
+
+@pytest.fixture
+def model_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'ONNX_MODEL_DIR', str(tmp_path))
+    return onnx_embeddings._model_dir('org/model')
+
+
+def test_publish_replaces_an_existing_export(tmp_path, model_dir):
+    _export_dir(model_dir, 'old')
+    _export_dir(str(tmp_path / 'export_1'), 'new')
+    onnx_embeddings._publish_export(str(tmp_path / 'export_1'), model_dir)
+    assert _marker(model_dir) == 'new'
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(model_dir)]
+
+
+def test_publish_keeps_the_old_export_when_the_swap_fails(tmp_path, model_dir, monkeypatch):
+    _export_dir(model_dir, 'old')
+    real_replace = os.replace
+
+    def replace(src, dst):
+        if os.path.basename(src).startswith('export_'):
+            raise OSError("simulated crash")
+        return real_replace(src, dst)
+    monkeypatch.setattr(os, 'replace', replace)
+    _export_dir(str(tmp_path / 'export_1'), 'new')
+    with pytest.raises(OSError):
+        onnx_embeddings._publish_export(str(tmp_path / 'export_1'), model_dir)
+    assert _marker(model_dir) == 'old'
+
+
+def test_an_export_moved_aside_by_a_crash_is_restored(tmp_path, model_dir):
+    _export_dir(model_dir + onnx_embeddings._RETIRED_MARKER + 'abc', 'old') # Crashed between the two renames
+    onnx_embeddings._restore_retired_export(model_dir)
+    assert _marker(model_dir) == 'old'
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(model_dir)]